@@ -1,23 +1,44 @@
-import subprocess
-import xml.etree.ElementTree as ET
+import asyncio
+import inspect
 import uuid
-import sqlite3
-from bs4 import BeautifulSoup
+from types import MappingProxyType
 from .Context import Context
+from .Connections import ConnectionManager
+from .Writers import MessageWriter
+from .Stores import SQLiteStore
+from .Schema import check_table_name, MESSAGE_ID, CONTENT
+from .ContextWindow import ContextWindow, extractive_summary
+from .Instrumentation import NULL_INSTRUMENTATION
+from .ResponseCache import ResponseCache, response_cache_from_params, TRUE_VALUES
+from .Providers import PROVIDER_CLIENTS, call_with_retries, acall_with_retries
+from .Sandbox import get_sandbox_pool
+from .Streaming import ResponseTagStream, TagParser, extract_tag, TEXT, START, DATA, END
 
 
 class Node:
+  """
+  Per-conversation state of a participant. The XML attributes of its role
+  live in `attributes`, a read-only mapping shared by every conversation
+  forked from the same definition, and are read as ordinary attributes.
+  """
+  __slots__ = ('name', 'context', 'parent', 'children', 'attributes')
   element = "node"
   def __init__(self, name=None, **params):
       self.name = name or 'unnamed_node'
-      # Set predefined attributes and any additional attributes from params
-      for key, value in params.items():
-          setattr(self, key, value)
+      # the role's XML attributes, or the keyword arguments of an agent built by hand
+      self.attributes = params.get('attributes') or MappingProxyType(params)
       # Set defaults for predefined attributes if not in params
       self.context = params.get('context', Context())
       self.parent = params.get('parent', None)
       self.children = []
 
+  def __getattr__(self, name):
+      # only called for names without a slot or instance attribute of their own
+      try:
+          return object.__getattribute__(self, 'attributes')[name]
+      except (KeyError, AttributeError):
+          raise AttributeError(f"{type(self).__name__!r} object has no attribute {name!r}") from None
+
 
   @classmethod
   def from_node(cls, action_node):
@@ -33,102 +54,347 @@ class Node:
       raise NotImplementedError
 
 class AgentInterface(Node):
+  __slots__ = ('role', 'spec', 'thread_id', 'input_table', 'output_table', 'rows', 'db_path',
+               'connections', 'writer', 'cache', 'store', 'bus', 'budget', 'instrumentation', 'response_cache',
+               'response_tag', 'stream', 'on_chunk', 'requests_per_minute', 'max_retries',
+               'prompt', 'context_window', 'last_response', 'messages_sent')
+
   def __init__(self, **params):
       super().__init__(**params)
-
-      # Set predefined attributes and any additional attributes from params
-      for key, value in params.items():
-          setattr(self, key, value)
+      self.role = params.get('role')
+      # the compiled RoleSpec shared by every conversation, None for agents built by hand
+      self.spec = params.get('spec')
 
       # Set defaults for non-provided attributes
       self.thread_id = params.get('thread_id', str(uuid.uuid4())[:8])
-      self.input_table = params.get('input_table', 'Messages').split(',')
-      self.output_table = params.get('output_table', 'Messages')
+      self.input_table = tuple(check_table_name(table) for table in params.get('input_table', 'Messages').split(','))
+      self.output_table = check_table_name(params.get('output_table', 'Messages'))
       self.rows = params.get('rows', 10)
       self.db_path = params.get('db_path', 'messages.db')
-      #self.connection = sqlite3.connect(self.db_path)
+      # long-lived connections shared by every agent of a parser
+      self.connections = params.get('connections') or ConnectionManager.for_path(self.db_path)
+      self.writer = params.get('writer') or MessageWriter(self.connections)
+      self.cache = self.writer.cache
+      # where messages are read and written, see Stores
+      self.store = params.get('store') or SQLiteStore(self.connections, self.writer)
+      # the MessageBus that announces this agent's messages, None for agents built by hand
+      self.bus = params.get('bus')
+      # the conversation's BudgetGovernor, None for agents built by hand
+      self.budget = params.get('budget')
+      self.instrumentation = params.get('instrumentation') or NULL_INSTRUMENTATION
+      # opt-in cache of model responses, see ResponseCache
+      self.response_cache = response_cache_from_params(params)
       self.response_tag = params.get('response_tag', None)
+      # stream="true" makes execute() stream the reply, handing each chunk to on_chunk(agent, chunk)
+      stream = params.get('stream', False)
+      self.stream = stream.strip().lower() in TRUE_VALUES if isinstance(stream, str) else bool(stream)
+      self.on_chunk = params.get('on_chunk')
+      # provider calls share a rate limiter per API key and model, see Providers
+      self.requests_per_minute = params.get('requests_per_minute')
+      self.max_retries = int(params.get('max_retries', 3))
       self.prompt = params.get('prompt','You are a helpful assistant.')
+      self.context_window = self.setup_context_window(params)
+      # number of messages written, saved with checkpoints
+      self.messages_sent = 0
 
       self.setup()
 
   def setup(self):
     pass
 
+  def setup_context_window(self, params):
+      """
+      A ContextWindow for the token_budget and summary_tokens attributes of the
+      role, split evenly between its input tables, or None to pass every row.
+      """
+      budget = params.get('token_budget')
+      if budget in (None, ''):
+          return None
+      tables = len(self.input_table)
+      summary_tokens = params.get('summary_tokens')
+      summary_tokens = int(budget) // 5 if summary_tokens in (None, '') else int(summary_tokens)
+      return ContextWindow(int(budget) // tables, summary_tokens // tables,
+                           model=getattr(self, 'model', None), summarize=self.summarize)
+
+  def summarize(self, summary, rows):
+      """
+      Adds rows that left the context window to the rolling summary. Override
+      this to summarize with a model.
+      """
+      return extractive_summary(summary, rows)
+
+  def timer(self, name, **labels):
+      """
+      Times the enclosed block under name, labelled with this agent's role.
+      """
+      if not self.instrumentation.enabled:
+          return self.instrumentation.timer(name)
+      return self.instrumentation.timer(name, role=self.role, **labels)
+
   def parse_response(self, response):
-      # Check if a response tag was specified and if it exists in the response
-      if self.response_tag and f"<{self.response_tag}>" in response:
-          try:
-              # Parse the XML response to extract the content inside the specified tag
-              root = ET.fromstring(response)
-              tag_content = root.find(self.response_tag).text
-              return tag_content
-
-          except Exception as e:
-              # Handle any potential parsing errors
-              print(f"Error parsing XML response: {e}")
+      # Return the content of the response tag if one was specified and it is in the response
+      if self.response_tag:
+          content = extract_tag(response, self.response_tag)
+          if content is not None:
+              return content
+      return response
+
+  def lookup_response(self, model, messages):
+      """
+      Returns (key, cached response or None) for a model call, or (None, None) when
+      this role has no response cache.
+      """
+      if self.response_cache is None:
+          return None, None
+      key = ResponseCache.key(model, messages)
+      response = self.response_cache.get(key)
+      self.instrumentation.count('response_cache.hits' if response is not None else 'response_cache.misses',
+                                 role=self.role, model=model)
+      return key, response
+
+  def cached_call(self, model, messages, call):
+      """
+      Returns the cached response for model and messages, or call() stored in the cache.
+      """
+      key, response = self.lookup_response(model, messages)
+      if response is None:
+          response = call()
+          if key is not None:
+              self.response_cache.set(key, response)
+      return response
+
+  async def acached_call(self, model, messages, call):
+      key, response = self.lookup_response(model, messages)
+      if response is None:
+          response = await call()
+          if key is not None:
+              self.response_cache.set(key, response)
       return response
 
+  def call_provider(self, call, api_key, model):
+      """
+      Makes a provider call through the shared rate limiter for api_key and
+      model, retrying rate limits and transient errors with jittered backoff.
+      """
+      self.check_budget()
+      limiter = PROVIDER_CLIENTS.limiter(api_key, model, self.requests_per_minute)
+      return call_with_retries(call, limiter, retries=self.max_retries, on_retry=self.count_retry)
+
+  async def acall_provider(self, call, api_key, model):
+      self.check_budget()
+      limiter = PROVIDER_CLIENTS.limiter(api_key, model, self.requests_per_minute)
+      return await acall_with_retries(call, limiter, retries=self.max_retries, on_retry=self.count_retry)
+
+  def check_budget(self):
+      """
+      Raises BudgetExceeded when a budget covering this agent's thread has run out.
+      """
+      if self.budget is not None:
+          self.budget.check(self.thread_id)
+
+  def charge_usage(self, prompt_tokens, completion_tokens):
+      """
+      Charges the tokens of a provider call to the conversation's budgets,
+      priced by the prompt_price and completion_price attributes if the role sets them.
+      """
+      if self.budget is not None:
+          self.budget.charge_tokens(self.thread_id, prompt_tokens, completion_tokens,
+                                    getattr(self, 'prompt_price', None), getattr(self, 'completion_price', None))
+
+  def count_retry(self, error, delay):
+      self.instrumentation.count('provider.retries', role=self.role,
+                                 status=str(getattr(error, 'status_code', type(error).__name__)))
+
+  def stream_response(self, chunks, cache_key=None):
+      """
+      Yields the response_tag content of a stream of raw chunks as it arrives,
+      then stores the parsed response once the stream is complete. The parsed
+      response is the generator's return value and is kept as last_response;
+      the raw response is put in the response cache under cache_key.
+      """
+      stream = ResponseTagStream(self.response_tag)
+      for chunk in chunks:
+          # stop reading a stream whose budget ran out
+          self.check_budget()
+          text = stream.feed(chunk)
+          if text:
+              self.emit_chunk(text)
+              yield text
+      text = stream.close()
+      if text:
+          self.emit_chunk(text)
+          yield text
+      return self.finish_stream(stream.text, cache_key)
+
+  async def astream_response(self, chunks, cache_key=None):
+      stream = ResponseTagStream(self.response_tag)
+      async for chunk in chunks:
+          self.check_budget()
+          text = stream.feed(chunk)
+          if text:
+              self.emit_chunk(text)
+              yield text
+      text = stream.close()
+      if text:
+          self.emit_chunk(text)
+          yield text
+      self.finish_stream(stream.text, cache_key)
+
+  def emit_chunk(self, text):
+      if self.on_chunk is not None:
+          self.on_chunk(self, text)
+
+  def finish_stream(self, content, cache_key=None):
+      if cache_key is not None:
+          self.response_cache.set(cache_key, content)
+      with self.timer('agent.parse_response'):
+          response = self.parse_response(content)
+      self.output_messsage(response)
+      self.last_response = response
+      return response
+
+  def get_messages(self, table, rows=None):
+        """
+        Returns the last rows messages of this agent's thread in table, newest first.
+        """
+        return self.store.last(table, self.thread_id, None if rows is None else int(rows))
+
+  def get_messages_between(self, table, after_id, before_id):
+        """
+        Returns the messages of this agent's thread in table with after_id < message_id < before_id, oldest first.
+        """
+        return self.store.between(table, self.thread_id, after_id, before_id)
+
   def get_inputs(self):
         # handle multiple inputs if passed
         inputs = []
-        connection = sqlite3.connect(self.db_path)
-        for idx, table in enumerate(self.input_table):
-            try:
-                # handle rows if they were specified for each table
-                rows = self.rows if not isinstance(self.rows, list) else self.rows[idx]
-                cursor = connection.cursor()
-                cursor.execute(f"SELECT * FROM {table} WHERE thread_id = ? ORDER BY timestamp DESC LIMIT ?",
-                               (self.thread_id, self.rows))
-                message = cursor.fetchall()[0][3]
-                inputs.append(message)
-            except:
-                print("failed to extract input")
-        connection.close()
+        with self.timer('agent.get_inputs'):
+            for idx, table in enumerate(self.input_table):
+                try:
+                    # handle rows if they were specified for each table
+                    rows = self.rows if not isinstance(self.rows, list) else self.rows[idx]
+                    messages = self.get_messages(table, rows)[::-1]
+                    if self.context_window is None:
+                        inputs.extend(message[CONTENT] for message in messages)
+                    else:
+                        inputs.extend(self.window_inputs(table, messages))
+                except:
+                    print("failed to extract input")
         return inputs
 
+  def window_inputs(self, table, messages):
+        """
+        Fits chronological messages into the context window, summarizing the
+        messages that left the window since the last turn.
+        """
+        key = (table, self.thread_id)
+        window = self.context_window
+        evicted, through = (), 0
+        ids = [message[MESSAGE_ID] for message in messages if message[MESSAGE_ID] is not None]
+        if window.summary_budget and ids and min(ids) - 1 > window.summarized_id(key):
+            through = min(ids) - 1
+            evicted = self.get_messages_between(table, window.summarized_id(key), min(ids))
+        return window.build(key, messages, evicted, through)
+
   def output_messsage(self, message):
       # Store the parsed content in the database
-      connection = sqlite3.connect(self.db_path)
-      cursor = connection.cursor()
-      cursor.execute(f"INSERT INTO {self.output_table} (thread_id, sender, content) VALUES (?, ?, ?)",
-                     (self.thread_id, self.role, message))
-      connection.commit()
-      connection.close()
+      with self.timer('agent.output_message'):
+          self.store.write(self.output_table, self.thread_id, self.role, message)
+      self.messages_sent += 1
+      if self.bus is not None:
+          self.bus.publish(self.output_table, self.thread_id, self.role, message)
 
   def send_message(self, messages=None):
       raise NotImplementedError(f"{self.__class__.__name__} does not implement the send_message method")
 
 
+  def __repr__(self):
+      return f"<{type(self).__name__} role={self.role!r} thread_id={self.thread_id!r}>"
+
   def execute(self):
       return self.send_message()
 
+  async def aexecute(self):
+      """
+      Runs the agent from an event loop. Agents may define `async def execute`,
+      which is awaited directly; a blocking execute runs in a worker thread so
+      it doesn't hold up other agents.
+      """
+      if inspect.iscoroutinefunction(self.execute):
+          return await self.execute()
+      return await asyncio.to_thread(self.execute)
+
+  def execute_stream(self):
+      """
+      Generator over the agent's output. Agents that can't stream yield their
+      whole result once; streaming agents yield chunks as the provider sends them.
+
+      Example Usage:
+          for chunk in agent.execute_stream():
+              print(chunk, end='', flush=True)
+      """
+      result = self.execute()
+      if result is not None:
+          yield result
+
+  async def aexecute_stream(self):
+      """
+      Async iterator version of execute_stream().
+      """
+      result = await self.aexecute()
+      if result is not None:
+          yield result
+
 
 
 class AgentTerminalInterface(AgentInterface):
+    """
+    Runs the <python> and <terminal> sections of a response in the shared
+    sandbox pool and replaces them with their output. Limits can be set per
+    role with the sandbox_timeout (seconds), sandbox_memory_limit (bytes) and
+    sandbox_output_limit (characters) attributes.
+    """
+    __slots__ = ()
 
     def parse_response(self, response):
-        soup = BeautifulSoup(response, 'html.parser')
-
-        # Find and execute Python code sections
-        python_elements = soup.find_all('python')
-        for python_element in python_elements:
-            python_code = python_element.get_text()
-            try:
-                python_output = subprocess.check_output(['python', '-c', python_code], universal_newlines=True)
-                python_element.replace_with(f'<python>{python_output}</python>')
-            except subprocess.CalledProcessError as e:
-                python_element.replace_with(f'<python>Error: {e.stderr}</python>')
-
-        # Find and execute terminal command sections
-        terminal_elements = soup.find_all('terminal')
-        for terminal_element in terminal_elements:
-            terminal_command = terminal_element.get_text()
-            try:
-                terminal_output = subprocess.check_output(terminal_command, shell=True, universal_newlines=True)
-                terminal_element.replace_with(f'<terminal>{terminal_output}</terminal>')
-            except subprocess.CalledProcessError as e:
-                terminal_element.replace_with(f'<terminal>Error: {e.stderr}</terminal>')
-
-        return str(soup)
+        # Split the response into text and sections, then run the sections concurrently
+        parts, blocks = [], []
+        for kind, tag, text in TagParser.parse(response, ('python', 'terminal')):
+            if kind == TEXT:
+                parts.append(text)
+            elif kind == START:
+                section = []
+            elif kind == DATA:
+                section.append(text)
+            elif kind == END:
+                blocks.append((tag, ''.join(section)))
+                parts.append(None)
+        if not blocks:
+            return response
+
+        results = iter(self.run_blocks(blocks))
+        for index, part in enumerate(parts):
+            if part is None:
+                result = next(results)
+                output = result.output if result.status == 'ok' else f'Error: {result.output}'
+                parts[index] = f'<{result.kind}>{output}</{result.kind}>'
+        return ''.join(parts)
+
+    def sandbox_limits(self):
+        limits = {}
+        for name, convert in (('timeout', float), ('memory_limit', int), ('output_limit', int)):
+            value = getattr(self, f'sandbox_{name}', None)
+            if value not in (None, ''):
+                limits[name] = convert(value)
+        return limits
 
+    def run_blocks(self, blocks):
+        """
+        Runs (kind, code) blocks in the sandbox pool and records their execution times.
+        """
+        results = get_sandbox_pool().run_many(blocks, **self.sandbox_limits())
+        if self.instrumentation.enabled:
+            for result in results:
+                self.instrumentation.record('agent.subprocess', result.elapsed, role=self.role,
+                                            kind=result.kind, status=result.status)
+        return results
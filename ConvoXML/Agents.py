@@ -1,36 +1,37 @@
-import sqlite3
-from bs4 import BeautifulSoup
-import uuid
+import asyncio
+import time
 import random
-import google.generativeai as palm
-from openai import OpenAI
-import google.generativeai as palm
-from .AgentInterface import AgentInterface, AgentTerminalInterface, Node
+from .AgentInterface import AgentInterface, AgentTerminalInterface
+from .Providers import PROVIDER_CLIENTS
+from .RequestBatcher import get_request_batcher, openai_batch_submitter
+from .Sandbox import get_sandbox_pool
+from .Streaming import extract_tag
+from .ContextWindow import count_tokens
+
+
+# Provider SDKs are slow to import, so they are only imported by the agents that use them.
+def import_openai():
+    import openai
+    return openai
+
+
+def import_palm():
+    import google.generativeai as palm
+    return palm
 
 
 class TestAgent(AgentInterface):
+  __slots__ = ('test_message',)
+
   def __init__(self, **params):
       super().__init__(**params)
-      # Set predefined attributes and any additional attributes from params
-      for key, value in params.items():
-          setattr(self, key, value)
-      # Set defaults for non-provided attributes
-      self.thread_id = params.get('thread_id', str(uuid.uuid4())[:8])
-      self.input_table = params.get('input_table', 'Messages').split(',')
-      self.output_table = params.get('output_table', 'Messages')
       self.test_message = params.get('test_message', f'This is a test message from Agent {self.role}')
       self.rows = params.get('rows', None)
-      self.connection = params.get('db_connection', sqlite3.connect(':memory:'))
 
 
   def send_message(self, message=None):
       message = message or self.test_message
-      connection = sqlite3.connect(self.db_path)
-      cursor = connection.cursor()
-      cursor.execute(f"INSERT INTO {self.output_table} (thread_id, sender, content) VALUES (?, ?, ?)",
-                     (self.thread_id, self.role, message))
-      connection.commit()
-      connection.close()
+      self.output_messsage(message)
       return message
 
   def execute(self, message=None):
@@ -41,6 +42,8 @@ class TestAgent(AgentInterface):
 
 # Moderator class
 class TestModerator(TestAgent):
+  __slots__ = ()
+
   def execute(self):
       if 'turns' not in self.context.keys():
           self.context.turns = {}
@@ -55,7 +58,8 @@ class TestModerator(TestAgent):
           if self.context.turns[self.thread_id] > 5:
               self.send_message(f"Moderator {self.name} has reached maximum number of turns.")
               self.context.exit = True
-          return next_agent.name
+          # the scheduler dispatches on the role name
+          return next_agent.role
       else:
           self.send_message(f"Moderator {self.name} has no participants to choose.")
 
@@ -66,32 +70,202 @@ class OpenAIAgent(AgentInterface):
     def __init__(self, model=None, context=None, **params):        
        
         self.context = context
+        self.model = model or 'gpt-3.5-turbo'
+        if context is not None:
+            params['context'] = context
         super().__init__(**params)
       
     def setup(self):
         # Check if the API key is available in the context
         if hasattr(self.context, 'openai_key') and self.context.openai_key:
-            self.client = OpenAI(api_key=self.context.openai_token)
+            # base_url points the agent at any OpenAI compatible server
+            self.base_url = getattr(self, 'base_url', None) or self.context.openai_base_url
+            # agents with the same key and server share a client and its connections
+            self.client = PROVIDER_CLIENTS.openai(self.context.openai_key, self.base_url)
+            self.batcher = self.setup_batcher()
         else:
             raise ValueError("API key not provided in the context. Please set context.openai_key with your API key.")
 
-        
+    def setup_batcher(self):
+        """
+        Returns the RequestBatcher shared by roles that set batch_endpoint, the
+        path of a batch endpoint on the server, or None to send requests one by one.
+        """
+        endpoint = getattr(self, 'batch_endpoint', None)
+        if not endpoint:
+            return None
+        # the batcher outlives this agent, so it only holds the client; every
+        # request goes through its agent's call_provider before it is submitted
+        key, client = self.context.openai_key, self.client
+        return get_request_batcher((key, self.base_url, endpoint), lambda: openai_batch_submitter(client, endpoint),
+                                   window=float(getattr(self, 'batch_window', 0.005)),
+                                   max_batch=int(getattr(self, 'batch_max_size', 32)))
+
+    @property
+    def async_client(self):
+        # async clients belong to the running event loop, so they are looked up on use
+        client = self.__dict__.get('_async_client')
+        return client if client is not None else PROVIDER_CLIENTS.async_openai(self.context.openai_key, self.base_url)
+
+    @async_client.setter
+    def async_client(self, client):
+        self._async_client = client
+
+    def format_messages(self, messages):
+        system_prompt = [{'role': 'system', 'content': self.prompt}]
+        return system_prompt + [{'role': 'user', 'content': msg} for msg in messages]
         
     def send_message(self, messages=None):
         messages = messages or self.get_inputs()
-        system_prompt = [{'role': 'system', 'content': self.prompt}]
-        messages = system_prompt + [{'role': 'user', 'content': msg} for msg in messages]
-        openai_response = self.client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=messages
-        )
+        messages = self.format_messages(messages)
+        content = self.cached_call(self.model, messages, lambda: self.complete(messages))
     
-        response = self.parse_response(openai_response.choices[0].message.content)
+        with self.timer('agent.parse_response'):
+            response = self.parse_response(content)
         self.output_messsage(response)
   
   
         return response
 
+    async def asend_message(self, messages=None):
+        messages = messages or self.get_inputs()
+        messages = self.format_messages(messages)
+        content = await self.acached_call(self.model, messages, lambda: self.acomplete(messages))
+
+        with self.timer('agent.parse_response'):
+            response = self.parse_response(content)
+        self.output_messsage(response)
+        return response
+
+    def complete(self, messages):
+        with self.timer('provider.call', provider='openai', model=self.model):
+            if self.batcher is not None:
+                request = {'model': self.model, 'messages': messages}
+                openai_response = self.call_provider(lambda: self.batcher.submit(request),
+                                                     self.context.openai_key, self.model)
+            else:
+                openai_response = self.call_provider(lambda: self.client.chat.completions.create(
+                    model=self.model,
+                    messages=messages
+                ), self.context.openai_key, self.model)
+        self.record_usage(openai_response)
+        return openai_response.choices[0].message.content
+
+    async def acomplete(self, messages):
+        with self.timer('provider.call', provider='openai', model=self.model):
+            if self.batcher is not None:
+                request = {'model': self.model, 'messages': messages}
+                openai_response = await self.acall_provider(
+                    lambda: asyncio.wrap_future(self.batcher.submit_future(request)), self.context.openai_key, self.model)
+            else:
+                openai_response = await self.acall_provider(lambda: self.async_client.chat.completions.create(
+                    model=self.model,
+                    messages=messages
+                ), self.context.openai_key, self.model)
+        self.record_usage(openai_response)
+        return openai_response.choices[0].message.content
+
+    def stream_message(self, messages=None):
+        """
+        Streams the reply: yields the response_tag content chunk by chunk as the
+        provider generates it and stores the parsed message once it is complete.
+        """
+        messages = messages or self.get_inputs()
+        messages = self.format_messages(messages)
+        key, content = self.lookup_response(self.model, messages)
+        if content is not None:
+            return (yield from self.stream_response([content]))
+        return (yield from self.stream_response(self.complete_stream(messages), cache_key=key))
+
+    async def astream_message(self, messages=None):
+        messages = messages or self.get_inputs()
+        messages = self.format_messages(messages)
+        key, content = self.lookup_response(self.model, messages)
+        if content is not None:
+            async def cached():
+                yield content
+            chunks, key = cached(), None
+        else:
+            chunks = self.acomplete_stream(messages)
+        async for text in self.astream_response(chunks, cache_key=key):
+            yield text
+
+    def complete_stream(self, messages):
+        started = time.perf_counter()
+        with self.timer('provider.call', provider='openai', model=self.model, stream='true'):
+            stream = self.call_provider(lambda: self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                stream=True,
+                stream_options={'include_usage': True}
+            ), self.context.openai_key, self.model)
+            for chunk in stream:
+                content = self.read_chunk(chunk, started)
+                started = None if content else started
+                if content:
+                    yield content
+
+    async def acomplete_stream(self, messages):
+        started = time.perf_counter()
+        with self.timer('provider.call', provider='openai', model=self.model, stream='true'):
+            stream = await self.acall_provider(lambda: self.async_client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                stream=True,
+                stream_options={'include_usage': True}
+            ), self.context.openai_key, self.model)
+            async for chunk in stream:
+                content = self.read_chunk(chunk, started)
+                started = None if content else started
+                if content:
+                    yield content
+
+    def read_chunk(self, chunk, started=None):
+        """
+        Returns the text delta of a streamed chunk, recording usage from the
+        final chunk and the time to first token when started is given.
+        """
+        if getattr(chunk, 'usage', None) is not None:
+            self.record_usage(chunk)
+        if not chunk.choices:
+            return None
+        content = chunk.choices[0].delta.content
+        if content and started is not None and self.instrumentation.enabled:
+            self.instrumentation.record('provider.first_token', time.perf_counter() - started,
+                                        role=self.role, provider='openai', model=self.model)
+        return content
+
+    def record_usage(self, openai_response):
+        usage = getattr(openai_response, 'usage', None)
+        if usage is None:
+            return
+        self.charge_usage(usage.prompt_tokens or 0, usage.completion_tokens or 0)
+        if not self.instrumentation.enabled:
+            return
+        labels = {'role': self.role, 'provider': 'openai', 'model': self.model}
+        self.instrumentation.count('provider.prompt_tokens', usage.prompt_tokens or 0, **labels)
+        self.instrumentation.count('provider.completion_tokens', usage.completion_tokens or 0, **labels)
+
+    def execute(self):
+        if self.stream:
+            for _ in self.stream_message():
+                pass
+            return self.last_response
+        return self.send_message()
+
+    async def aexecute(self):
+        if self.stream:
+            async for _ in self.astream_message():
+                pass
+            return self.last_response
+        return await self.asend_message()
+
+    def execute_stream(self):
+        return self.stream_message()
+
+    def aexecute_stream(self):
+        return self.astream_message()
+
 class OpenAIDeveloper(OpenAIAgent, AgentTerminalInterface):
   def parse_response(self, response):
     return AgentTerminalInterface.parse_response(self, response)
@@ -101,7 +275,7 @@ class PalmAgent(AgentInterface):
   
     def setup(self):
         if hasattr(self.context, 'palm_key') and self.context.palm_key:
-            palm.configure(api_key=self.context.palm_key)
+            import_palm().configure(api_key=self.context.palm_key)
         else:
             raise ValueError("API key not provided in the context. Please set context.openai_key with your API key.")
                 
@@ -118,9 +292,20 @@ class PalmAgent(AgentInterface):
     def send_message(self, messages=None):
         messages = messages or self.get_inputs()
         messages = self.format_messages(messages)
-        response = palm.chat(messages=messages)
-        response = self.parse_response(response.messages[-1]['content'])
-        return response.messages[-1]['content']
+        content = self.cached_call('palm', messages, lambda: self.complete(messages))
+        with self.timer('agent.parse_response'):
+            response = self.parse_response(content)
+        self.output_messsage(response)
+        return response
+
+
+    def complete(self, messages):
+        with self.timer('provider.call', provider='palm'):
+            response = self.call_provider(lambda: import_palm().chat(messages=messages), self.context.palm_key, 'palm')
+        content = response.messages[-1]['content']
+        # PaLM doesn't report usage, so budgets are charged with counted tokens
+        self.charge_usage(sum(count_tokens(str(message['content'])) for message in messages), count_tokens(content or ''))
+        return content
 
 
 class PalmDeveloper(PalmAgent, AgentTerminalInterface):
@@ -130,7 +315,7 @@ class PalmDeveloper(PalmAgent, AgentTerminalInterface):
 
 class SubprocessAgent(AgentInterface):
   def __init__(self, context=None, **params):
-      self.client = OpenAI()
+      self.client = PROVIDER_CLIENTS.openai()
       self.context = context
       super().__init__(**params)
 
@@ -177,32 +362,20 @@ class SubprocessAgent(AgentInterface):
       return None
 
   def execute_python_code(self, code):
-      try:
-          result = subprocess.check_output(['python', '-c', code], stderr=subprocess.STDOUT, text=True)
-          return result
-      except subprocess.CalledProcessError as e:
-          return f"Python Error: {e.output}"
+      result = get_sandbox_pool().run('python', code)
+      return result.output if result.status == 'ok' else f"Python Error: {result.output}"
 
   def extract_command_from_xml(self, xml_content):
-      try:
-          root = ET.fromstring(xml_content)
-          if root.tag == "commandline":
-              return root.text.strip()
-          else:
-              return None
-      except ET.ParseError:
-          return None
+      command = extract_tag(xml_content, 'commandline')
+      return command.strip() if command is not None else None
 
   def execute_terminal_command(self, command):
-      try:
-          result = subprocess.check_output(command, shell=True, stderr=subprocess.STDOUT, text=True)
-          return result
-      except subprocess.CalledProcessError as e:
-          return f"Command Error: {e.output}"
+      result = get_sandbox_pool().run('terminal', command)
+      return result.output if result.status == 'ok' else f"Command Error: {result.output}"
 
   def insert_responses_into_db(self, responses):
-      cursor = self.connection.cursor()
-      for response in responses:
-          cursor.execute(f"INSERT INTO {self.output_table} (thread_id, sender_id, content) VALUES (?, ?, ?)",
-                         (self.thread_id, self.role, response))
-          self.connection.commit()
+      self.store.write_many(self.output_table, self.thread_id, self.role, responses)
+      self.messages_sent += len(responses)
+      if self.bus is not None:
+          for response in responses:
+              self.bus.publish(self.output_table, self.thread_id, self.role, response)
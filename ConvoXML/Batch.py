@@ -0,0 +1,222 @@
+import pickle
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from .Sharding import assign_shard_thread_ids, shard_paths
+
+
+class BatchStats:
+    """
+    Aggregate progress of a batch run. A snapshot is passed to the progress
+    callback and the final one is returned by BatchRunner.run.
+    """
+
+    def __init__(self, total=0):
+        self.total = total
+        self.completed = 0
+        self.failed = 0
+        self.steps = 0
+        # usage reported by the conversations' budget governors
+        self.tokens = 0
+        self.spend = 0.0
+        self.budget_stops = 0
+        self.started = time.monotonic()
+        self.finished = None
+        self.errors = []
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def conversations_per_second(self):
+        return self.completed / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def steps_per_second(self):
+        return self.steps / self.elapsed if self.elapsed else 0.0
+
+    def as_dict(self):
+        return {
+            'total': self.total,
+            'completed': self.completed,
+            'failed': self.failed,
+            'steps': self.steps,
+            'tokens': self.tokens,
+            'spend': self.spend,
+            'budget_stops': self.budget_stops,
+            'elapsed': self.elapsed,
+            'conversations_per_second': self.conversations_per_second,
+            'steps_per_second': self.steps_per_second,
+        }
+
+    def __repr__(self):
+        return (f"BatchStats({self.completed}/{self.total} completed, {self.failed} failed, "
+                f"{self.conversations_per_second:.1f} conversations/s, {self.steps_per_second:.1f} steps/s)")
+
+
+def run_conversation(parser, shard=None, shards=None):
+    """
+    Runs one fork of parser to completion and returns its thread ids, the
+    number of agent executions and its usage. With shards, the fork's thread
+    ids are chosen to hash to shard.
+    """
+    conversation = parser.fork()
+    if shards:
+        assign_shard_thread_ids(conversation, shard, shards)
+    usage = conversation.run()
+    return [agent.thread_id for agent in conversation.agents], conversation.steps, usage
+
+
+# parser options holding objects of this process, which each worker builds again for itself
+PROCESS_LOCAL_OPTIONS = ('connections', 'bus', 'instrumentation')
+
+
+def _worker_options(options, mode):
+    """
+    The parser options sent to worker processes. Options of this process are
+    left out, and any other option that can't be pickled raises ValueError.
+    """
+    forwarded = {}
+    for key, value in options.items():
+        if key in PROCESS_LOCAL_OPTIONS:
+            continue
+        try:
+            pickle.dumps(value)
+        except Exception as e:
+            raise ValueError(f"BatchRunner mode={mode!r} can't send the {key!r} option to its worker processes, "
+                             f"use mode='thread' or pass a picklable value: {e}") from None
+        forwarded[key] = value
+    return forwarded
+
+
+# parser owned by a process pool worker, built once by _init_worker
+_worker_parser = None
+# (shard, shards) of a sharded worker
+_worker_shard = (None, None)
+
+
+def _init_worker(xml_string, db_path, agent_classes, options, shard=None, shards=None):
+    global _worker_parser, _worker_shard
+    from .ConvoXML import ConvoXMLParser
+    _worker_parser = ConvoXMLParser(xml_string, db_path=db_path, agent_classes=agent_classes, **options)
+    _worker_shard = (shard, shards)
+
+
+def _run_worker_conversation(_):
+    result = run_conversation(_worker_parser, *_worker_shard)
+    # buffered messages must reach the shared database before the result is reported
+    _worker_parser.store.flush()
+    return result
+
+
+class _ShardExecutors:
+    """
+    One single-process pool per shard, handing out work round-robin. Each
+    shard database has exactly one writer, so shards never wait on each
+    other's locks.
+    """
+
+    def __init__(self, executors):
+        self.executors = executors
+        self._next = 0
+
+    def submit(self, fn, *args):
+        executor = self.executors[self._next % len(self.executors)]
+        self._next += 1
+        return executor.submit(fn, *args)
+
+    def shutdown(self, wait=True):
+        for executor in self.executors:
+            executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+
+class BatchRunner:
+    """
+    Runs many conversations from one parsed ConvoXML definition.
+
+    Each conversation is a fork of the parser with its own agents, thread ids
+    and Context, and every conversation writes to the parser's database. With
+    mode='thread' the forks run on a thread pool inside this process and share
+    the parser's connections, writer and cache. With mode='process' every
+    worker process parses the definition once and then runs its share of the
+    conversations. mode='sharded' runs one process per shard, each writing to
+    its own database (see shard_paths) with thread ids that hash to it;
+    ShardedChatMessages reads across the shards afterwards.
+
+    Example Usage:
+        parser = ConvoXML(xml_string, buffered_writes=True)
+        stats = BatchRunner(parser, conversations=10000, workers=8,
+                            progress=print).run()
+    """
+
+    def __init__(self, parser, conversations, workers=4, mode='thread', progress=None, progress_interval=1.0):
+        if mode not in ('thread', 'process', 'sharded'):
+            raise ValueError(f"Unknown batch mode {mode!r}, expected 'thread', 'process' or 'sharded'")
+        self.parser = parser
+        self.conversations = conversations
+        self.workers = workers
+        self.mode = mode
+        self.progress = progress
+        self.progress_interval = progress_interval
+        self.thread_ids = []
+        self.stats = BatchStats(conversations)
+        self._last_report = 0.0
+        self._lock = threading.Lock()
+
+    def executor(self):
+        if self.mode == 'thread':
+            return ThreadPoolExecutor(max_workers=self.workers)
+        # connections, writers, caches and buses belong to this process and are rebuilt by each worker
+        options = _worker_options(self.parser.options, self.mode)
+        if self.mode == 'sharded':
+            paths = shard_paths(self.parser.db_path, self.workers)
+            return _ShardExecutors([
+                ProcessPoolExecutor(max_workers=1, initializer=_init_worker,
+                                    initargs=(self.parser.xml_string, path, self.parser.agent_classes,
+                                              options, shard, self.workers))
+                for shard, path in enumerate(paths)])
+        return ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                   initargs=(self.parser.xml_string, self.parser.db_path,
+                                             self.parser.agent_classes, options))
+
+    def submit(self, executor):
+        if self.mode == 'thread':
+            return [executor.submit(run_conversation, self.parser) for _ in range(self.conversations)]
+        return [executor.submit(_run_worker_conversation, idx) for idx in range(self.conversations)]
+
+    def run(self):
+        self.stats = BatchStats(self.conversations)
+        with self.executor() as executor:
+            for future in as_completed(self.submit(executor)):
+                self.record(future)
+        self.parser.store.flush()
+        self.stats.finished = time.monotonic()
+        if self.progress:
+            self.progress(self.stats)
+        return self.stats
+
+    def record(self, future):
+        with self._lock:
+            try:
+                thread_ids, steps, usage = future.result()
+            except Exception as e:
+                self.stats.failed += 1
+                self.stats.errors.append(e)
+            else:
+                self.stats.completed += 1
+                self.stats.steps += steps
+                self.stats.tokens += usage['tokens']
+                self.stats.spend += usage['spend']
+                self.stats.budget_stops += len(usage['stopped'])
+                self.thread_ids.append(thread_ids)
+            now = time.monotonic()
+            if self.progress and now - self._last_report >= self.progress_interval:
+                self._last_report = now
+                self.progress(self.stats)
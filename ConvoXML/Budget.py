@@ -0,0 +1,255 @@
+import asyncio
+import threading
+import time
+from .Instrumentation import NULL_INSTRUMENTATION
+
+
+class BudgetExceeded(Exception):
+    """
+    Raised in an agent's turn once a budget covering its thread has run out.
+    thread_id is None when the budget of the whole run ran out.
+    """
+
+    def __init__(self, scope, limit, used, maximum, thread_id=None):
+        self.scope = scope
+        self.limit = limit
+        self.used = used
+        self.maximum = maximum
+        self.thread_id = thread_id
+        where = f"thread {thread_id}" if thread_id is not None else 'run'
+        super().__init__(f"{where} exceeded its {limit} budget: {used:g} of {maximum:g}")
+
+    def copy(self):
+        # raised anew every time, so tracebacks don't pile up on one instance
+        return BudgetExceeded(self.scope, self.limit, self.used, self.maximum, self.thread_id)
+
+    def as_dict(self):
+        return {'scope': self.scope, 'thread_id': self.thread_id, 'limit': self.limit,
+                'used': self.used, 'maximum': self.maximum}
+
+
+class Usage:
+    """
+    What a run or one of its threads has used so far.
+    """
+
+    __slots__ = ('turns', 'prompt_tokens', 'completion_tokens', 'spend', 'started')
+
+    def __init__(self):
+        self.turns = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.spend = 0.0
+        self.started = time.monotonic()
+
+    @property
+    def tokens(self):
+        return self.prompt_tokens + self.completion_tokens
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def used(self, limit):
+        return {'turns': self.turns, 'tokens': self.tokens, 'seconds': self.elapsed, 'spend': self.spend}[limit]
+
+    @classmethod
+    def from_dict(cls, state):
+        """
+        Usage saved by as_dict(), its clock set back by the elapsed time.
+        """
+        usage = cls()
+        usage.turns = state['turns']
+        usage.prompt_tokens = state['prompt_tokens']
+        usage.completion_tokens = state['completion_tokens']
+        usage.spend = state['spend']
+        usage.started -= state['elapsed']
+        return usage
+
+    def as_dict(self):
+        return {
+            'turns': self.turns,
+            'prompt_tokens': self.prompt_tokens,
+            'completion_tokens': self.completion_tokens,
+            'tokens': self.tokens,
+            'spend': self.spend,
+            'elapsed': self.elapsed,
+        }
+
+
+class BudgetGovernor:
+    """
+    Enforces the turn, token, wall time and spend budgets of a conversation.
+
+    The <Budget> with scope="run" limits the whole run, the one with
+    scope="thread" limits each thread of the ConvoLoop on its own. The
+    scheduler charges a turn for every agent execution and agents charge the
+    tokens their provider reports, priced per 1000 tokens by the budget or
+    by the prompt_price and completion_price attributes of the role. Once a
+    budget runs out, the next check() for a thread it covers raises
+    BudgetExceeded: the scheduler stops that thread, or the whole run, and
+    leaves the other threads running. Cancellation is cooperative. Provider
+    calls check before they start and streams after every chunk, and async
+    turns are tracked by guard(), which cancels them as soon as their budget
+    runs out, including when their wall time is up. Usage is always
+    recorded, with or without budgets, and as_dict() reports it.
+
+    Example Usage:
+        <InteractionModel>
+          <Budget max_seconds="600" max_spend="5" prompt_price="0.5" completion_price="1.5"/>
+          <Budget scope="thread" max_turns="12" max_tokens="20000"/>
+          ...
+    """
+
+    LIMITS = (('turns', 'max_turns'), ('tokens', 'max_tokens'), ('seconds', 'max_seconds'), ('spend', 'max_spend'))
+
+    def __init__(self, run_budget=None, thread_budget=None, instrumentation=None):
+        self.run_budget = run_budget
+        self.thread_budget = thread_budget
+        self.instrumentation = instrumentation or NULL_INSTRUMENTATION
+        priced = run_budget or thread_budget
+        self.prompt_price = priced.prompt_price if priced else 0.0
+        self.completion_price = priced.completion_price if priced else 0.0
+        self._lock = threading.Lock()
+        self._tasks = {}
+        self.start()
+
+    @classmethod
+    def from_plan(cls, plan, instrumentation=None):
+        return cls(plan.budget('run'), plan.budget('thread'), instrumentation)
+
+    def start(self):
+        """
+        Resets the usage, and the clocks of the wall time budgets.
+        """
+        with self._lock:
+            self.usage = Usage()
+            self.threads = {}
+            # BudgetExceeded by thread_id, None for the run
+            self.exceeded = {}
+
+    def _thread_usage(self, thread_id):
+        usage = self.threads.get(thread_id)
+        if usage is None:
+            usage = self.threads[thread_id] = Usage()
+        return usage
+
+    def charge_turn(self, thread_id):
+        with self._lock:
+            self.usage.turns += 1
+            self._thread_usage(thread_id).turns += 1
+            self._evaluate(thread_id)
+
+    def charge_tokens(self, thread_id, prompt_tokens, completion_tokens, prompt_price=None, completion_price=None):
+        """
+        Charges tokens used by a provider call, priced per 1000 tokens.
+        """
+        prompt_price = self.prompt_price if prompt_price in (None, '') else float(prompt_price)
+        completion_price = self.completion_price if completion_price in (None, '') else float(completion_price)
+        spend = (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+        with self._lock:
+            for usage in (self.usage, self._thread_usage(thread_id)):
+                usage.prompt_tokens += prompt_tokens
+                usage.completion_tokens += completion_tokens
+                usage.spend += spend
+            self._evaluate(thread_id)
+
+    def _evaluate(self, thread_id):
+        """
+        Records the budgets that ran out, called with the lock held.
+        """
+        for scope, budget, key in (('run', self.run_budget, None), ('thread', self.thread_budget, thread_id)):
+            if budget is None or key in self.exceeded or (scope == 'thread' and key is None):
+                continue
+            # a thread's clock starts the first time it is looked at
+            usage = self.usage if key is None else self._thread_usage(key)
+            for limit, field in self.LIMITS:
+                maximum = getattr(budget, field)
+                if maximum is not None and usage.used(limit) >= maximum:
+                    self.exceeded[key] = BudgetExceeded(scope, limit, usage.used(limit), maximum, key)
+                    self.instrumentation.count('budget.exceeded', scope=scope, limit=limit)
+                    self._cancel(key)
+                    break
+
+    def stopped(self, thread_id=None):
+        """
+        The BudgetExceeded that stopped the run, or thread_id, or None.
+        """
+        if self.run_budget is None and self.thread_budget is None:
+            return None
+        with self._lock:
+            self._evaluate(thread_id)
+            return self.exceeded.get(None) or (self.exceeded.get(thread_id) if thread_id is not None else None)
+
+    def check(self, thread_id):
+        """
+        Raises BudgetExceeded if a budget covering thread_id has run out.
+        """
+        exceeded = self.stopped(thread_id)
+        if exceeded is not None:
+            raise exceeded.copy()
+
+    def remaining_seconds(self, thread_id):
+        """
+        Seconds left before a wall time budget of thread_id runs out, or None.
+        """
+        remaining = []
+        with self._lock:
+            if self.run_budget is not None and self.run_budget.max_seconds is not None:
+                remaining.append(self.run_budget.max_seconds - self.usage.elapsed)
+            if self.thread_budget is not None and self.thread_budget.max_seconds is not None:
+                remaining.append(self.thread_budget.max_seconds - self._thread_usage(thread_id).elapsed)
+        return max(min(remaining), 0.0) if remaining else None
+
+    def _cancel(self, key):
+        """
+        Cancels the tracked tasks of thread key, or all of them for the run,
+        except the task that is charging. Called with the lock held.
+        """
+        try:
+            current = asyncio.current_task()
+        except RuntimeError:
+            current = None
+        tasks = self._tasks.get(key, ()) if key is not None else [
+            entry for entries in self._tasks.values() for entry in entries]
+        for loop, task in list(tasks):
+            if task is not current:
+                loop.call_soon_threadsafe(task.cancel)
+
+    async def guard(self, thread_id, awaitable):
+        """
+        Awaits a turn of thread_id as a task that is cancelled once a budget
+        covering the thread runs out, and raises BudgetExceeded instead.
+        """
+        self.check(thread_id)
+        task = asyncio.ensure_future(awaitable)
+        entry = (asyncio.get_running_loop(), task)
+        with self._lock:
+            self._tasks.setdefault(thread_id, set()).add(entry)
+        try:
+            return await asyncio.wait_for(task, self.remaining_seconds(thread_id))
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            exceeded = self.stopped(thread_id)
+            if exceeded is None:
+                raise
+            raise exceeded.copy() from None
+        finally:
+            with self._lock:
+                self._tasks[thread_id].discard(entry)
+
+    def restore(self, state):
+        """
+        Continues from usage reported by as_dict(), e.g. from a checkpoint.
+        Budgets that had run out are found again by the next check.
+        """
+        with self._lock:
+            self.usage = Usage.from_dict(state)
+            self.threads = {thread_id: Usage.from_dict(usage) for thread_id, usage in state['threads'].items()}
+            self.exceeded = {}
+
+    def as_dict(self):
+        with self._lock:
+            report = self.usage.as_dict()
+            report['threads'] = {thread_id: usage.as_dict() for thread_id, usage in self.threads.items()}
+            report['stopped'] = [exceeded.as_dict() for exceeded in self.exceeded.values()]
+        return report
@@ -0,0 +1,219 @@
+import json
+import os
+import socket
+import threading
+from collections import namedtuple
+
+# A message announced on the bus. content is None for publishers that only announce a write.
+BusMessage = namedtuple('BusMessage', ['table', 'thread_id', 'sender', 'content'])
+
+
+class MessageBus:
+    """
+    In-process publish/subscribe for new messages.
+
+    Writers publish every message they store, and subscribers register a
+    callback for a (table, thread_id) pair, so a runner learns which agents
+    have new input without querying the database. Callbacks run on the
+    publishing thread and should only record the message.
+
+    Example Usage:
+        bus = MessageBus()
+        token = bus.subscribe('Messages', 't1', print)
+        bus.publish('Messages', 't1', 'Critic', 'Looks good.')
+        bus.unsubscribe(token)
+    """
+
+    def __init__(self):
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, table, thread_id, callback):
+        """
+        Calls callback(message) for every message published to table on
+        thread_id, and returns a token for unsubscribe().
+        """
+        key = (table, thread_id)
+        with self._lock:
+            # copy on write, so publish() can read the lists without the lock
+            self._subscribers[key] = self._subscribers.get(key, ()) + (callback,)
+        return key, callback
+
+    def unsubscribe(self, token):
+        key, callback = token
+        with self._lock:
+            callbacks = tuple(subscriber for subscriber in self._subscribers.get(key, ()) if subscriber is not callback)
+            if callbacks:
+                self._subscribers[key] = callbacks
+            else:
+                self._subscribers.pop(key, None)
+
+    def publish(self, table, thread_id, sender, content=None):
+        self.deliver(BusMessage(table, thread_id, sender, content))
+
+    def deliver(self, message):
+        """
+        Hands message to the local subscribers of its table and thread.
+        """
+        for callback in self._subscribers.get((message.table, message.thread_id), ()):
+            callback(message)
+
+    def close(self):
+        with self._lock:
+            self._subscribers = {}
+
+
+class SocketBus(MessageBus):
+    """
+    MessageBus shared by the processes on one machine over a local socket.
+
+    The first bus to open `path` listens on it and relays messages between
+    the buses that connect to it later. Every message published in one
+    process is delivered to the subscribers of all of them. Messages travel
+    as JSON lines. A message from another process first drops its thread
+    from the MessageCaches in `caches`, which never saw that write, so a
+    subscriber it wakes reads the message from the database. A socket file left behind by a process that died is
+    replaced. Unix domain sockets are needed, so this bus isn't available
+    on every platform.
+
+    Example Usage:
+        parser = ConvoXML(xml_string, bus_path='/tmp/convoxml.sock')
+    """
+
+    def __init__(self, path, caches=()):
+        super().__init__()
+        if not hasattr(socket, 'AF_UNIX'):
+            raise ValueError("SocketBus needs Unix domain sockets, which this platform doesn't have")
+        self.path = path
+        self.caches = list(caches)
+        self._peers = []
+        self._peers_lock = threading.Lock()
+        self._closed = False
+        self.hub = self._listen()
+        if self.hub:
+            self._start(self._accept)
+        else:
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            connection.connect(path)
+            # the hub greets a bus once it relays to it, so nothing published afterwards is missed
+            if connection.recv(1) != b'\n':
+                connection.close()
+                raise OSError(f"No message bus is listening on {path}")
+            self._add_peer(connection)
+
+    def _listen(self):
+        """
+        Listens on path and returns True, or returns False when another bus already does.
+        """
+        for _ in range(2):
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                server.bind(self.path)
+            except OSError:
+                server.close()
+                if self._is_served():
+                    return False
+                # a stale socket file of a bus that is gone
+                try:
+                    os.unlink(self.path)
+                except FileNotFoundError:
+                    pass
+                continue
+            server.listen()
+            self._server = server
+            return True
+        raise OSError(f"Could not listen on {self.path}")
+
+    def _is_served(self):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.path)
+            return True
+        except OSError:
+            return False
+        finally:
+            probe.close()
+
+    def _start(self, target, *args):
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        thread.start()
+
+    def _accept(self):
+        while not self._closed:
+            try:
+                connection, _ = self._server.accept()
+            except OSError:
+                return
+            self._add_peer(connection)
+
+    def _add_peer(self, connection):
+        peer = (connection, threading.Lock())
+        # holding the peer's lock keeps relayed messages behind the greeting
+        with peer[1]:
+            with self._peers_lock:
+                self._peers.append(peer)
+            if self.hub:
+                try:
+                    connection.sendall(b'\n')
+                except OSError:
+                    pass
+        self._start(self._read, peer)
+
+    def _read(self, peer):
+        connection, _ = peer
+        try:
+            with connection.makefile('rb') as lines:
+                for line in lines:
+                    message = BusMessage(*json.loads(line))
+                    if self.hub:
+                        self._send(message, skip=peer)
+                    for cache in self.caches:
+                        cache.invalidate(message.table, message.thread_id)
+                    self.deliver(message)
+        except (OSError, ValueError):
+            pass
+        finally:
+            with self._peers_lock:
+                if peer in self._peers:
+                    self._peers.remove(peer)
+            connection.close()
+
+    def _send(self, message, skip=None):
+        line = (json.dumps(list(message)) + '\n').encode('utf-8')
+        with self._peers_lock:
+            peers = [peer for peer in self._peers if peer is not skip]
+        for connection, lock in peers:
+            try:
+                with lock:
+                    connection.sendall(line)
+            except OSError:
+                # the reader of a closed peer removes it
+                pass
+
+    def publish(self, table, thread_id, sender, content=None):
+        message = BusMessage(table, thread_id, sender, content)
+        self._send(message)
+        self.deliver(message)
+
+    def close(self):
+        self._closed = True
+        with self._peers_lock:
+            peers, self._peers = self._peers, []
+        for connection, _ in peers:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            connection.close()
+        if self.hub:
+            try:
+                # wakes the thread blocked in accept()
+                self._server.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._server.close()
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+        super().close()
@@ -0,0 +1,137 @@
+import threading
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+
+# rough per-row bookkeeping cost on top of the stored strings
+ROW_OVERHEAD = 120
+
+
+def row_size(row):
+    return ROW_OVERHEAD + sum(len(value) for value in row if isinstance(value, str))
+
+
+def utc_timestamp():
+    # same format SQLite uses for CURRENT_TIMESTAMP
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+class _Entry:
+    __slots__ = ('rows', 'complete', 'size')
+
+    def __init__(self, rows, complete, size):
+        self.rows = rows
+        self.complete = complete
+        self.size = size
+
+
+class MessageCache:
+    """
+    Write-through cache of the most recent messages of each (table, thread_id).
+
+    Each thread keeps a ring buffer of its last `rows_per_thread` rows, newest
+    last, in the column order of Schema.MESSAGE_COLUMNS. A thread is loaded
+    from SQLite the first time it is read and afterwards kept current by the
+    writers, so repeated reads of a hot thread are a dict lookup. Cold threads
+    are evicted least recently used first once there are more than
+    `max_threads` of them or the cached rows exceed `max_bytes`.
+
+    Only writes made through this cache are seen, so it should not be used
+    when other processes write to the same threads, unless they announce
+    their writes on a SocketBus that invalidates it.
+    """
+
+    def __init__(self, rows_per_thread=50, max_threads=1024, max_bytes=64 * 1024 * 1024):
+        self.rows_per_thread = rows_per_thread
+        self.max_threads = max_threads
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def append(self, table, row):
+        """
+        Adds a freshly written row. Threads that are not cached are skipped,
+        they are loaded from the database the next time they are read.
+        Writers append after their commit, so a row that a load in between
+        already read is skipped, and rows committed by concurrent writers are
+        kept in message_id order whatever order they arrive in.
+        """
+        key = (table, row[1])
+        with self.lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            rows = entry.rows
+            position = len(rows)
+            while position and rows[position - 1][0] >= row[0]:
+                if rows[position - 1][0] == row[0]:
+                    return
+                position -= 1
+            if len(rows) == rows.maxlen:
+                entry.complete = False
+                if position == 0:
+                    # older than the whole window
+                    return
+                dropped = row_size(rows.popleft())
+                entry.size -= dropped
+                self.size -= dropped
+                position -= 1
+            rows.insert(position, row)
+            entry.size += row_size(row)
+            self.size += row_size(row)
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def get(self, table, thread_id, n, loader):
+        """
+        Returns the last n rows of the thread, newest first, like
+        `ORDER BY message_id DESC LIMIT n`, or all of them when n is None. On a
+        miss loader(limit) is called to fetch the newest `limit` rows from the
+        database, newest first, with None meaning no limit.
+        """
+        key = (table, thread_id)
+        with self.lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry.complete or (n is not None and n <= len(entry.rows))):
+                self.hits += 1
+                self._entries.move_to_end(key)
+                rows = list(reversed(entry.rows))
+                return rows if n is None else rows[:n]
+
+            self.misses += 1
+            limit = None if n is None else max(n, self.rows_per_thread)
+            rows = list(loader(limit))
+            self._load(key, rows, complete=limit is None or len(rows) < limit)
+            return rows if n is None else rows[:n]
+
+    def _load(self, key, rows, complete):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.size
+        buffer = deque(reversed(rows[:self.rows_per_thread]), maxlen=self.rows_per_thread)
+        size = sum(row_size(row) for row in buffer)
+        self._entries[key] = _Entry(buffer, complete and len(rows) <= self.rows_per_thread, size)
+        self.size += size
+        self._evict()
+
+    def _evict(self):
+        # the most recently used entry is always kept
+        while len(self._entries) > 1 and (len(self._entries) > self.max_threads or self.size > self.max_bytes):
+            _, entry = self._entries.popitem(last=False)
+            self.size -= entry.size
+
+    def invalidate(self, table=None, thread_id=None):
+        with self.lock:
+            for key in list(self._entries):
+                if (table is None or key[0] == table) and (thread_id is None or key[1] == thread_id):
+                    self.size -= self._entries.pop(key).size
+
+    def clear(self):
+        with self.lock:
+            self._entries.clear()
+            self.size = 0
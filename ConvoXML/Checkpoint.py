@@ -0,0 +1,88 @@
+import json
+import time
+from . import Schema
+
+# parser options kept in the Context that are never written to a checkpoint
+UNSAVED_CONTEXT = ('openai_key', 'palm_key', 'openai_base_url', 'exit')
+
+
+def context_state(context):
+    """
+    The entries of a Context that can be saved as JSON, without API keys.
+    """
+    state = {}
+    for key, value in context.items():
+        if key in UNSAVED_CONTEXT:
+            continue
+        try:
+            json.dumps(value)
+        except (TypeError, ValueError):
+            continue
+        state[key] = value
+    return state
+
+
+class Checkpointer:
+    """
+    Saves the state of a run to the Checkpoints table of the message database.
+
+    Each run has one row, keyed by its run_id, that every checkpoint
+    replaces, so checkpoints cost one small upsert however long the run is.
+    save() writes at most once every `interval` seconds unless forced, and
+    interval=0 saves after every turn. A turn finished after the last
+    checkpoint is run again on resume, so the interval bounds the model
+    calls a crash can cost. The message store is flushed before each save,
+    so a checkpoint never gets ahead of the messages it counts.
+
+    Example Usage:
+        parser = ConvoXML(xml_string, db_path='runs.db', run_id='nightly', checkpoint_interval=5)
+        parser.run()
+        # after a crash, in a new process
+        ConvoXML(xml_string, db_path='runs.db', run_id='nightly', checkpoint_interval=5).resume()
+    """
+
+    def __init__(self, connections, run_id, digest, interval=1.0, store=None):
+        self.connections = connections
+        self.run_id = run_id
+        self.digest = digest
+        self.interval = interval
+        self.store = store
+        self.sequence = 0
+        self._saved = time.monotonic()
+        Schema.create_checkpoint_table(connections.connection())
+
+    def due(self):
+        return time.monotonic() - self._saved >= self.interval
+
+    def save(self, state, force=False):
+        """
+        Writes state if a checkpoint is due, or always when force is set.
+        """
+        if not force and not self.due():
+            return False
+        if self.store is not None:
+            self.store.flush()
+        self.sequence += 1
+        self.connections.execute(
+            "INSERT OR REPLACE INTO Checkpoints (run_id, digest, sequence, state) VALUES (?, ?, ?, ?)",
+            (self.run_id, self.digest, self.sequence, json.dumps(state)), commit=True)
+        self._saved = time.monotonic()
+        return True
+
+    def load(self):
+        """
+        The state saved last for this run, or None. Checkpoints of another
+        definition are refused.
+        """
+        row = self.connections.execute(
+            "SELECT digest, sequence, state FROM Checkpoints WHERE run_id = ?", (self.run_id,)).fetchone()
+        if row is None:
+            return None
+        digest, sequence, state = row
+        if digest != self.digest:
+            raise ValueError(f"Checkpoint of run {self.run_id!r} was saved by a different ConvoXML definition")
+        self.sequence = sequence
+        return json.loads(state)
+
+    def delete(self):
+        self.connections.execute("DELETE FROM Checkpoints WHERE run_id = ?", (self.run_id,), commit=True)
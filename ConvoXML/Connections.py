@@ -0,0 +1,123 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+class ConnectionManager:
+    """
+    Hands out long-lived SQLite connections for a single database file.
+
+    Each thread gets its own connection which is opened on first use and kept
+    for the lifetime of the manager, so agents no longer pay for a connect/close
+    cycle on every read and write. Connections are opened in WAL mode with a
+    tunable synchronous level, and sqlite3's per-connection statement cache is
+    sized by `cached_statements` so repeated queries reuse their prepared
+    statements.
+
+    Example Usage:
+        connections = ConnectionManager('messages.db', synchronous='NORMAL')
+        connections.execute("INSERT INTO Messages (thread_id, content) VALUES (?, ?)",
+                            ('thread1', 'hello'), commit=True)
+        rows = connections.execute("SELECT * FROM Messages").fetchall()
+    """
+
+    _managers = {}
+    _managers_lock = threading.Lock()
+
+    def __init__(self, db_path='messages.db', synchronous='NORMAL', journal_mode='WAL',
+                 cached_statements=256, timeout=30.0):
+        self.db_path = db_path
+        self.synchronous = synchronous
+        self.journal_mode = journal_mode
+        self.cached_statements = cached_statements
+        self.timeout = timeout
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+        # An in-memory database only exists inside the connection that created it,
+        # so every thread has to share the same one.
+        self._shared = db_path == ':memory:'
+
+    @classmethod
+    def for_path(cls, db_path, **options):
+        """
+        Returns the process-wide manager for db_path, creating it on first use.
+        Agents and ChatMessages built outside of a ConvoXMLParser fall back to this.
+        """
+        with cls._managers_lock:
+            manager = cls._managers.get(db_path)
+            if manager is None:
+                manager = cls._managers[db_path] = cls(db_path, **options)
+            return manager
+
+    def connect(self):
+        connection = sqlite3.connect(self.db_path, timeout=self.timeout,
+                                     cached_statements=self.cached_statements,
+                                     check_same_thread=False)
+        if not self._shared and self.journal_mode:
+            connection.execute(f"PRAGMA journal_mode={self.journal_mode}")
+        if self.synchronous:
+            connection.execute(f"PRAGMA synchronous={self.synchronous}")
+        return connection
+
+    def connection(self):
+        """
+        Returns the connection owned by the calling thread.
+        """
+        if self._shared:
+            with self._lock:
+                if not self._connections:
+                    self._connections.append(self.connect())
+                return self._connections[0]
+
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self.connect()
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def execute(self, sql, parameters=(), commit=False):
+        connection = self.connection()
+        cursor = connection.execute(sql, parameters)
+        if commit:
+            connection.commit()
+        return cursor
+
+    def executemany(self, sql, seq_of_parameters, commit=False):
+        connection = self.connection()
+        cursor = connection.executemany(sql, seq_of_parameters)
+        if commit:
+            connection.commit()
+        return cursor
+
+    def commit(self):
+        self.connection().commit()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Commits everything executed inside the block at once, or rolls it back on error.
+        """
+        connection = self.connection()
+        try:
+            yield connection
+        except BaseException:
+            connection.rollback()
+            raise
+        else:
+            connection.commit()
+
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for connection in connections:
+            try:
+                connection.close()
+            except sqlite3.Error:
+                pass
+        self._local = threading.local()
+        with self._managers_lock:
+            if self._managers.get(self.db_path) is self:
+                del self._managers[self.db_path]
@@ -1,6 +1,7 @@
-import sqlite3
 import uuid
-from datetime import datetime
+from .Cache import utc_timestamp
+from .Connections import ConnectionManager
+from . import Schema
 
 class Context(dict):
     """
@@ -21,6 +22,16 @@ class Context(dict):
             cls._instance = super().__new__(cls, *args, **kwargs)
         return cls._instance
 
+    @classmethod
+    def isolated(cls, **items):
+        """
+        Creates a Context that is not the singleton, for conversations that
+        run side by side and must not share turns or the exit flag.
+        """
+        context = dict.__new__(cls)
+        context.update(items)
+        return context
+
     def __getattr__(self, item):
         return self.get(item)
 
@@ -32,32 +43,22 @@ class Context(dict):
 
 
 class ChatMessages:
-  def __init__(self, db_filename="chatroom.db", thread_id=None):
-       # Create a SQLite database connection and cursor
+  def __init__(self, db_filename="chatroom.db", thread_id=None, connections=None, cache=None, bus=None):
+       # Reuse a long-lived SQLite connection for this database file
       self.db_filename = db_filename
-      self.db_connection = sqlite3.connect(self.db_filename)
+      self.connections = connections or ConnectionManager.for_path(self.db_filename)
+      # optional MessageCache consulted before querying a thread
+      self.cache = cache
+      # optional MessageBus that announces inserted messages, e.g. to a running conversation
+      self.bus = bus
+      self.db_connection = self.connections.connection()
       self.db_cursor = self.db_connection.cursor()
       self.thread_id = thread_id or self.new_thread_id()
       self.init_db()
 
   def init_db(self):
-      # Create a SQLite database and Messages table if it doesn't exist
-      conn = sqlite3.connect(self.db_filename)
-      cursor = conn.cursor()
-      cursor.execute('''
-          CREATE TABLE IF NOT EXISTS Messages (
-              message_id INTEGER PRIMARY KEY AUTOINCREMENT,
-              thread_id TEXT,
-              timestamp DATETIME,
-              sender TEXT,
-              content TEXT,
-              agent_name TEXT,
-              participants TEXT,
-              agents TEXT
-          )
-      ''')
-      conn.commit()
-      conn.close()
+      # Create the Messages table, or bring an older one up to date
+      Schema.migrate(self.connections.connection())
 
   def new_thread_id(self):
       thread_id = str(uuid.uuid4())
@@ -70,34 +71,42 @@ class ChatMessages:
   def insert_message(self, sender, content, agent_name, participants, agents, thread_id=None):
       # Insert a message into the database
       thread_id = thread_id or self.thread_id
-      timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+      # UTC like every other writer, so shards merge messages in order
+      timestamp = utc_timestamp()
       print(thread_id, timestamp, sender, content, agent_name, participants, agents)
-      conn = sqlite3.connect(self.db_filename)
-      cursor = conn.cursor()
-      cursor.execute('''
+      values = (thread_id, timestamp, sender, content, agent_name, str(participants), str(agents))
+      cursor = self._insert(values)
+      if self.cache is not None:
+          self.cache.append('Messages', (cursor.lastrowid,) + values)
+      if self.bus is not None:
+          self.bus.publish('Messages', thread_id, sender, content)
+
+  def _insert(self, values):
+      return self.connections.execute('''
           INSERT INTO Messages (thread_id, timestamp, sender, content, agent_name, participants, agents)
           VALUES (?, ?, ?, ?, ?, ?, ?)
-      ''', (thread_id, timestamp, sender, content, agent_name, str(participants), str(agents)))
-      conn.commit()
-      conn.close()
+      ''', values, commit=True)
 
   def get_last_n_messages(self, n=5, thread_id=None):
-      # Retrieve the last n messages from the database
-      conn = sqlite3.connect(self.db_filename)
-      cursor = conn.cursor()
+      # Retrieve the last n messages, from the cache when the thread is hot
+      if thread_id and self.cache is not None:
+          return self.cache.get('Messages', thread_id, n, lambda limit: self._select(limit, thread_id))
+      return self._select(n, thread_id)
+
+  def _select(self, n, thread_id=None):
+      n = -1 if n is None else n
       if thread_id:
-          cursor.execute('''
-              SELECT * FROM Messages
+          cursor = self.connections.execute(f'''
+              SELECT {Schema.MESSAGE_SELECT} FROM Messages
                WHERE thread_id = ?
               ORDER BY message_id DESC
               LIMIT ?
           ''', (thread_id,n,))            
       else:
-          cursor.execute('''
-              SELECT * FROM Messages
+          cursor = self.connections.execute(f'''
+              SELECT {Schema.MESSAGE_SELECT} FROM Messages
               ORDER BY message_id DESC
               LIMIT ?
           ''', (n,))
       messages = cursor.fetchall()
-      conn.close()
       return messages
\ No newline at end of file
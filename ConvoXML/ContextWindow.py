@@ -0,0 +1,133 @@
+import re
+from functools import lru_cache
+from .Schema import MESSAGE_ID, SENDER, CONTENT
+
+# rough token boundaries used when tiktoken isn't installed
+_TOKEN = re.compile(r"\w+|[^\w\s]")
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s")
+SUMMARY_PREFIX = 'Summary of earlier messages: '
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model=None):
+    """
+    The tiktoken encoding for model, or None when tiktoken isn't installed.
+    """
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model) if model else tiktoken.get_encoding('cl100k_base')
+    except KeyError:
+        return tiktoken.get_encoding('cl100k_base')
+
+
+@lru_cache(maxsize=65536)
+def count_tokens(text, model=None):
+    """
+    Number of tokens in text. Counts are cached, since the same messages
+    are counted again on every turn of a thread.
+    """
+    encoding = get_encoding(model)
+    if encoding is None:
+        return len(_TOKEN.findall(text))
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_tokens(text, budget, model=None, keep='end'):
+    """
+    Cuts text down to about budget tokens, keeping its end (or its start).
+    """
+    if count_tokens(text, model) <= budget:
+        return text
+    words = text.split()
+    kept, used = [], 0
+    for word in (reversed(words) if keep == 'end' else words):
+        used += count_tokens(word, model)
+        if used > budget:
+            break
+        kept.append(word)
+    return ' '.join(reversed(kept) if keep == 'end' else kept)
+
+
+def extractive_summary(summary, rows):
+    """
+    Default summarizer: adds the first sentence of each message, with its
+    sender, to the previous summary.
+    """
+    lines = [summary] if summary else []
+    for row in rows:
+        first = _SENTENCE_END.split(row[CONTENT].strip(), maxsplit=1)[0]
+        lines.append(f"{row[SENDER]}: {first}")
+    return ' '.join(lines)
+
+
+class ContextWindow:
+    """
+    Fits the messages an agent reads into a token budget.
+
+    build() keeps the newest messages that fit in `budget` tokens and, when
+    `summary_budget` is set, folds the messages that no longer fit into a
+    rolling summary of at most `summary_budget` tokens which is sent ahead
+    of them. Summaries are kept per (table, thread) and updated
+    incrementally: each message is summarized once, when it first leaves
+    the window. summarize(summary, rows) can be replaced, e.g. by a model call.
+
+    Example Usage:
+        <Role name="Critic" class="OpenAIAgent" rows="50" token_budget="2000" summary_tokens="300"/>
+    """
+
+    def __init__(self, budget, summary_budget=0, model=None, summarize=None):
+        self.budget = budget
+        self.summary_budget = summary_budget
+        self.model = model
+        self.summarize = summarize or extractive_summary
+        self.summaries = {}
+        # the highest message_id folded into each summary
+        self.summarized = {}
+
+    def count(self, text):
+        return count_tokens(text, self.model)
+
+    def fit(self, rows, budget):
+        """
+        Splits chronological rows into (dropped, kept), keeping the newest rows
+        that fit in budget tokens.
+        """
+        used = 0
+        for index in range(len(rows) - 1, -1, -1):
+            used += self.count(rows[index][CONTENT])
+            if used > budget:
+                return rows[:index + 1], rows[index + 1:]
+        return [], rows
+
+    def summarized_id(self, key):
+        return self.summarized.get(key, 0)
+
+    def update_summary(self, key, rows, through=0):
+        """
+        Folds the rows that aren't in the summary yet into it. Every message up
+        to message_id `through` counts as summarized afterwards.
+        """
+        last = self.summarized_id(key)
+        rows = [row for row in rows if row[MESSAGE_ID] is not None and row[MESSAGE_ID] > last]
+        if rows:
+            summary = self.summarize(self.summaries.get(key), rows)
+            self.summaries[key] = truncate_tokens(summary, self.summary_budget, self.model)
+        self.summarized[key] = max([last, through] + [row[MESSAGE_ID] for row in rows])
+        return self.summaries.get(key)
+
+    def build(self, key, rows, evicted=(), through=0):
+        """
+        Returns the input strings for chronological rows, oldest first. evicted
+        are older rows, up to message_id `through`, that left the window since
+        the last call and only go into the summary.
+        """
+        summary = self.summaries.get(key) if self.summary_budget else None
+        budget = self.budget - self.summary_budget
+        dropped, kept = self.fit(rows, max(budget, 0))
+        if self.summary_budget and (evicted or dropped or through > self.summarized_id(key)):
+            summary = self.update_summary(key, list(evicted) + list(dropped), through)
+        inputs = [row[CONTENT] for row in kept]
+        return [SUMMARY_PREFIX + summary] + inputs if summary else inputs
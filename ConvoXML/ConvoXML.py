@@ -1,13 +1,22 @@
-import sqlite3
-from bs4 import BeautifulSoup
+import asyncio
+import copy
+import inspect
+import os
 import uuid
-import re
-import random
-import openai
-import google.generativeai as palm
-from .AgentInterface import AgentInterface
-from .Agents import TestAgent, TestModerator, PalmAgent, PalmDeveloper, OpenAIAgent, OpenAIDeveloper
+from .Agents import TestAgent
+from .Registry import AgentRegistry, BUILTIN_AGENTS
 from .Context import Context
+from .Connections import ConnectionManager
+from .Writers import MessageWriter, BufferedMessageWriter
+from .Stores import StoreRouter, create_store
+from .Scheduler import ConvoScheduler
+from .Budget import BudgetGovernor
+from .Checkpoint import Checkpointer, context_state
+from .Bus import MessageBus, SocketBus
+from .Cache import MessageCache
+from .Plan import load_plan, DEFAULT_CACHE_DIR
+from .Instrumentation import Instrumentation, NULL_INSTRUMENTATION
+from . import Schema
 
 
 
@@ -17,15 +26,8 @@ class ConvoXMLParser:
       Parses xml and creates agents
     """
 
-    # Define a dictionary to store class name to class object mappings
-    class_mapping = {
-        'TestAgent': TestAgent,
-        'TestModerator': TestModerator,
-        'PalmAgent': PalmAgent,
-        'PalmDeveloper': PalmDeveloper,
-        'OpenAIAgent': OpenAIAgent,
-        'OpenAIDeveloper': OpenAIDeveloper,
-    }
+    # Maps class names to agent classes, resolved the first time a role uses them
+    class_mapping = AgentRegistry(BUILTIN_AGENTS)
 
     default_agent = TestAgent
 
@@ -33,48 +35,107 @@ class ConvoXMLParser:
         
 
         self.xml_string = xml_string
+        self.agent_classes = list(agent_classes)
+        # constructor options, reused by workers that rebuild this parser in another process
+        self.options = kwargs
+        # number of agent executions performed by run/arun
+        self.steps = 0
+        # pass an Instrumentation, or instrument=True, to collect timings of agents and runs
+        self.instrumentation = kwargs.get('instrumentation') or (
+            Instrumentation() if kwargs.get('instrument') else NULL_INSTRUMENTATION)
         self.context = context or Context()
         self.context.openai_key = kwargs.get('openai_key')
         self.context.palm_key = kwargs.get('palm_key')
+        self.context.openai_base_url = kwargs.get('openai_base_url')
         self.db_path = db_path or 'messages.db'
+        # called as on_chunk(agent, text) for every chunk of a role with stream="true"
+        self.on_chunk = kwargs.get('on_chunk')
+        # maximum number of agents arun executes at the same time
+        self.concurrency = kwargs.get('concurrency', 8)
+        # seconds a run with no agent ready waits for notify() before it returns
+        self.idle_timeout = kwargs.get('idle_timeout', 0.0)
+        self.scheduler = None
+        # checkpoint_interval (seconds, 0 for every turn) saves the run's state under run_id, see resume()
+        self.run_id = kwargs.get('run_id') or str(uuid.uuid4())
+        self.checkpoint_interval = kwargs.get('checkpoint_interval')
+        # one set of long-lived connections shared by every agent of this parser
+        self.connections = kwargs.get('connections') or ConnectionManager(
+            self.db_path, synchronous=kwargs.get('synchronous', 'NORMAL'))
         self.db_connection = self.setup_database(self.db_path)
+        # recent messages of each thread are served from memory, cache_rows=0 turns this off
+        cache_rows = kwargs.get('cache_rows', 50)
+        self.cache = MessageCache(cache_rows, max_threads=kwargs.get('cache_threads', 1024),
+                                  max_bytes=kwargs.get('cache_bytes', 64 * 1024 * 1024)) if cache_rows else None
+        # buffered_writes trades a few milliseconds of durability for group commits
+        if kwargs.get('buffered_writes'):
+            self.writer = BufferedMessageWriter(self.connections,
+                                                batch_size=kwargs.get('batch_size', 500),
+                                                flush_interval=kwargs.get('flush_interval', 0.05),
+                                                cache=self.cache)
+        else:
+            self.writer = MessageWriter(self.connections, cache=self.cache)
         for agent_class in agent_classes:
                 self.register_agent_class(agent_class)
-        self.soup = BeautifulSoup(self.xml_string, features="html.parser")
-        self.convo_loop = self.get_convo()    
+        # compiled once per definition, plan_cache names a directory for reusing it across runs
+        plan_cache = kwargs.get('plan_cache', os.environ.get('CONVOXML_CACHE_DIR'))
+        self.plan = load_plan(self.xml_string, DEFAULT_CACHE_DIR if plan_cache is True else plan_cache)
+        self.convo_loop = self.get_convo()
+        # tables live in SQLite unless the store option or their <input>/<output> names another store
+        self.store = self.setup_stores(kwargs.get('store', 'sqlite'), kwargs.get('log_dir'))
+        # new messages are published on the bus, bus_path shares it with other processes over a local socket
+        caches = [self.cache] if self.cache is not None else []
+        self.bus = kwargs.get('bus') or (SocketBus(kwargs['bus_path'], caches) if kwargs.get('bus_path') else MessageBus())
+        if isinstance(self.bus, SocketBus) and self.cache is not None and self.cache not in self.bus.caches:
+            self.bus.caches.append(self.cache)
+        # enforces the <Budget> declarations and keeps the usage of each run
+        self.budget = BudgetGovernor.from_plan(self.plan, self.instrumentation)
         self.agents = self.get_agents()
         self.queue = self.parse_queue()
+        # create the SQLite input and output tables the roles refer to
+        Schema.migrate(self.db_connection, [table for table in self.get_tables()
+                                            if self.store.store(table.strip()) is self.sqlite_store])
 
-    def get_convo(self):
+    def fork(self, context=None):
+        """
+        Returns a new conversation from the definition this parser already parsed.
 
-        convo_loop = self.soup.find(re.compile(r'convoloop', re.IGNORECASE))
-        return convo_loop
+        The fork gets fresh agents with new thread ids and its own Context, so it
+        can run alongside other forks, while sharing the database connections,
+        message writer and cache of this parser. Nothing is parsed again.
+        """
+        conversation = copy.copy(self)
+        conversation.context = context or Context.isolated(openai_key=self.context.openai_key,
+                                                           palm_key=self.context.palm_key,
+                                                           openai_base_url=self.context.openai_base_url)
+        conversation.steps = 0
+        conversation.scheduler = None
+        conversation.run_id = str(uuid.uuid4())
+        conversation.budget = BudgetGovernor.from_plan(self.plan, self.instrumentation)
+        conversation.agents = conversation.get_agents()
+        conversation.queue = conversation.parse_queue()
+        return conversation
+
+    def get_convo(self):
+        return self.plan.steps
 
     def parse_queue(self):
         queue = []
-        branch = []
-        for child in self.convo_loop.findChildren(recursive=False):
-            agent = self.get_agent_by_role(child.name)
+        for step in self.plan.steps:
+            agent = self.get_agent_by_role(step.role)
             queue.append(agent)
-            for grand_child in child.findChildren(recursive=False):
-                if grand_child.name.lower() == 'case':
-                    nested_agent = self.get_agent_by_role(grand_child.get("role"))
-                else:
-                    nested_agent = self.get_agent_by_role(grand_child.name)
+            branch = []
+            for role in step.branch:
+                nested_agent = self.get_agent_by_role(role)
                 nested_agent.thread_id = agent.thread_id
                 agent.children.append(nested_agent)
                 branch.append(nested_agent)
             if len(branch) > 0:
                 queue.append(branch)
-                branch = []
         return queue
 
 
     def get_agent_by_role(self, name):
-        for agent in self.agents:
-            if agent.role.lower() == name.lower():
-                return agent
-        return None
+        return self.role_index.get(name.lower())
 
 
     def register_agent_class(self, AgentClass):
@@ -86,98 +147,199 @@ class ConvoXMLParser:
 
 
     def get_agents(self):
-        roles = self.soup.find_all('role')
         agents = []
-        for role in roles:
+        for spec in self.plan.roles:
             # Create a dictionary to hold role attributes and values
-            role_attrs = {'role': role["name"]}
-
-            # Add any additional attributes from the XML dynamically
-            for attr in role.attrs:
-                role_attrs[attr] = role[attr]
-
-            # Extract specific attributes if they exist
-            input_element = role.find('input')
-            output_element = role.find('output')
-
-            if input_element:
-                role_attrs['input_table'] = list(input_element.get('table'))
-                role_attrs['rows'] = input_element.get('rows').split(',')
-
-            if output_element:
-                role_attrs['output_table'] = output_element.get('table')
+            role_attrs = {'role': spec.name}
+
+            # Add any additional attributes from the XML dynamically; agents keep
+            # the shared attribute mapping rather than a copy of each value
+            role_attrs.update(spec.attributes)
+            role_attrs['spec'] = spec
+            role_attrs['attributes'] = self.plan.role_attributes(spec.name)
+            role_attrs['input_table'] = spec.input_table
+            role_attrs['output_table'] = spec.output_table
+            if spec.rows is not None:
+                role_attrs['rows'] = list(spec.rows) if len(spec.rows) > 1 else spec.rows[0]
 
             # Assign the database connection and context
             role_attrs['db_path'] = self.db_path
+            role_attrs['connections'] = self.connections
+            role_attrs['writer'] = self.writer
+            role_attrs['store'] = self.store
+            role_attrs['budget'] = self.budget
+            role_attrs['bus'] = self.bus
+            role_attrs['instrumentation'] = self.instrumentation
             role_attrs['context'] = self.context
+            role_attrs['on_chunk'] = self.on_chunk
 
-            # Instantiate the agent with dynamic attributes
             # Instantiate the agent with dynamic attributes using class_mapping
-            if 'class' in role.attrs.keys():
-                class_name = role['class'][0]
-                agent_class = self.class_mapping.get(class_name, self.default_agent)
-            else:
-                agent_class = self.default_agent
+            agent_class = self.class_mapping.get(spec.class_name, self.default_agent) if spec.class_name else self.default_agent
             agent = agent_class(**role_attrs)
             agents.append(agent)
 
+        # role names are matched case-insensitively
+        self.role_index = {agent.role.lower(): agent for agent in agents}
         return agents
 
-    def get_agent_queue(self):
-        element_queue = self.parse_queue()
-        agent_queue = []
-        for idx,action in enumerate(element_queue):
-            agent_queue.append(action)
-        return agent_queue
+    def get_tables(self):
+        return self.plan.tables()
 
+    def setup_stores(self, default='sqlite', log_dir=None):
+        """
+        Returns a StoreRouter that sends each table to its declared store, and
+        the tables without a store attribute to the default store. Log files
+        go to log_dir, next to the database by default.
+        """
+        if log_dir is None:
+            stem = 'messages' if self.db_path == ':memory:' else os.path.splitext(self.db_path)[0]
+            log_dir = f"{stem}.logs"
+        self.sqlite_store = create_store('sqlite', self.connections, self.writer)
+        stores = {'sqlite': self.sqlite_store}
 
+        def store(name):
+            if name not in stores:
+                stores[name] = create_store(name, directory=log_dir)
+            return stores[name]
 
+        tables = {table: store(name) for table, name in self.plan.table_stores().items()}
+        return StoreRouter(store(default), tables)
 
-    def handle_branch(self, result, branch):
-        """
-        Handles a branch of the conversation queue
-        """
-        results = []
-        for agent in branch:
-            if result in agent.role:
-                results.append(agent.execute())
-        return results
+    def get_agent_queue(self):
+        return list(self.queue)
 
 
 
 
+    def execute_agent(self, agent):
+        self.steps += 1
+        with agent.timer('agent.execute'):
+            result = agent.execute()
+            # agents with an async execute can still be used by the blocking run
+            if inspect.isawaitable(result):
+                result = asyncio.run(result)
+        return result
+
     def run(self):
-        queue = self.queue        
-        self.context.exit = False
-        while not self.context.exit:
-            result = None
-            for action in queue:
-                if type(action) == list and result != None:
-                    self.handle_branch(result, action)
-                else:
-                    result = action.execute()
+        """
+        Runs the conversation until an agent sets context.exit, no agent is
+        left with a message to answer, or the run's budget runs out, see
+        ConvoScheduler. Returns the usage of the run, see BudgetGovernor.
+        """
+        self.budget.start()
+        self.scheduler = ConvoScheduler(self, idle_timeout=self.idle_timeout, checkpointer=self.checkpointer())
+        self.scheduler.run()
+        self.store.flush()
+        return self.budget.as_dict()
+
+    async def aexecute_agent(self, agent, semaphore):
+        async with semaphore:
+            self.steps += 1
+            with agent.timer('agent.execute'):
+                return await agent.aexecute()
+
+    async def arun(self, concurrency=None):
+        """
+        Async version of run. Independent threads and the members a branch
+        selects together execute concurrently, with at most `concurrency`
+        agents running at once.
+        """
+        self.budget.start()
+        self.scheduler = ConvoScheduler(self, idle_timeout=self.idle_timeout, checkpointer=self.checkpointer())
+        await self.scheduler.arun(concurrency or self.concurrency)
+        await asyncio.to_thread(self.store.flush)
+        return self.budget.as_dict()
+
+    def checkpointer(self):
+        if self.checkpoint_interval is None:
+            return None
+        return Checkpointer(self.connections, self.run_id, self.plan.digest,
+                            interval=float(self.checkpoint_interval), store=self.store)
+
+    def checkpoint_state(self):
+        """
+        The state of the conversation that a checkpoint keeps besides the
+        scheduler's: agent thread ids and counters, the Context and the usage.
+        """
+        return {
+            'steps': self.steps,
+            'agents': [[agent.role, agent.thread_id, agent.messages_sent] for agent in self.agents],
+            'context': context_state(self.context),
+            'usage': self.budget.as_dict(),
+        }
+
+    def restore_checkpoint(self):
+        """
+        Loads the last checkpoint of run_id into this conversation and returns
+        a scheduler that continues from it, or None when the run had finished.
+        """
+        checkpointer = self.checkpointer() or Checkpointer(self.connections, self.run_id, self.plan.digest, store=self.store)
+        state = checkpointer.load()
+        if state is None:
+            raise ValueError(f"No checkpoint saved for run {self.run_id!r}")
+        self.steps = state['steps']
+        for role, thread_id, messages_sent in state['agents']:
+            agent = self.get_agent_by_role(role)
+            agent.thread_id = thread_id
+            agent.messages_sent = messages_sent
+        self.context.update(state['context'])
+        self.budget.restore(state['usage'])
+        if state['finished']:
+            return None
+        scheduler = ConvoScheduler(self, idle_timeout=self.idle_timeout, checkpointer=self.checkpointer())
+        scheduler.restore(state)
+        return scheduler
+
+    def resume(self):
+        """
+        Continues run_id from its last checkpoint, without running the turns
+        the checkpoint already counts, and returns the usage of the run.
+        Nothing runs if the run had finished.
+        """
+        self.scheduler = self.restore_checkpoint()
+        if self.scheduler is not None:
+            self.scheduler.run()
+            self.store.flush()
+        return self.budget.as_dict()
+
+    async def aresume(self, concurrency=None):
+        self.scheduler = self.restore_checkpoint()
+        if self.scheduler is not None:
+            await self.scheduler.arun(concurrency or self.concurrency)
+            await asyncio.to_thread(self.store.flush)
+        return self.budget.as_dict()
+
+    def notify(self, role):
+        """
+        Wakes role in the running conversation, e.g. when a message for it
+        arrives from outside. An idle run picks it up within idle_timeout.
+        """
+        if self.scheduler is not None:
+            self.scheduler.post(role)
 
+    def close(self):
+        """
+        Writes any buffered messages and closes the message stores, the bus and the database connections.
+        """
+        self.store.close()
+        self.bus.close()
+        self.writer.close()
+        self.connections.close()
 
 
 
 
-    # Setting up the SQLite database and test data
+    # Setting up the SQLite database
     def setup_database(self, db_path=None):
         db_path = db_path or self.db_path
-        connection = sqlite3.connect(db_path)
-        cursor = connection.cursor()
-
-        # Create the Messages table
-        cursor.execute('''CREATE TABLE IF NOT EXISTS Messages (
-                              message_id INTEGER PRIMARY KEY,
-                              thread_id TEXT,
-                              sender_id INTEGER,
-                              content TEXT,
-                              timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)''')
-
-        # Inserting some test data
-        cursor.execute("INSERT INTO Messages (thread_id, sender_id, content) VALUES (?, ?, ?)", ('thread1', 1, 'Test message 1'))
-        cursor.execute("INSERT INTO Messages (thread_id, sender_id, content) VALUES (?, ?, ?)", ('thread1', 2, 'Test message 2'))
-        cursor.execute("INSERT INTO Messages (thread_id, sender_id, content) VALUES (?, ?, ?)", ('thread2', 1, 'Test message 3'))
+        connections = self.connections if db_path == self.connections.db_path else ConnectionManager.for_path(db_path)
+        connection = connections.connection()
+
+        # Create or upgrade the Messages table
+        Schema.migrate(connection)
 
         return connection
+
+
+# ConvoXML is the name used throughout the README
+ConvoXML = ConvoXMLParser
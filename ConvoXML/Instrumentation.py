@@ -0,0 +1,249 @@
+import json
+import math
+import threading
+import time
+from contextlib import nullcontext
+
+# the disabled path hands out this shared no-op context manager
+_NULL_TIMER = nullcontext()
+
+
+class Histogram:
+    """
+    Log-linear latency histogram in the spirit of HdrHistogram.
+
+    Values are bucketed by powers of two, each split into `sub_buckets`
+    linear steps, so every recorded value is kept with a relative error of
+    at most 1/sub_buckets while memory stays proportional to the number of
+    distinct magnitudes seen. Values are seconds.
+    """
+
+    def __init__(self, sub_buckets=16, lowest=1e-7):
+        self.sub_buckets = sub_buckets
+        self.lowest = lowest
+        self.buckets = {}
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def bucket(self, value):
+        if value <= self.lowest:
+            return 0
+        scaled = value / self.lowest
+        exponent = int(math.log2(scaled))
+        fraction = scaled / (1 << exponent) - 1
+        return 1 + exponent * self.sub_buckets + min(int(fraction * self.sub_buckets), self.sub_buckets - 1)
+
+    def upper_bound(self, index):
+        if index == 0:
+            return self.lowest
+        exponent, step = divmod(index - 1, self.sub_buckets)
+        return self.lowest * (1 << exponent) * (1 + (step + 1) / self.sub_buckets)
+
+    def record(self, value):
+        index = self.bucket(value)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other):
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += other.count
+        self.sum += other.sum
+        if other.count:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def percentile(self, percent):
+        if not self.count:
+            return 0.0
+        target = max(1, math.ceil(self.count * percent / 100))
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= target:
+                return min(self.upper_bound(index), self.max)
+        return self.max
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+    def cumulative(self):
+        """
+        (upper bound, cumulative count) pairs for the non-empty buckets.
+        """
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            yield self.upper_bound(index), seen
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'min': self.min or 0.0,
+            'max': self.max or 0.0,
+            'mean': self.mean,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+        }
+
+
+class _Timer:
+    __slots__ = ('instrumentation', 'name', 'labels', 'started')
+
+    def __init__(self, instrumentation, name, labels):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        labels = self.labels if exc_type is None else dict(self.labels, error=exc_type.__name__)
+        self.instrumentation.record(self.name, time.perf_counter() - self.started, **labels)
+        return False
+
+
+class Instrumentation:
+    """
+    Collects latency histograms and counters for agents and runs.
+
+    Timings are recorded under a name such as 'agent.get_inputs' plus labels
+    (role, model, ...), and every recording is also passed to the registered
+    hooks as hook(name, value, labels). When disabled, timer() returns a
+    shared no-op context manager and record()/count() return immediately.
+
+    Example Usage:
+        instrumentation = Instrumentation()
+        parser = ConvoXML(xml_string, instrumentation=instrumentation)
+        parser.run()
+        print(instrumentation.to_prometheus())
+    """
+
+    def __init__(self, enabled=True, hooks=None):
+        self.enabled = enabled
+        self.hooks = list(hooks or [])
+        self.histograms = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+        return hook
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def timer(self, name, **labels):
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name, labels)
+
+    def record(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = self.key(name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.record(value)
+        for hook in self.hooks:
+            hook(name, value, labels)
+
+    def count(self, name, value=1, **labels):
+        if not self.enabled or not value:
+            return
+        key = self.key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        for hook in self.hooks:
+            hook(name, value, labels)
+
+    def histogram(self, name, **labels):
+        """
+        Histogram of name merged over every label set that includes labels.
+        """
+        merged = Histogram()
+        with self._lock:
+            for (key_name, key_labels), histogram in self.histograms.items():
+                if key_name == name and set(labels.items()) <= set(key_labels):
+                    merged.merge(histogram)
+        return merged
+
+    def counter(self, name, **labels):
+        with self._lock:
+            return sum(value for (key_name, key_labels), value in self.counters.items()
+                       if key_name == name and set(labels.items()) <= set(key_labels))
+
+    def reset(self):
+        with self._lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'histograms': [dict(name=name, labels=dict(labels), **histogram.summary())
+                               for (name, labels), histogram in self.histograms.items()],
+                'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                             for (name, labels), value in self.counters.items()],
+            }
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.as_dict(), **kwargs)
+
+    def to_prometheus(self, prefix='convoxml'):
+        """
+        Renders the metrics in the Prometheus text exposition format.
+        """
+        def metric_name(name, suffix=''):
+            return f"{prefix}_{name.replace('.', '_').replace('-', '_')}{suffix}"
+
+        def render_labels(labels, **extra):
+            pairs = list(labels) + list(extra.items())
+            if not pairs:
+                return ''
+            escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+                       for _, value in pairs)
+            return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + '}'
+
+        lines = []
+        with self._lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+        declared = set()
+        for (name, labels), histogram in histograms:
+            metric = metric_name(name, '_seconds')
+            if metric not in declared:
+                declared.add(metric)
+                lines.append(f"# TYPE {metric} histogram")
+            for bound, seen in histogram.cumulative():
+                lines.append(f"{metric}_bucket{render_labels(labels, le=f'{bound:.9g}')} {seen}")
+            lines.append(f"{metric}_bucket{render_labels(labels, le='+Inf')} {histogram.count}")
+            lines.append(f"{metric}_sum{render_labels(labels)} {histogram.sum:.9g}")
+            lines.append(f"{metric}_count{render_labels(labels)} {histogram.count}")
+        for (name, labels), value in counters:
+            metric = metric_name(name, '_total')
+            if metric not in declared:
+                declared.add(metric)
+                lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric}{render_labels(labels)} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+# shared by agents and parsers that were not given an Instrumentation
+NULL_INSTRUMENTATION = Instrumentation(enabled=False)
@@ -0,0 +1,281 @@
+import hashlib
+import io
+import json
+import os
+import threading
+import xml.etree.ElementTree as ET
+from collections import namedtuple
+from types import MappingProxyType
+
+# bump when the layout of compiled plans changes so stale cache files are ignored
+PLAN_VERSION = 4
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'convoxml')
+
+# A role declared in <Roles>. attributes holds the XML attributes as (name, value) pairs,
+# stores the (table, store) pairs named by the store attribute of its <input> and <output>,
+# subscriptions the input tables whose new messages wake the role.
+RoleSpec = namedtuple('RoleSpec', ['name', 'class_name', 'attributes', 'input_table', 'rows', 'output_table',
+                                   'stores', 'subscriptions'])
+
+# A <Budget> of the definition. scope is 'run' or 'thread', limits left out are None and
+# prices are per 1000 tokens.
+BudgetSpec = namedtuple('BudgetSpec', ['scope', 'max_turns', 'max_tokens', 'max_seconds', 'max_spend',
+                                       'prompt_price', 'completion_price'])
+
+BUDGET_SCOPES = ('run', 'thread')
+
+# One entry of the ConvoLoop: the role that acts, and the roles of its branch (empty if none).
+Step = namedtuple('Step', ['role', 'branch'])
+
+
+class ConvoPlan:
+    """
+    Immutable, compiled form of a ConvoXML definition.
+
+    roles keeps the <Role> declarations in document order, role_index maps the
+    lower-cased role name to its RoleSpec, and steps is the flattened ConvoLoop
+    where each Step carries the branch table of the roles it can hand over to.
+    budgets holds the <Budget> declarations, at most one per scope.
+    Plans are compiled with a streaming parser and cached by the hash of the
+    XML, so the same definition is only parsed once per process, or once per
+    machine when a cache directory is used.
+    """
+
+    __slots__ = ('roles', 'steps', 'digest', 'budgets', '_role_index', '_role_attributes')
+
+    def __init__(self, roles, steps, digest, budgets=()):
+        object.__setattr__(self, 'roles', tuple(roles))
+        object.__setattr__(self, 'steps', tuple(steps))
+        object.__setattr__(self, 'digest', digest)
+        object.__setattr__(self, 'budgets', tuple(budgets))
+        object.__setattr__(self, '_role_index', {role.name.lower(): role for role in self.roles})
+        object.__setattr__(self, '_role_attributes', {role.name: MappingProxyType(dict(role.attributes))
+                                                      for role in self.roles})
+
+    def __setattr__(self, key, value):
+        raise AttributeError("ConvoPlan is immutable")
+
+    def __getstate__(self):
+        return (self.roles, self.steps, self.digest, self.budgets)
+
+    def __setstate__(self, state):
+        ConvoPlan.__init__(self, *state)
+
+    def as_dict(self):
+        """
+        The plan as JSON-compatible data, rebuilt by from_dict().
+        """
+        return {
+            'digest': self.digest,
+            'roles': [list(role) for role in self.roles],
+            'steps': [list(step) for step in self.steps],
+            'budgets': [list(budget) for budget in self.budgets],
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        def pairs(values):
+            return tuple(tuple(pair) for pair in values)
+
+        roles = []
+        for name, class_name, attributes, input_table, rows, output_table, stores, subscriptions in state['roles']:
+            roles.append(RoleSpec(name, class_name, pairs(attributes), input_table,
+                                  tuple(rows) if rows is not None else None, output_table, pairs(stores),
+                                  tuple(subscriptions)))
+        steps = [Step(role, tuple(branch)) for role, branch in state['steps']]
+        return cls(roles, steps, state['digest'], [BudgetSpec(*budget) for budget in state['budgets']])
+
+    def role(self, name):
+        return self._role_index.get(name.lower())
+
+    def role_attributes(self, name):
+        """
+        The XML attributes of a role as a read-only mapping, shared by every
+        agent created for the role.
+        """
+        return self._role_attributes[self.role(name).name]
+
+    def budget(self, scope):
+        """
+        The BudgetSpec declared for scope, or None.
+        """
+        for budget in self.budgets:
+            if budget.scope == scope:
+                return budget
+        return None
+
+    @property
+    def role_index(self):
+        return dict(self._role_index)
+
+    def tables(self):
+        tables = []
+        for role in self.roles:
+            for table in role.input_table.split(',') + [role.output_table]:
+                if table not in tables:
+                    tables.append(table)
+        return tables
+
+    def table_stores(self):
+        """
+        Maps each table declared with a store attribute to that store. A table
+        can only live in one store.
+        """
+        stores = {}
+        for role in self.roles:
+            for table, store in role.stores:
+                if stores.setdefault(table, store) != store:
+                    raise ValueError(f"Table {table!r} is declared with both store {stores[table]!r} and {store!r}")
+        return stores
+
+    @staticmethod
+    def hash(xml_string):
+        return hashlib.sha256(f"{PLAN_VERSION}:{xml_string}".encode('utf-8')).hexdigest()
+
+    @classmethod
+    def compile(cls, xml_string):
+        """
+        Parses the XML in a single streaming pass, without keeping a tree.
+        """
+        roles = []
+        steps = []
+        budgets = []
+        stack = []
+        # children of the ConvoLoop step that is currently open
+        branch = None
+        try:
+            for event, element in ET.iterparse(io.BytesIO(xml_string.encode('utf-8')), events=('start', 'end')):
+                tag = element.tag.lower()
+                if event == 'start':
+                    stack.append(tag)
+                    if len(stack) >= 2 and stack[-2] == 'convoloop':
+                        branch = []
+                    continue
+
+                stack.pop()
+                parent = stack[-1] if stack else None
+                if tag == 'role' and parent == 'roles':
+                    roles.append(cls.compile_role(element))
+                elif tag == 'budget' and len(stack) == 1:
+                    budgets.append(cls.compile_budget(element))
+                elif parent == 'convoloop':
+                    steps.append((element.tag, tuple(branch)))
+                    branch = None
+                elif branch is not None and len(stack) >= 2 and stack[-2] == 'convoloop':
+                    branch.append(element.get('role') if tag == 'case' else element.tag)
+
+                # nothing else needs the element once its end tag is seen
+                if parent in ('roles', 'convoloop') or tag in ('convoloop', 'budget'):
+                    element.clear()
+        except ET.ParseError as e:
+            raise ValueError(f"Invalid ConvoXML definition: {e}") from e
+
+        scopes = [budget.scope for budget in budgets]
+        for scope in set(scopes):
+            if scopes.count(scope) > 1:
+                raise ValueError(f"More than one <Budget> with scope {scope!r}")
+        index = {role.name.lower(): role for role in roles}
+
+        def resolve(name):
+            if not name or name.lower() not in index:
+                raise ValueError(f"ConvoLoop refers to undeclared role {name!r}")
+            return index[name.lower()].name
+
+        steps = [Step(resolve(role), tuple(resolve(name) for name in branch)) for role, branch in steps]
+        return cls(roles, steps, cls.hash(xml_string), budgets)
+
+    @staticmethod
+    def compile_role(element):
+        # attribute names are case-insensitive in ConvoXML
+        attributes = {key.lower(): value for key, value in element.attrib.items()}
+        if 'name' not in attributes:
+            raise ValueError("<Role> elements need a name attribute")
+        input_table = attributes.get('input_table', 'Messages')
+        output_table = attributes.get('output_table', 'Messages')
+        rows = None
+        stores = []
+        subscribe = True
+        for child in element:
+            tag = child.tag.lower()
+            if tag == 'input':
+                input_table = child.get('table', input_table)
+                if child.get('rows'):
+                    rows = tuple(int(value) for value in child.get('rows').split(','))
+                if child.get('store'):
+                    stores.extend((table.strip(), child.get('store').strip().lower()) for table in input_table.split(','))
+                # subscribe="false" reads the tables without being woken by them
+                subscribe = child.get('subscribe', 'true').strip().lower() not in ('false', '0', 'no', 'off')
+            elif tag == 'output':
+                output_table = child.get('table', output_table)
+                if child.get('store'):
+                    stores.append((output_table.strip(), child.get('store').strip().lower()))
+        class_name = attributes.get('class', '').split()
+        subscriptions = tuple(table.strip() for table in input_table.split(',')) if subscribe else ()
+        return RoleSpec(attributes['name'], class_name[0] if class_name else None,
+                        tuple(attributes.items()), input_table, rows, output_table, tuple(stores), subscriptions)
+
+    @staticmethod
+    def compile_budget(element):
+        attributes = {key.lower(): value for key, value in element.attrib.items()}
+        scope = attributes.get('scope', 'run').strip().lower()
+        if scope not in BUDGET_SCOPES:
+            raise ValueError(f"<Budget> scope must be 'run' or 'thread', not {scope!r}")
+
+        def number(name, convert=float):
+            value = attributes.get(name)
+            if value in (None, ''):
+                return None
+            try:
+                return convert(value)
+            except ValueError:
+                raise ValueError(f"<Budget> {name} must be a number, not {value!r}") from None
+
+        return BudgetSpec(scope, number('max_turns', int), number('max_tokens', int),
+                          number('max_seconds'), number('max_spend'),
+                          number('prompt_price') or 0.0, number('completion_price') or 0.0)
+
+
+_plans = {}
+_plans_lock = threading.Lock()
+
+
+def load_plan(xml_string, cache_dir=None):
+    """
+    Returns the compiled plan for xml_string. Plans are memoized in the process
+    and, when cache_dir is given, saved as JSON to `<cache_dir>/<sha256>.json`
+    so later runs of the same definition skip parsing. Cache files are only
+    read as data, so a file planted in the directory can't run code.
+    """
+    digest = ConvoPlan.hash(xml_string)
+    with _plans_lock:
+        plan = _plans.get(digest)
+    if plan is not None:
+        return plan
+
+    path = os.path.join(cache_dir, f"{digest}.json") if cache_dir else None
+    if path and os.path.exists(path):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                plan = ConvoPlan.from_dict(json.load(f))
+            if plan.digest != digest:
+                plan = None
+        except Exception:
+            plan = None
+
+    if plan is None:
+        plan = ConvoPlan.compile(xml_string)
+        if path:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                temp_path = f"{path}.{os.getpid()}.tmp"
+                with open(temp_path, 'w', encoding='utf-8') as f:
+                    json.dump(plan.as_dict(), f)
+                os.replace(temp_path, path)
+            except OSError:
+                # the cache is only an optimization
+                pass
+
+    with _plans_lock:
+        _plans[digest] = plan
+    return plan
@@ -0,0 +1,194 @@
+import asyncio
+import random
+import threading
+import time
+import weakref
+
+# responses worth retrying: timeouts, conflicts, rate limits and server errors
+RETRYABLE_STATUS = (408, 409, 429, 500, 502, 503, 504)
+# openai errors raised without a response
+RETRYABLE_ERRORS = ('APIConnectionError', 'APITimeoutError')
+
+
+class TokenBucket:
+    """
+    Token bucket limiting how many requests go out per second.
+
+    Callers reserve a token and sleep until it is due, so concurrent agents
+    queue up behind each other instead of all firing and getting 429s. A
+    rate limit response pauses the whole bucket with pause().
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens=1):
+        """
+        Takes tokens and returns how many seconds the caller has to wait for them.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= tokens
+            return max(0.0, -self.tokens / self.rate)
+
+    def acquire(self, tokens=1):
+        wait = self.reserve(tokens)
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    async def aacquire(self, tokens=1):
+        wait = self.reserve(tokens)
+        if wait:
+            await asyncio.sleep(wait)
+        return wait
+
+    def pause(self, seconds):
+        """
+        Holds back every caller for at least seconds, e.g. after a 429.
+        """
+        with self._lock:
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+    def set_rate(self, rate):
+        with self._lock:
+            self.rate = rate
+            self.capacity = max(1.0, rate)
+
+
+class ProviderClients:
+    """
+    Provider clients and rate limiters shared by every agent in the process.
+
+    Agents using the same API key and base URL share one client, and so one
+    pool of keep-alive connections. Async clients are kept per event loop,
+    since their connections can't outlive the loop that opened them. Rate
+    limiters are kept per API key and model.
+    """
+
+    def __init__(self):
+        self._clients = {}
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def openai(self, api_key=None, base_url=None):
+        key = (api_key, base_url)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                from .Agents import import_openai
+                # retries are done by call_with_retries, which knows about the rate limiter
+                client = self._clients[key] = import_openai().OpenAI(api_key=api_key, base_url=base_url, max_retries=0)
+            return client
+
+    def async_openai(self, api_key=None, base_url=None):
+        loop = asyncio.get_running_loop()
+        key = (api_key, base_url)
+        with self._lock:
+            clients = self._async_clients.setdefault(loop, {})
+            client = clients.get(key)
+            if client is None:
+                from .Agents import import_openai
+                client = clients[key] = import_openai().AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=0)
+            return client
+
+    def limiter(self, api_key, model, requests_per_minute=None):
+        """
+        Returns the rate limiter for api_key and model, or None when no rate
+        was ever configured for them. The last rate given wins.
+        """
+        key = (api_key, model)
+        with self._lock:
+            limiter = self._limiters.get(key)
+            if requests_per_minute:
+                rate = float(requests_per_minute) / 60
+                if limiter is None:
+                    limiter = self._limiters[key] = TokenBucket(rate)
+                elif limiter.rate != rate:
+                    limiter.set_rate(rate)
+            return limiter
+
+    def close(self):
+        with self._lock:
+            clients, self._clients = list(self._clients.values()), {}
+            self._limiters.clear()
+        for client in clients:
+            client.close()
+
+
+# shared by every agent in the process
+PROVIDER_CLIENTS = ProviderClients()
+
+
+def is_retryable(error):
+    status = getattr(error, 'status_code', None)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    return type(error).__name__ in RETRYABLE_ERRORS
+
+
+def retry_after(error):
+    """
+    Seconds asked for by the Retry-After header of a failed response, or None.
+    """
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_delay(error, attempt, backoff=0.5, max_backoff=30.0):
+    """
+    Exponential backoff with full jitter, or the server's Retry-After if it sent one.
+    """
+    delay = retry_after(error)
+    if delay is not None:
+        return min(delay, max_backoff)
+    return random.uniform(0, min(max_backoff, backoff * 2 ** attempt))
+
+
+def call_with_retries(call, limiter=None, retries=3, backoff=0.5, max_backoff=30.0, on_retry=None):
+    """
+    Calls call() once the limiter allows it, retrying retryable errors up to
+    retries times. on_retry(error, delay) is called before each retry.
+    """
+    for attempt in range(retries + 1):
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            return call()
+        except Exception as error:
+            if attempt == retries or not is_retryable(error):
+                raise
+            delay = retry_delay(error, attempt, backoff, max_backoff)
+            if limiter is not None and getattr(error, 'status_code', None) == 429:
+                limiter.pause(delay)
+            if on_retry is not None:
+                on_retry(error, delay)
+            time.sleep(delay)
+
+
+async def acall_with_retries(call, limiter=None, retries=3, backoff=0.5, max_backoff=30.0, on_retry=None):
+    for attempt in range(retries + 1):
+        if limiter is not None:
+            await limiter.aacquire()
+        try:
+            return await call()
+        except Exception as error:
+            if attempt == retries or not is_retryable(error):
+                raise
+            delay = retry_delay(error, attempt, backoff, max_backoff)
+            if limiter is not None and getattr(error, 'status_code', None) == 429:
+                limiter.pause(delay)
+            if on_retry is not None:
+                on_retry(error, delay)
+            await asyncio.sleep(delay)
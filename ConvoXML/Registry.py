@@ -0,0 +1,88 @@
+import importlib
+from collections.abc import MutableMapping
+
+# agent classes that ship with ConvoXML, imported the first time a role uses them
+BUILTIN_AGENTS = {
+    'TestAgent': 'ConvoXML.Agents:TestAgent',
+    'TestModerator': 'ConvoXML.Agents:TestModerator',
+    'PalmAgent': 'ConvoXML.Agents:PalmAgent',
+    'PalmDeveloper': 'ConvoXML.Agents:PalmDeveloper',
+    'OpenAIAgent': 'ConvoXML.Agents:OpenAIAgent',
+    'OpenAIDeveloper': 'ConvoXML.Agents:OpenAIDeveloper',
+    'SubprocessAgent': 'ConvoXML.Agents:SubprocessAgent',
+}
+
+# installed packages can add agent classes under this entry point group, e.g.
+#   [project.entry-points."convoxml.agents"]
+#   MyAgent = "my_package.agents:MyAgent"
+ENTRY_POINT_GROUP = 'convoxml.agents'
+
+
+def load_reference(reference):
+    """
+    Imports a 'module:attribute' reference and returns the attribute.
+    """
+    module_name, _, attribute = reference.partition(':')
+    return getattr(importlib.import_module(module_name), attribute)
+
+
+class AgentRegistry(MutableMapping):
+    """
+    Maps class names used in <Role class="..."> to agent classes.
+
+    Entries can be classes or 'module:attribute' references. References are
+    imported on first lookup, and names that are not registered are looked up
+    in the `convoxml.agents` entry points, so provider SDKs are only imported
+    by runs that actually use them.
+    """
+
+    def __init__(self, entries=None, entry_point_group=ENTRY_POINT_GROUP):
+        self._entries = dict(entries or {})
+        self.entry_point_group = entry_point_group
+        self._entry_points = None
+
+    def __getitem__(self, name):
+        entry = self._entries.get(name)
+        if entry is None:
+            entry = self.entry_points().get(name)
+            if entry is None:
+                raise KeyError(name)
+        if isinstance(entry, str):
+            entry = load_reference(entry)
+            self._entries[name] = entry
+        elif hasattr(entry, 'load') and not isinstance(entry, type):
+            entry = entry.load()
+            self._entries[name] = entry
+        return entry
+
+    def __setitem__(self, name, agent_class):
+        self._entries[name] = agent_class
+
+    def __delitem__(self, name):
+        del self._entries[name]
+
+    def __contains__(self, name):
+        return name in self._entries or name in self.entry_points()
+
+    def __iter__(self):
+        names = list(self._entries)
+        names.extend(name for name in self.entry_points() if name not in self._entries)
+        return iter(names)
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def entry_points(self):
+        if self._entry_points is None:
+            from importlib.metadata import entry_points
+            try:
+                found = entry_points(group=self.entry_point_group)
+            except TypeError:
+                # Python < 3.10
+                found = entry_points().get(self.entry_point_group, [])
+            self._entry_points = {entry_point.name: entry_point for entry_point in found}
+        return self._entry_points
+
+    def register(self, agent_class, name=None):
+        self._entries[name or agent_class.__name__] = agent_class
+        return agent_class
@@ -0,0 +1,142 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class RequestBatcher:
+    """
+    Coalesces concurrent model requests into batches.
+
+    Requests submitted from any thread or event loop are collected for up
+    to `window` seconds, or until `max_batch` are waiting, and handed to
+    submit_batch(requests), which returns one result per request in the
+    same order. Each caller gets its own result back; a failed batch fails
+    every request in it. Up to `max_inflight` batches are in flight at once.
+
+    Example Usage:
+        batcher = RequestBatcher(lambda prompts: [p.upper() for p in prompts], window=0.01)
+        batcher.submit('hello')   # 'HELLO'
+    """
+
+    def __init__(self, submit_batch, window=0.005, max_batch=32, max_inflight=4):
+        self.submit_batch = submit_batch
+        self.window = window
+        self.max_batch = max_batch
+        self.batches = 0
+        self.requests = 0
+        self._pending = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._executor = ThreadPoolExecutor(max_inflight, thread_name_prefix='convoxml-batch')
+        self._thread = threading.Thread(target=self._run, name='convoxml-batcher', daemon=True)
+        self._thread.start()
+
+    def submit_future(self, request):
+        if self._closed:
+            raise RuntimeError("Cannot submit to a closed RequestBatcher")
+        future = Future()
+        with self._lock:
+            self._pending.append((request, future))
+        self._wakeup.set()
+        return future
+
+    def submit(self, request, timeout=None):
+        return self.submit_future(request).result(timeout)
+
+    @property
+    def mean_batch_size(self):
+        return self.requests / self.batches if self.batches else 0.0
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            # give concurrent callers the rest of the window to join the batch
+            deadline = time.monotonic() + self.window
+            while time.monotonic() < deadline:
+                with self._lock:
+                    if len(self._pending) >= self.max_batch:
+                        break
+                time.sleep(min(self.window / 4, max(0.0, deadline - time.monotonic())))
+            self._dispatch()
+
+    def _dispatch(self):
+        while True:
+            with self._lock:
+                batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+                if batch:
+                    self.batches += 1
+                    self.requests += len(batch)
+            if not batch:
+                return
+            self._executor.submit(self._submit, batch)
+
+    def _submit(self, batch):
+        requests = [request for request, _ in batch]
+        try:
+            results = self.submit_batch(requests)
+            if len(results) != len(batch):
+                raise RuntimeError(f"batch of {len(batch)} requests returned {len(results)} results")
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join()
+        self._dispatch()
+        self._executor.shutdown(wait=True)
+
+
+class BatchRequestError(Exception):
+    """
+    Error returned for one request of a batch.
+    """
+
+
+def openai_batch_submitter(client, endpoint, call=None):
+    """
+    Returns submit_batch for a RequestBatcher that posts chat completion
+    requests to a batch endpoint of an OpenAI compatible server:
+
+        POST {base_url}{endpoint}  {"requests": [{"model": ..., "messages": [...]}, ...]}
+        ->  {"responses": [<chat.completion or {"error": ...}>, ...]}
+
+    call(fn) wraps the HTTP call, e.g. with rate limiting and retries.
+    """
+    from openai.types.chat import ChatCompletion
+
+    def submit_batch(requests):
+        post = lambda: client.post(endpoint, cast_to=object, body={'requests': requests})
+        body = call(post) if call is not None else post()
+        return [BatchRequestError(str(response['error'])) if 'error' in response
+                else ChatCompletion.model_validate(response)
+                for response in body['responses']]
+
+    return submit_batch
+
+
+_batchers = {}
+_batchers_lock = threading.Lock()
+
+
+def get_request_batcher(key, make_submit_batch, window=0.005, max_batch=32):
+    """
+    Returns the batcher shared by every agent that uses key, e.g. an API
+    key, base URL and batch endpoint, creating it with make_submit_batch().
+    """
+    with _batchers_lock:
+        batcher = _batchers.get(key)
+        if batcher is None:
+            batcher = _batchers[key] = RequestBatcher(make_submit_batch(), window=window, max_batch=max_batch)
+        return batcher
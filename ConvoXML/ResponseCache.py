@@ -0,0 +1,157 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from .Connections import ConnectionManager
+
+TRUE_VALUES = ('1', 'true', 'yes', 'on')
+
+
+class ResponseCache:
+    """
+    Content-addressed cache of model responses.
+
+    Responses are keyed by the hash of the model name and the formatted
+    messages sent to it (system prompt included), so replaying a simulation
+    with the same inputs skips the provider call. Entries live in an
+    in-memory LRU of `max_entries` and, when `path` is given, in a SQLite
+    table that survives restarts. `ttl` is the lifetime of an entry in
+    seconds, None keeps entries forever.
+
+    Enabled per role in the XML:
+        <Role name="Critic" class="OpenAIAgent" response_cache="true"
+              response_cache_ttl="3600" response_cache_path="responses.db"/>
+    """
+
+    def __init__(self, path=None, max_entries=1024, ttl=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self.connections = None
+        if path:
+            self.connections = ConnectionManager(path)
+            self.connections.execute('''
+                CREATE TABLE IF NOT EXISTS ResponseCache (
+                    key TEXT PRIMARY KEY,
+                    response TEXT,
+                    created REAL,
+                    expires REAL
+                )
+            ''', commit=True)
+
+    @staticmethod
+    def key(model, messages):
+        payload = json.dumps([model, messages], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                response, expires = entry
+                if expires is None or expires > now:
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return response
+                del self._memory[key]
+
+        if self.connections is not None:
+            row = self.connections.execute("SELECT response, expires FROM ResponseCache WHERE key = ?", (key,)).fetchone()
+            if row is not None and (row[1] is None or row[1] > now):
+                with self._lock:
+                    self.hits += 1
+                    self.disk_hits += 1
+                    self._remember(key, row[0], row[1])
+                return row[0]
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, key, response, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        now = time.time()
+        expires = now + ttl if ttl else None
+        with self._lock:
+            self._remember(key, response, expires)
+        if self.connections is not None:
+            self.connections.execute("INSERT OR REPLACE INTO ResponseCache (key, response, created, expires) VALUES (?, ?, ?, ?)",
+                                     (key, response, now, expires), commit=True)
+
+    def _remember(self, key, response, expires):
+        self._memory[key] = (response, expires)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def purge_expired(self):
+        now = time.time()
+        with self._lock:
+            for key in [key for key, (_, expires) in self._memory.items() if expires is not None and expires <= now]:
+                del self._memory[key]
+        if self.connections is not None:
+            self.connections.execute("DELETE FROM ResponseCache WHERE expires IS NOT NULL AND expires <= ?", (now,), commit=True)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+        if self.connections is not None:
+            self.connections.execute("DELETE FROM ResponseCache", commit=True)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'disk_hits': self.disk_hits,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': len(self._memory),
+            }
+
+    def close(self):
+        if self.connections is not None:
+            self.connections.close()
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_response_cache(path=None, max_entries=1024, ttl=None):
+    """
+    Returns the shared cache for path (None for memory only), so roles and
+    conversations that use the same cache settings share their entries.
+    """
+    key = (path, max_entries, ttl)
+    with _caches_lock:
+        cache = _caches.get(key)
+        if cache is None:
+            cache = _caches[key] = ResponseCache(path, max_entries=max_entries, ttl=ttl)
+        return cache
+
+
+def response_cache_from_params(params):
+    """
+    Builds the cache configured by the response_cache, response_cache_ttl,
+    response_cache_path and response_cache_size attributes of a <Role>, or
+    returns None when caching is off.
+    """
+    enabled = params.get('response_cache')
+    if isinstance(enabled, ResponseCache):
+        return enabled
+    if isinstance(enabled, str):
+        enabled = enabled.strip().lower() in TRUE_VALUES
+    if not enabled:
+        return None
+    ttl = params.get('response_cache_ttl')
+    return get_response_cache(params.get('response_cache_path') or None,
+                              max_entries=int(params.get('response_cache_size', 1024)),
+                              ttl=float(ttl) if ttl not in (None, '') else None)
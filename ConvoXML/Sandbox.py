@@ -0,0 +1,356 @@
+import atexit
+import builtins
+import io
+import os
+import pickle
+import queue
+import selectors
+import signal
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# status is 'ok', 'error' or 'timeout'; elapsed is the execution time in seconds
+BlockResult = namedtuple('BlockResult', ['kind', 'status', 'output', 'elapsed', 'truncated'])
+
+# extra time a worker gets to report its own timeout before it is killed
+KILL_GRACE = 1.0
+
+# the worker's task and result pipes, closed in the children that run blocks
+_PROTOCOL_FDS = []
+
+
+def _set_memory_limit(limit):
+    if resource is None:
+        return
+    _, hard = resource.getrlimit(resource.RLIMIT_AS)
+    if limit and hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (limit or hard, hard))
+
+
+def _truncate(text, limit):
+    if limit is not None and len(text) > limit:
+        return text[:limit], True
+    return text, False
+
+
+def _exit_code(error):
+    if error.code is None or isinstance(error.code, int):
+        return error.code or 0
+    print(error.code, file=sys.stderr)
+    return 1
+
+
+def _run_block(kind, code, cwd, memory_limit):
+    """
+    Body of the child forked for one block, which never returns. The child
+    leads its own process group so the worker can kill whatever it starts.
+    """
+    status = 1
+    try:
+        os.setsid()
+        os.chdir(cwd)
+        _set_memory_limit(memory_limit)
+        if kind == 'terminal':
+            os.execv('/bin/sh', ['/bin/sh', '-c', code])
+        try:
+            exec(compile(code, '<python>', 'exec'), {'__name__': '__main__', '__builtins__': builtins})
+            status = 0
+        except SystemExit as e:
+            status = _exit_code(e)
+        except BaseException as e:
+            # leave this function's frame out of the traceback
+            traceback.print_exception(type(e), e, e.__traceback__.tb_next)
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        for stream in (sys.stdout, sys.stderr):
+            try:
+                stream.flush()
+            except BaseException:
+                pass
+        os._exit(status)
+
+
+def _kill_group(pid):
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def _read_output(pipes, pid, timeout, output_limit):
+    """
+    Reads the child's stdout and stderr pipes until both are closed and the
+    child has exited, killing its process group once the child exits, so
+    processes it left behind don't hold the pipes open, or when it times out.
+    Returns the exit code, or None after a timeout, and the two outputs.
+    """
+    # enough bytes for output_limit characters of UTF-8
+    cap = None if output_limit is None else output_limit * 4
+    outputs = {fd: bytearray() for fd in pipes}
+    overflow = False
+    deadline = time.monotonic() + timeout if timeout else None
+    exit_code = timed_out = None
+    with selectors.DefaultSelector() as selector:
+        for fd in pipes:
+            selector.register(fd, selectors.EVENT_READ)
+        while selector.get_map() or (exit_code is None and not timed_out):
+            if exit_code is None and not timed_out:
+                waited, wait_status = os.waitpid(pid, os.WNOHANG)
+                if waited:
+                    exit_code = os.waitstatus_to_exitcode(wait_status)
+                    _kill_group(pid)
+                elif deadline is not None and time.monotonic() >= deadline:
+                    timed_out = True
+                    _kill_group(pid)
+            if not selector.get_map():
+                time.sleep(0.005)
+                continue
+            for key, _ in selector.select(0.05):
+                chunk = os.read(key.fd, 65536)
+                if not chunk:
+                    selector.unregister(key.fd)
+                    continue
+                buffer = outputs[key.fd]
+                if cap is not None and len(buffer) + len(chunk) > cap:
+                    overflow = True
+                    chunk = chunk[:max(cap - len(buffer), 0)]
+                buffer += chunk
+    if timed_out:
+        os.waitpid(pid, 0)
+    texts = [outputs[fd].decode('utf-8', 'replace') for fd in pipes]
+    return (None if timed_out else exit_code), texts, overflow
+
+
+def _run_forked(kind, code, cwd, timeout, memory_limit, output_limit):
+    """
+    Runs a block in a child forked from the worker, so blocks never share
+    modules, environment variables or threads. fd 1 and 2 of the child are
+    pipes, which also capture the output of the processes it starts.
+    """
+    stdout_read, stdout_write = os.pipe()
+    stderr_read, stderr_write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(stdout_read)
+        os.close(stderr_read)
+        os.dup2(stdout_write, 1)
+        os.dup2(stderr_write, 2)
+        for fd in _PROTOCOL_FDS + [stdout_write, stderr_write]:
+            os.close(fd)
+        _run_block(kind, code, cwd, memory_limit)
+    os.close(stdout_write)
+    os.close(stderr_write)
+    try:
+        exit_code, (stdout, stderr), overflow = _read_output((stdout_read, stderr_read), pid, timeout, output_limit)
+    finally:
+        os.close(stdout_read)
+        os.close(stderr_read)
+    if exit_code is None:
+        return 'timeout', f"timed out after {timeout}s", False
+    if exit_code == 0:
+        output, truncated = _truncate(stdout, output_limit)
+        return 'ok', output, truncated or overflow
+    output, truncated = _truncate(stderr or stdout, output_limit)
+    return 'error', output, truncated or overflow
+
+
+def _run_process(kind, code, cwd, timeout, output_limit):
+    """
+    Fallback for platforms without fork: every block gets a fresh interpreter or shell.
+    """
+    command = [sys.executable, '-c', code] if kind == 'python' else code
+    try:
+        completed = subprocess.run(command, shell=kind != 'python', capture_output=True, text=True,
+                                   stdin=subprocess.DEVNULL, timeout=timeout, cwd=cwd)
+    except subprocess.TimeoutExpired:
+        return 'timeout', f"timed out after {timeout}s", False
+    if completed.returncode == 0:
+        return ('ok',) + _truncate(completed.stdout, output_limit)
+    return ('error',) + _truncate(completed.stderr or completed.stdout, output_limit)
+
+
+def _run_task(kind, code, cwd, timeout, memory_limit, output_limit):
+    started = time.perf_counter()
+    if hasattr(os, 'fork'):
+        status, output, truncated = _run_forked(kind, code, cwd, timeout, memory_limit, output_limit)
+    else:
+        status, output, truncated = _run_process(kind, code, cwd, timeout, output_limit)
+    return status, output, truncated, time.perf_counter() - started
+
+
+def serve():
+    """
+    Worker loop: runs the blocks sent by the pool one at a time, each in a
+    child forked from this warm interpreter. Tasks and results are pickled
+    over the worker's stdin and stdout, which are then pointed at /dev/null
+    so the blocks can't write into the protocol.
+    """
+    tasks = os.fdopen(os.dup(0), 'rb')
+    results = os.fdopen(os.dup(1), 'wb')
+    _PROTOCOL_FDS[:] = [tasks.fileno(), results.fileno()]
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 0)
+    os.dup2(devnull, 1)
+    sys.stdin = io.StringIO()
+    while True:
+        try:
+            task = pickle.load(tasks)
+        except (EOFError, KeyboardInterrupt):
+            return
+        pickle.dump(_run_task(*task), results)
+        results.flush()
+
+
+# the directory containing the ConvoXML package, so workers can import it
+PACKAGE_PARENT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKER_COMMAND = f"import sys; sys.path.insert(0, {PACKAGE_PARENT!r}); from ConvoXML.Sandbox import serve; serve()"
+
+
+class _Worker:
+    def __init__(self):
+        self.process = subprocess.Popen([sys.executable, '-c', WORKER_COMMAND],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.timed_out = False
+
+    def run(self, task, timeout):
+        timer = threading.Timer(timeout, self._expire) if timeout else None
+        if timer is not None:
+            timer.start()
+        try:
+            pickle.dump(task, self.process.stdin)
+            self.process.stdin.flush()
+            result = pickle.load(self.process.stdout)
+        except (EOFError, OSError, pickle.UnpicklingError):
+            if self.timed_out:
+                raise TimeoutError()
+            raise EOFError()
+        finally:
+            if timer is not None:
+                timer.cancel()
+        return result
+
+    def _expire(self):
+        self.timed_out = True
+        self.process.kill()
+
+    def kill(self):
+        self.process.kill()
+        self.process.wait()
+        self.process.stdin.close()
+        self.process.stdout.close()
+
+
+class SandboxPool:
+    """
+    Pool of pre-started interpreters that run <python> and <terminal> blocks.
+
+    Workers are started once and reused, so a block doesn't pay for a new
+    interpreter, and independent blocks run concurrently. Workers are plain
+    `python -c` processes rather than multiprocessing children, which would
+    re-run the caller's unguarded __main__ script. Every block runs in its
+    own child forked from a worker, a Python block in the already started
+    interpreter and a terminal block in a shell, so blocks can't see each
+    other's modules, environment or threads, and output written by any
+    process the block starts is captured from fd 1 and 2. Each
+    block is limited to `timeout` seconds, `memory_limit` bytes of address
+    space (where the resource module is available) and `output_limit`
+    characters of output. A worker that hangs or dies is replaced.
+
+    Example Usage:
+        with SandboxPool(workers=4, timeout=10) as pool:
+            results = pool.run_many([('python', 'print(1)'), ('terminal', 'ls')])
+    """
+
+    def __init__(self, workers=4, timeout=30.0, memory_limit=512 * 1024 * 1024, output_limit=64 * 1024):
+        self.workers = workers
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.output_limit = output_limit
+        self._idle = queue.LifoQueue()
+        self._all = []
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix='convoxml-sandbox')
+        for _ in range(workers):
+            self._idle.put(self._start_worker())
+
+    def _start_worker(self):
+        worker = _Worker()
+        with self._lock:
+            self._all.append(worker)
+        return worker
+
+    def _kill_worker(self, worker):
+        with self._lock:
+            self._all.remove(worker)
+        worker.kill()
+
+    def run(self, kind, code, timeout=None, memory_limit=None, output_limit=None):
+        timeout = self.timeout if timeout is None else timeout
+        memory_limit = self.memory_limit if memory_limit is None else memory_limit
+        output_limit = self.output_limit if output_limit is None else output_limit
+        task = (kind, code, os.getcwd(), timeout, memory_limit, output_limit)
+        worker = self._idle.get()
+        started = time.perf_counter()
+        try:
+            status, output, truncated, elapsed = worker.run(task, timeout + KILL_GRACE if timeout else None)
+        except TimeoutError:
+            self._kill_worker(worker)
+            worker = self._start_worker()
+            status, output, truncated, elapsed = 'timeout', f"timed out after {timeout}s", False, time.perf_counter() - started
+        except (EOFError, OSError):
+            self._kill_worker(worker)
+            worker = self._start_worker()
+            status, output, truncated, elapsed = 'error', 'sandbox worker exited', False, time.perf_counter() - started
+        finally:
+            self._idle.put(worker)
+        return BlockResult(kind, status, output, elapsed, truncated)
+
+    def run_many(self, blocks, **limits):
+        """
+        Runs (kind, code) blocks concurrently and returns their results in order.
+        """
+        futures = [self._executor.submit(self.run, kind, code, **limits) for kind, code in blocks]
+        return [future.result() for future in futures]
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            workers, self._all = self._all, []
+        for worker in workers:
+            worker.kill()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_sandbox_pool():
+    """
+    Returns the process-wide pool shared by the developer agents, starting it
+    on first use with CONVOXML_SANDBOX_WORKERS workers (default: up to 4).
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            workers = int(os.environ.get('CONVOXML_SANDBOX_WORKERS', min(4, os.cpu_count() or 1)))
+            _pool = SandboxPool(workers=workers)
+            atexit.register(_pool.close)
+        return _pool
@@ -0,0 +1,280 @@
+import asyncio
+import threading
+from .Budget import BudgetExceeded
+
+
+class ConvoScheduler:
+    """
+    Runs one conversation as a state machine over the steps of its ConvoLoop.
+
+    Each step is an agent plus a dispatch table from the lower-cased role
+    names of its branch to their agents, so the role an agent returns
+    selects the branch member with one lookup. A string selects one member,
+    a list or tuple of roles selects several. Steps run in ConvoLoop order,
+    but only when they are ready: every step is ready at the start, and
+    afterwards when the MessageBus delivers a message for one of the input
+    tables it subscribes to on its thread, written by another agent or from
+    outside the conversation. Branch members run when they are selected. When no step is ready
+    the scheduler idles for up to `idle_timeout` seconds, waiting for post()
+    to wake a role, and otherwise ends the run instead of spinning. Runs also
+    end once an agent sets context.exit, at the end of that pass. When a
+    budget runs out (see BudgetGovernor), the steps of the thread it covers
+    stop running, and all of them do when it was the budget of the run.
+    With a Checkpointer the scheduler saves its state after every turn that
+    is due for a checkpoint: the position in the current pass, the ready
+    steps and the branch members selected but not yet run. restore() picks
+    a run up from such a state.
+
+    Example Usage:
+        scheduler = ConvoScheduler(parser, idle_timeout=5)
+        threading.Timer(1, scheduler.post, ['Moderator']).start()
+        scheduler.run()
+    """
+
+    def __init__(self, conversation, idle_timeout=0.0, checkpointer=None):
+        self.conversation = conversation
+        self.idle_timeout = idle_timeout
+        self.budget = conversation.budget
+        self.checkpointer = checkpointer
+        self.steps = []
+        for step in conversation.plan.steps:
+            agent = conversation.get_agent_by_role(step.role)
+            dispatch = {role.lower(): conversation.get_agent_by_role(role) for role in step.branch}
+            self.steps.append((agent, dispatch))
+        # steps woken by new messages in each (table, thread_id), see <input subscribe="...">
+        self.readers = {}
+        for index, (agent, _) in enumerate(self.steps):
+            for table in (agent.spec.subscriptions if agent.spec is not None else agent.input_table):
+                self.readers.setdefault((table, agent.thread_id), []).append(index)
+        self.ready = set(range(len(self.steps)))
+        # the next step of the current pass, and the selected branch members left to run by step
+        self.cursor = 0
+        self.pending = {}
+        self._posted = set()
+        self._wakeup = threading.Condition()
+        # the thread that runs the steps, the only one that touches ready
+        self._owner = None
+        self._subscriptions = []
+
+    def state(self, finished=False):
+        """
+        The scheduler's part of a checkpoint, together with the conversation's.
+        """
+        state = self.conversation.checkpoint_state()
+        state.update({
+            'cursor': self.cursor,
+            'ready': sorted(self.ready),
+            'pending': {str(index): [agent.role for agent in members] for index, members in self.pending.items() if members},
+            'finished': finished,
+        })
+        return state
+
+    def restore(self, state):
+        self.cursor = state['cursor']
+        self.ready = set(state['ready'])
+        self.pending = {int(index): [self.conversation.get_agent_by_role(role) for role in roles]
+                        for index, roles in state['pending'].items()}
+
+    def checkpoint(self, finished=False):
+        if self.checkpointer is not None:
+            self.checkpointer.save(self.state(finished), force=finished)
+
+    def select(self, dispatch, result):
+        """
+        The branch members chosen by result, a role name or a list of them.
+        """
+        names = [result] if isinstance(result, str) else result if isinstance(result, (list, tuple)) else ()
+        selected = []
+        for name in names:
+            agent = dispatch.get(str(name).strip().lower())
+            if agent is not None:
+                selected.append(agent)
+        return selected
+
+    def post(self, role):
+        """
+        Wakes the steps of role, e.g. after a message for it arrived from
+        outside the conversation. Safe to call from any thread.
+        """
+        indexes = {index for index, (agent, _) in enumerate(self.steps) if agent.role.lower() == role.lower()}
+        with self._wakeup:
+            self._posted |= indexes
+            self._wakeup.notify_all()
+
+    def subscribe(self):
+        self._owner = threading.get_ident()
+        bus = self.conversation.bus
+        self._subscriptions = [bus.subscribe(table, thread_id, self.delivered) for table, thread_id in self.readers]
+
+    def unsubscribe(self):
+        for token in self._subscriptions:
+            self.conversation.bus.unsubscribe(token)
+        self._subscriptions = []
+
+    def delivered(self, message):
+        """
+        Bus callback: marks the steps subscribed to the table and thread of
+        message as ready, except the step of its sender.
+        """
+        indexes = [index for index in self.readers.get((message.table, message.thread_id), ())
+                   if self.steps[index][0].role != message.sender]
+        if not indexes or self.budget.stopped(message.thread_id) is not None:
+            return
+        if threading.get_ident() == self._owner:
+            self.ready.update(indexes)
+            return
+        with self._wakeup:
+            self._posted.update(indexes)
+            self._wakeup.notify_all()
+
+    def collect(self):
+        """
+        Moves the steps woken from other threads into ready.
+        """
+        if self._posted:
+            with self._wakeup:
+                posted, self._posted = self._posted, set()
+            self.ready |= posted
+
+    def idle(self):
+        """
+        Waits up to idle_timeout for post() and returns whether a step became ready.
+        """
+        with self._wakeup:
+            if not self._posted and self.idle_timeout:
+                with self.conversation.instrumentation.timer('run.idle'):
+                    self._wakeup.wait(self.idle_timeout)
+            posted, self._posted = self._posted, set()
+        self.ready |= posted
+        return bool(posted)
+
+    def run_agent(self, agent):
+        self.budget.check(agent.thread_id)
+        result = self.conversation.execute_agent(agent)
+        self.budget.charge_turn(agent.thread_id)
+        return result
+
+    def execute(self, index):
+        agent, dispatch = self.steps[index]
+        self.ready.discard(index)
+        self.cursor = index + 1
+        try:
+            result = self.run_agent(agent)
+            if dispatch and result is not None:
+                self.pending[index] = self.select(dispatch, result)
+            self.checkpoint()
+            self.run_pending(index)
+        except BudgetExceeded:
+            # the thread stays stopped: its steps are no longer woken
+            self.pending.pop(index, None)
+
+    def run_pending(self, index):
+        members = self.pending.get(index, [])
+        while members:
+            self.run_agent(members[0])
+            members.pop(0)
+            self.checkpoint()
+        self.pending.pop(index, None)
+
+    def run(self):
+        self.subscribe()
+        try:
+            self._run()
+        finally:
+            self.unsubscribe()
+        self.checkpoint(finished=True)
+
+    def _run(self):
+        context = self.conversation.context
+        context.exit = False
+        # branch members a restored run still owes
+        for index in list(self.pending):
+            try:
+                self.run_pending(index)
+            except BudgetExceeded:
+                self.pending.pop(index, None)
+        while not context.exit and self.budget.stopped() is None:
+            self.collect()
+            with self.conversation.instrumentation.timer('run.iteration'):
+                for index in range(self.cursor, len(self.steps)):
+                    if index in self.ready:
+                        self.execute(index)
+            self.cursor = 0
+            if not self.ready and not self.idle():
+                return
+
+    async def arun_agent(self, agent, semaphore):
+        result = await self.budget.guard(agent.thread_id, self.conversation.aexecute_agent(agent, semaphore))
+        self.budget.charge_turn(agent.thread_id)
+        return result
+
+    async def aexecute(self, index, semaphore):
+        agent, dispatch = self.steps[index]
+        self.ready.discard(index)
+        try:
+            result = await self.arun_agent(agent, semaphore)
+            if dispatch and result is not None:
+                self.pending[index] = self.select(dispatch, result)
+            self.checkpoint()
+            await self.arun_pending(index, semaphore)
+        except BudgetExceeded:
+            self.pending.pop(index, None)
+
+    async def arun_pending(self, index, semaphore):
+        async def run_member(member):
+            await self.arun_agent(member, semaphore)
+            self.pending[index].remove(member)
+            self.checkpoint()
+
+        results = await asyncio.gather(*(run_member(member) for member in list(self.pending.get(index, ()))),
+                                       return_exceptions=True)
+        self.pending.pop(index, None)
+        # the members that were stopped by a budget have been cancelled, other errors propagate
+        for error in results:
+            if isinstance(error, BaseException):
+                raise error
+
+    async def arun_thread(self, indexes, semaphore):
+        ran = False
+        for index in indexes:
+            if index in self.ready:
+                await self.aexecute(index, semaphore)
+                ran = True
+        return ran
+
+    async def arun(self, concurrency=8):
+        """
+        Async version of run. Steps of different threads never read each
+        other's messages, so each thread's steps run concurrently with the
+        others, and so do the branch members selected together.
+        """
+        self.subscribe()
+        try:
+            await self._arun(asyncio.Semaphore(concurrency))
+        finally:
+            self.unsubscribe()
+        self.checkpoint(finished=True)
+
+    async def _arun(self, semaphore):
+        threads = {}
+        for index, (agent, _) in enumerate(self.steps):
+            threads.setdefault(agent.thread_id, []).append(index)
+        context = self.conversation.context
+        context.exit = False
+        # threads run side by side, so a restored run starts its pass over and only owes the pending members
+        self.cursor = 0
+        for index in list(self.pending):
+            try:
+                await self.arun_pending(index, semaphore)
+            except BudgetExceeded:
+                pass
+        while not context.exit and self.budget.stopped() is None:
+            # blocking agents publish from worker threads
+            self.collect()
+            with self.conversation.instrumentation.timer('run.iteration'):
+                ran = await asyncio.gather(*(self.arun_thread(indexes, semaphore) for indexes in threads.values()))
+            if any(ran):
+                continue
+            # only hand the wait to a thread when there is something to wait for
+            if not (await asyncio.to_thread(self.idle) if self.idle_timeout else self.idle()):
+                return
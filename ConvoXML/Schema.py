@@ -0,0 +1,157 @@
+"""
+The single definition of the message tables used by agents, the parser and
+ChatMessages, plus the migrations that bring older databases up to date.
+
+Every message table (Messages and any table named by an <input>/<output>
+element) has the same columns. message_id is the monotonic sequence: new
+tables declare it AUTOINCREMENT so ids are never reused, and together with
+the (thread_id, message_id) index "latest N messages of a thread" is an
+index seek instead of a table scan.
+
+Checkpoints holds the latest saved state of each checkpointed run, see
+Checkpoint.
+"""
+import re
+
+SCHEMA_VERSION = 2
+
+MESSAGE_COLUMNS = ('message_id', 'thread_id', 'timestamp', 'sender', 'content',
+                   'agent_name', 'participants', 'agents')
+
+# select list that returns rows in MESSAGE_COLUMNS order, also for upgraded tables
+MESSAGE_SELECT = ', '.join(MESSAGE_COLUMNS)
+
+MESSAGE_ID = MESSAGE_COLUMNS.index('message_id')
+SENDER = MESSAGE_COLUMNS.index('sender')
+CONTENT = MESSAGE_COLUMNS.index('content')
+
+# columns that older databases may be missing, with their declared types
+_ADDED_COLUMNS = (
+    ('timestamp', 'DATETIME'),
+    ('sender', 'TEXT'),
+    ('agent_name', 'TEXT'),
+    ('participants', 'TEXT'),
+    ('agents', 'TEXT'),
+)
+
+_IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+def check_table_name(table):
+    """
+    Table names are interpolated into SQL, so only plain identifiers are allowed.
+    """
+    table = table.strip()
+    if not _IDENTIFIER.match(table):
+        raise ValueError(f"Invalid table name: {table!r}")
+    return table
+
+
+def table_exists(connection, table):
+    row = connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                             (table,)).fetchone()
+    return row is not None
+
+
+def table_columns(connection, table):
+    return [row[1] for row in connection.execute(f"PRAGMA table_info({table})")]
+
+
+def create_message_table(connection, table):
+    connection.execute(f'''
+        CREATE TABLE IF NOT EXISTS {table} (
+            message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            thread_id TEXT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            sender TEXT,
+            content TEXT,
+            agent_name TEXT,
+            participants TEXT,
+            agents TEXT
+        )
+    ''')
+
+
+def create_message_indexes(connection, table):
+    connection.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_thread_timestamp ON {table} (thread_id, timestamp)")
+    connection.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_thread_message ON {table} (thread_id, message_id)")
+
+
+def upgrade_message_table(connection, table):
+    """
+    Adds the columns missing from tables created by older versions. The parser
+    used to store the sender in a sender_id column, which is copied into sender.
+    """
+    columns = table_columns(connection, table)
+    for column, column_type in _ADDED_COLUMNS:
+        if column not in columns:
+            connection.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+    if 'sender_id' in columns and 'sender' not in columns:
+        connection.execute(f"UPDATE {table} SET sender = CAST(sender_id AS TEXT) WHERE sender IS NULL")
+
+
+def ensure_message_table(connection, table='Messages'):
+    """
+    Creates the table with the current schema, or upgrades an existing one,
+    and makes sure its indexes exist. Safe to call repeatedly.
+    """
+    table = check_table_name(table)
+    if table_exists(connection, table):
+        upgrade_message_table(connection, table)
+    else:
+        create_message_table(connection, table)
+    create_message_indexes(connection, table)
+    return table
+
+
+def _migration_1(connection):
+    # unify the parser and ChatMessages definitions of Messages and index it
+    for (table,) in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall():
+        if table != 'sqlite_sequence' and 'thread_id' in table_columns(connection, table):
+            ensure_message_table(connection, table)
+    ensure_message_table(connection, 'Messages')
+
+
+def create_checkpoint_table(connection):
+    # one row per run, replaced by every checkpoint; state is JSON
+    connection.execute('''
+        CREATE TABLE IF NOT EXISTS Checkpoints (
+            run_id TEXT PRIMARY KEY,
+            digest TEXT,
+            sequence INTEGER,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            state TEXT
+        )
+    ''')
+
+
+def _migration_2(connection):
+    create_checkpoint_table(connection)
+
+
+# (version, step) pairs applied in order to databases below that version
+MIGRATIONS = (
+    (1, _migration_1),
+    (2, _migration_2),
+)
+
+
+def schema_version(connection):
+    return connection.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(connection, tables=()):
+    """
+    Brings the database up to SCHEMA_VERSION and makes sure the given message
+    tables exist. Returns the schema version.
+    """
+    version = schema_version(connection)
+    for target, step in MIGRATIONS:
+        if target > version:
+            step(connection)
+            connection.execute(f"PRAGMA user_version = {target}")
+            version = target
+    for table in tables:
+        ensure_message_table(connection, table)
+    connection.commit()
+    return version
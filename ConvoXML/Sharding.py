@@ -0,0 +1,102 @@
+import hashlib
+import heapq
+import os
+import uuid
+from .Connections import ConnectionManager
+from .Context import ChatMessages
+from .Schema import MESSAGE_ID, MESSAGE_COLUMNS
+
+TIMESTAMP = MESSAGE_COLUMNS.index('timestamp')
+
+
+def shard_for(thread_id, shards):
+    """
+    The shard that stores thread_id, stable across processes and runs.
+    """
+    digest = hashlib.blake2b(str(thread_id).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % shards
+
+
+def shard_paths(db_path, shards):
+    """
+    Database files of a sharded run, e.g. messages.db -> messages.shard0.db, messages.shard1.db, ...
+    """
+    if db_path == ':memory:':
+        raise ValueError("Sharded runs need a database file, not ':memory:'")
+    stem, extension = os.path.splitext(db_path)
+    return [f"{stem}.shard{shard}{extension}" for shard in range(shards)]
+
+
+def shard_thread_id(shard, shards):
+    """
+    A new thread id that hashes to shard.
+    """
+    while True:
+        thread_id = str(uuid.uuid4())[:8]
+        if shard_for(thread_id, shards) == shard:
+            return thread_id
+
+
+def assign_shard_thread_ids(conversation, shard, shards):
+    """
+    Gives the agents of a conversation thread ids that hash to shard, keeping
+    agents that shared a thread on one thread.
+    """
+    thread_ids = {}
+    for agent in conversation.agents:
+        if agent.thread_id not in thread_ids:
+            thread_ids[agent.thread_id] = shard_thread_id(shard, shards)
+        agent.thread_id = thread_ids[agent.thread_id]
+    return conversation
+
+
+class ShardedChatMessages:
+    """
+    ChatMessages over the shard databases of a sharded run.
+
+    Reads and writes for a thread go to the shard that owns it. Reads
+    without a thread, and query(), cover every shard and merge the results,
+    newest first by timestamp. message_ids are only unique within a shard,
+    and timestamps only have one-second resolution, so messages written
+    in the same second on different shards merge in no particular order.
+
+    Example Usage:
+        BatchRunner(parser, conversations=10000, workers=8, mode='sharded').run()
+        messages = ShardedChatMessages('messages.db', shards=8)
+        messages.get_last_n_messages(5, thread_id)
+    """
+
+    def __init__(self, db_path="chatroom.db", shards=4, bus=None):
+        self.db_path = db_path
+        self.paths = shard_paths(db_path, shards)
+        self.shards = [ChatMessages(path, connections=ConnectionManager.for_path(path), bus=bus) for path in self.paths]
+
+    def shard(self, thread_id):
+        return self.shards[shard_for(thread_id, len(self.shards))]
+
+    def add_new_message(self, msg_dict):
+        self.shard(msg_dict['thread_id']).add_new_message(msg_dict)
+
+    def insert_message(self, sender, content, agent_name, participants, agents, thread_id):
+        self.shard(thread_id).insert_message(sender, content, agent_name, participants, agents, thread_id=thread_id)
+
+    def get_last_n_messages(self, n=5, thread_id=None):
+        if thread_id:
+            return self.shard(thread_id).get_last_n_messages(n, thread_id)
+        newest_first = lambda row: (row[TIMESTAMP] or '', row[MESSAGE_ID])
+        rows = heapq.merge(*(shard.get_last_n_messages(n) for shard in self.shards), key=newest_first, reverse=True)
+        return list(rows) if n is None else [row for _, row in zip(range(n), rows)]
+
+    def query(self, sql, params=()):
+        """
+        Runs a read-only query on every shard and returns all rows, e.g. for
+        analytics. Aggregates have to be combined by the caller.
+        """
+        rows = []
+        for shard in self.shards:
+            rows.extend(shard.connections.execute(sql, params).fetchall())
+        return rows
+
+    def close(self):
+        for shard in self.shards:
+            shard.connections.close()
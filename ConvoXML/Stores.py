@@ -0,0 +1,340 @@
+import json
+import os
+import threading
+from .Cache import utc_timestamp
+from .Writers import MessageWriter
+from .Schema import check_table_name, MESSAGE_SELECT, MESSAGE_ID
+from .Transcript import TranscriptLog, SEGMENT_SIZE
+
+
+class MessageStore:
+    """
+    Where agents write their messages and read their inputs from.
+
+    Rows are tuples in Schema.MESSAGE_COLUMNS order and message_ids increase
+    per table, so every backend can serve "the newest n messages of a thread"
+    and the rows between two message_ids the same way the SQLite tables do.
+    """
+
+    name = None
+
+    def write(self, table, thread_id, sender, content):
+        raise NotImplementedError
+
+    def write_many(self, table, thread_id, sender, contents):
+        for content in contents:
+            self.write(table, thread_id, sender, content)
+
+    def last(self, table, thread_id, n=None):
+        """
+        Returns the newest n messages of the thread in table, newest first, or all of them when n is None.
+        """
+        raise NotImplementedError
+
+    def between(self, table, thread_id, after_id, before_id):
+        """
+        Returns the messages of the thread in table with after_id < message_id < before_id, oldest first.
+        """
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SQLiteStore(MessageStore):
+    """
+    Message tables in the parser's SQLite database, written through a
+    MessageWriter and read through its MessageCache when there is one.
+    """
+
+    name = 'sqlite'
+
+    def __init__(self, connections, writer=None):
+        self.connections = connections
+        self.writer = writer or MessageWriter(connections)
+
+    @property
+    def cache(self):
+        return self.writer.cache
+
+    def write(self, table, thread_id, sender, content):
+        self.writer.write(table, thread_id, sender, content)
+
+    def last(self, table, thread_id, n=None):
+        # queued messages reach the database and the cache only when they are flushed
+        self.writer.flush()
+
+        def load(limit):
+            cursor = self.connections.execute(f"SELECT {MESSAGE_SELECT} FROM {table} WHERE thread_id = ? ORDER BY message_id DESC LIMIT ?",
+                                              (thread_id, -1 if limit is None else limit))
+            return cursor.fetchall()
+
+        if self.cache is None:
+            return load(n)
+        return self.cache.get(table, thread_id, n, load)
+
+    def between(self, table, thread_id, after_id, before_id):
+        self.writer.flush()
+        cursor = self.connections.execute(f"SELECT {MESSAGE_SELECT} FROM {table} WHERE thread_id = ? AND message_id > ? AND message_id < ? ORDER BY message_id",
+                                          (thread_id, after_id, before_id))
+        return cursor.fetchall()
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        self.writer.close()
+
+
+class MemoryStore(MessageStore):
+    """
+    Keeps every message in process memory. Nothing is persisted, which makes
+    it the fastest store for tests and for runs whose transcripts are thrown
+    away; messages are only visible inside the process that wrote them.
+    """
+
+    name = 'memory'
+
+    def __init__(self):
+        self._threads = {}
+        self._last_ids = {}
+        self._lock = threading.Lock()
+
+    def write(self, table, thread_id, sender, content):
+        with self._lock:
+            message_id = self._last_ids[table] = self._last_ids.get(table, 0) + 1
+            row = (message_id, thread_id, utc_timestamp(), sender, content, None, None, None)
+            self._threads.setdefault((table, thread_id), []).append(row)
+
+    def last(self, table, thread_id, n=None):
+        with self._lock:
+            rows = self._threads.get((table, thread_id), [])
+            rows = rows if n is None else rows[max(len(rows) - n, 0):]
+            return rows[::-1]
+
+    def between(self, table, thread_id, after_id, before_id):
+        with self._lock:
+            rows = self._threads.get((table, thread_id), [])
+            return [row for row in rows if after_id < row[MESSAGE_ID] < before_id]
+
+    def close(self):
+        with self._lock:
+            self._threads.clear()
+
+
+class LogStore(MessageStore):
+    """
+    Append-only JSON-lines file per table in `directory`, one row per line.
+
+    Writes never touch earlier records, so appending stays cheap however
+    long the transcript gets. The byte offset of every message is indexed
+    per thread, and rebuilt by scanning the files when a store is opened, so
+    reading a thread seeks straight to its records. Only one process should
+    append to a directory at a time.
+
+    Example Usage:
+        <Output table="Transcript" store="log"/>
+    """
+
+    name = 'log'
+
+    def __init__(self, directory='messages.logs'):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._files = {}
+        self._offsets = {}
+        self._last_ids = {}
+        self._lock = threading.Lock()
+
+    def path(self, table):
+        return os.path.join(self.directory, f"{check_table_name(table)}.jsonl")
+
+    def _open(self, table):
+        """
+        Returns the file of table, opening it and indexing its records on first use.
+        """
+        file = self._files.get(table)
+        if file is not None:
+            return file
+        file = open(self.path(table), 'a+b')
+        file.seek(0)
+        offset, last_id = 0, 0
+        for line in file:
+            if line.endswith(b'\n'):
+                row = json.loads(line)
+                self._offsets.setdefault((table, row[1]), []).append((row[MESSAGE_ID], offset))
+                last_id = row[MESSAGE_ID]
+            offset += len(line)
+        # drop a record cut short by a crash
+        file.truncate(offset)
+        self._last_ids[table] = last_id
+        self._files[table] = file
+        return file
+
+    def write(self, table, thread_id, sender, content):
+        with self._lock:
+            file = self._open(table)
+            message_id = self._last_ids[table] = self._last_ids[table] + 1
+            row = (message_id, thread_id, utc_timestamp(), sender, content, None, None, None)
+            file.seek(0, os.SEEK_END)
+            self._offsets.setdefault((table, thread_id), []).append((message_id, file.tell()))
+            file.write(json.dumps(row).encode('utf-8') + b'\n')
+
+    def _read(self, file, entries):
+        file.flush()
+        rows = []
+        for _, offset in entries:
+            file.seek(offset)
+            rows.append(tuple(json.loads(file.readline())))
+        return rows
+
+    def last(self, table, thread_id, n=None):
+        with self._lock:
+            file = self._open(table)
+            entries = self._offsets.get((table, thread_id), [])
+            entries = entries if n is None else entries[max(len(entries) - n, 0):]
+            return self._read(file, entries)[::-1]
+
+    def between(self, table, thread_id, after_id, before_id):
+        with self._lock:
+            file = self._open(table)
+            entries = [entry for entry in self._offsets.get((table, thread_id), [])
+                       if after_id < entry[0] < before_id]
+            return self._read(file, entries)
+
+    def flush(self):
+        with self._lock:
+            for file in self._files.values():
+                file.flush()
+
+    def close(self):
+        with self._lock:
+            files, self._files = list(self._files.values()), {}
+            self._offsets.clear()
+            self._last_ids.clear()
+        for file in files:
+            file.close()
+
+
+class TranscriptStore(MessageStore):
+    """
+    A TranscriptLog per table, in `directory`/<table>. Suited to very long
+    runs that mostly append and read back the latest messages of a thread.
+    export() copies the transcripts into SQLite message tables.
+
+    Example Usage:
+        <Output table="Messages" store="transcript"/>
+    """
+
+    name = 'transcript'
+
+    def __init__(self, directory='messages.logs', segment_size=SEGMENT_SIZE):
+        self.directory = directory
+        self.segment_size = segment_size
+        self._logs = {}
+        self._lock = threading.Lock()
+
+    def log(self, table):
+        with self._lock:
+            log = self._logs.get(table)
+            if log is None:
+                path = os.path.join(self.directory, check_table_name(table))
+                log = self._logs[table] = TranscriptLog(path, self.segment_size)
+            return log
+
+    def write(self, table, thread_id, sender, content):
+        self.log(table).append(thread_id, sender, content)
+
+    def last(self, table, thread_id, n=None):
+        return self.log(table).tail(thread_id, n)
+
+    def between(self, table, thread_id, after_id, before_id):
+        return self.log(table).between(thread_id, after_id, before_id)
+
+    def export(self, connections, tables=None):
+        """
+        Appends the transcripts of tables (default: every table opened by this
+        store) to the SQLite tables of the same name and returns the number of
+        messages exported per table.
+        """
+        tables = list(self._logs) if tables is None else tables
+        return {table: self.log(table).export(connections, table) for table in tables}
+
+    def flush(self):
+        with self._lock:
+            logs = list(self._logs.values())
+        for log in logs:
+            log.flush()
+
+    def close(self):
+        with self._lock:
+            logs, self._logs = list(self._logs.values()), {}
+        for log in logs:
+            log.close()
+
+
+# store names accepted by the store attribute of <input> and <output>
+STORE_BACKENDS = {
+    'sqlite': SQLiteStore,
+    'memory': MemoryStore,
+    'log': LogStore,
+    'transcript': TranscriptStore,
+}
+
+
+def create_store(name, connections=None, writer=None, directory=None):
+    """
+    Builds the store called name. SQLite stores use the given connections and
+    writer, log and transcript stores keep their files in directory.
+    """
+    if name not in STORE_BACKENDS:
+        raise ValueError(f"Unknown message store {name!r}, expected one of {', '.join(STORE_BACKENDS)}")
+    if name == 'sqlite':
+        return SQLiteStore(connections, writer)
+    if name in ('log', 'transcript'):
+        return STORE_BACKENDS[name](directory or 'messages.logs')
+    return STORE_BACKENDS[name]()
+
+
+class StoreRouter(MessageStore):
+    """
+    Sends each table to the store it was declared with, and every other
+    table to the default store.
+    """
+
+    def __init__(self, default, tables=None):
+        self.default = default
+        self.tables = dict(tables or {})
+
+    def store(self, table):
+        return self.tables.get(table, self.default)
+
+    def stores(self):
+        stores = [self.default]
+        for store in self.tables.values():
+            if all(store is not known for known in stores):
+                stores.append(store)
+        return stores
+
+    def write(self, table, thread_id, sender, content):
+        self.store(table).write(table, thread_id, sender, content)
+
+    def write_many(self, table, thread_id, sender, contents):
+        self.store(table).write_many(table, thread_id, sender, contents)
+
+    def last(self, table, thread_id, n=None):
+        return self.store(table).last(table, thread_id, n)
+
+    def between(self, table, thread_id, after_id, before_id):
+        return self.store(table).between(table, thread_id, after_id, before_id)
+
+    def flush(self):
+        for store in self.stores():
+            store.flush()
+
+    def close(self):
+        for store in self.stores():
+            store.close()
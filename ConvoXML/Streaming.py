@@ -0,0 +1,191 @@
+import re
+
+# events produced by TagParser
+TEXT = 'text'      # text outside the watched tags
+START = 'start'    # a watched tag was opened
+DATA = 'data'      # text inside the open tag
+END = 'end'        # the open tag was closed, or the response ended
+
+_TAG = re.compile(r'<(/?)([A-Za-z_][\w.-]*)(\s[^<>]*)?>')
+# what a tag split across chunks can look like so far
+_PARTIAL_TAG = re.compile(r'<(/?)([A-Za-z_][\w.-]*)?(\s[^<>]*)?\Z')
+# a '<' followed by this much text without a '>' is treated as text
+MAX_PARTIAL_TAG = 256
+_INCOMPLETE = object()
+
+
+class TagParser:
+    """
+    Incremental pull parser that finds sections such as <python>...</python>
+    in model output, in one pass and without building a tree.
+
+    Only the watched tags are recognised, case-insensitively and with or
+    without attributes; everything else, including markup that isn't well
+    formed, is passed through as text. Sections don't nest: inside an open
+    tag everything up to its closing tag is data, and a tag left open is
+    closed when the response ends. feed() returns the (kind, tag, text)
+    events the new chunk completes, holding back only a possible tag that
+    is split across chunks.
+
+    Example Usage:
+        parser = TagParser(['python'])
+        events = parser.feed('Run <python>print(1)</py') + parser.feed('thon> now') + parser.close()
+        # [('text', None, 'Run '), ('start', 'python', ''), ('data', 'python', 'print(1)'),
+        #  ('end', 'python', ''), ('text', None, ' now')]
+    """
+
+    def __init__(self, tags):
+        self.tags = tuple(tag.lower() for tag in tags)
+        self.tag = None
+        self._buffer = ''
+
+    @classmethod
+    def parse(cls, text, tags):
+        parser = cls(tags)
+        return parser.feed(text) + parser.close()
+
+    def feed(self, chunk):
+        self._buffer += chunk
+        return self._scan(final=False)
+
+    def close(self):
+        events = self._scan(final=True)
+        if self.tag is not None:
+            events.append((END, self.tag, ''))
+            self.tag = None
+        return events
+
+    def _scan(self, final):
+        buffer = self._buffer
+        events = []
+        emitted = position = 0
+        hold = len(buffer)
+        while True:
+            start = buffer.find('<', position)
+            if start == -1:
+                break
+            match = self._match(buffer, start)
+            if match is _INCOMPLETE and not final:
+                hold = start
+                break
+            if match is None or match is _INCOMPLETE:
+                position = start + 1
+                continue
+            tag, closing, end = match
+            if self.tag is None and not closing:
+                self._text(events, buffer[emitted:start])
+                events.append((START, tag, ''))
+                self.tag = tag
+            elif closing and tag == self.tag:
+                self._text(events, buffer[emitted:start])
+                events.append((END, tag, ''))
+                self.tag = None
+            else:
+                # tags that don't open or close a section are ordinary text
+                position = end
+                continue
+            emitted = position = end
+        self._text(events, buffer[emitted:hold])
+        self._buffer = buffer[hold:]
+        return events
+
+    def _text(self, events, text):
+        if text:
+            events.append((TEXT, None, text) if self.tag is None else (DATA, self.tag, text))
+
+    def _match(self, buffer, start):
+        """
+        Returns (tag, closing, end) for a watched tag at start, _INCOMPLETE when
+        more input could still make it one, or None.
+        """
+        match = _TAG.match(buffer, start)
+        if match is not None:
+            closing, name, attributes = match.groups()
+            name = name.lower()
+            if name in self.tags and not (closing and attributes and attributes.strip()):
+                return name, bool(closing), match.end()
+            return None
+        match = _PARTIAL_TAG.match(buffer, start)
+        if match is None or len(buffer) - start > MAX_PARTIAL_TAG:
+            return None
+        name = (match.group(2) or '').lower()
+        if match.group(3) is None:
+            return _INCOMPLETE if any(tag.startswith(name) for tag in self.tags) else None
+        return _INCOMPLETE if name in self.tags else None
+
+
+def extract_tag(text, tag):
+    """
+    Returns the content of the first <tag> section of text, or None when the
+    tag isn't there. An unclosed section runs to the end of the text.
+    """
+    content = None
+    for kind, _, data in TagParser.parse(text, [tag]):
+        if kind == START:
+            content = []
+        elif kind == DATA:
+            content.append(data)
+        elif kind == END:
+            return ''.join(content)
+    return None
+
+
+class ResponseTagStream:
+    """
+    Incrementally extracts the text inside <tag>...</tag> from a streamed response.
+
+    feed() takes the next chunk from the provider and returns the part of the
+    first tagged section that is now known. Without a tag every chunk is
+    passed through. If the stream ends without the tag ever appearing the
+    whole response is returned by close(), matching parse_response.
+
+    Example Usage:
+        stream = ResponseTagStream('answer')
+        for chunk in ['<thinking>..</thinking><ans', 'wer>Hel', 'lo</answer>']:
+            print(stream.feed(chunk), end='')   # prints 'Hel' then 'lo'
+        print(stream.close())
+    """
+
+    def __init__(self, tag=None):
+        self.tag = tag
+        self.parser = TagParser([tag]) if tag else None
+        self.found = False
+        self.done = False
+        self.chunks = []
+
+    @property
+    def text(self):
+        """The complete response received so far."""
+        return ''.join(self.chunks)
+
+    def feed(self, chunk):
+        if not chunk:
+            return ''
+        self.chunks.append(chunk)
+        if self.parser is None:
+            return chunk
+        if self.done:
+            return ''
+        return self._section(self.parser.feed(chunk))
+
+    def close(self):
+        """
+        Returns whatever is still held back once the stream has ended.
+        """
+        if self.parser is None or self.done:
+            return ''
+        output = self._section(self.parser.close())
+        self.done = True
+        return output if self.found else self.text
+
+    def _section(self, events):
+        output = []
+        for kind, _, data in events:
+            if kind == START:
+                self.found = True
+            elif kind == DATA:
+                output.append(data)
+            elif kind == END:
+                self.done = True
+                break
+        return ''.join(output)
@@ -0,0 +1,301 @@
+import glob
+import mmap
+import os
+import shutil
+import struct
+import threading
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import islice
+from .Cache import utc_timestamp
+from . import Schema
+
+# length, crc32, message_id, timestamp, then the byte lengths of thread_id, sender and content
+HEADER = struct.Struct('<IIQ19sHHI')
+# the crc covers everything after the crc field
+CRC_START = 8
+SEGMENT_SIZE = 64 * 1024 * 1024
+# positions pack the segment number above a 32-bit offset
+OFFSET_BITS = 32
+OFFSET_MASK = (1 << OFFSET_BITS) - 1
+
+
+def encode_record(message_id, thread_id, timestamp, sender, content):
+    thread_id, sender, content = (str(value).encode('utf-8') for value in (thread_id, sender, content))
+    length = HEADER.size + len(thread_id) + len(sender) + len(content)
+    body = struct.pack('<Q19sHHI', message_id, timestamp.encode('ascii'), len(thread_id), len(sender), len(content))
+    body += thread_id + sender + content
+    return struct.pack('<II', length, zlib.crc32(body)) + body
+
+
+class _ThreadIndex:
+    """
+    message_ids and packed positions of one thread's records, in append order.
+    Arrays keep the index at 16 bytes per message.
+    """
+
+    __slots__ = ('ids', 'positions')
+
+    def __init__(self):
+        self.ids = array('Q')
+        self.positions = array('Q')
+
+    def append(self, message_id, position):
+        self.ids.append(message_id)
+        self.positions.append(position)
+
+
+class TranscriptLog:
+    """
+    Append-only transcript of one message table, stored in memory-mapped segments.
+
+    Records are length-prefixed and checksummed, and are appended to the
+    active segment of `segment_size` bytes. A full segment is sealed and a
+    new one started. Every thread has an index of its records' positions,
+    built by scanning the segments on open, so tailing a thread decodes its
+    last records directly from the mapped pages without read() calls.
+    Appending stops at the first damaged or incomplete record, so a record
+    torn by a crash is overwritten by the next write. compact() rewrites the
+    log without the records it no longer needs to keep, and export() copies
+    the log into a SQLite message table.
+
+    Example Usage:
+        log = TranscriptLog('transcripts/Messages')
+        log.append('t1', 'Critic', 'Looks good.')
+        log.tail('t1', 10)
+    """
+
+    def __init__(self, directory, segment_size=SEGMENT_SIZE):
+        if segment_size > OFFSET_MASK:
+            raise ValueError(f"segment_size can be at most {OFFSET_MASK} bytes")
+        self.directory = directory
+        self.segment_size = segment_size
+        self._lock = threading.RLock()
+        self._open()
+
+    def _segment_path(self, segment):
+        return os.path.join(self.directory, f"{segment:08d}.seg")
+
+    def _open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._maps = []
+        self._index = {}
+        self.last_id = 0
+        self.records = 0
+        paths = sorted(glob.glob(os.path.join(self.directory, '*.seg')))
+        for segment, path in enumerate(paths):
+            if path != self._segment_path(segment):
+                raise ValueError(f"Transcript segment {path} is out of sequence")
+            with open(path, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                self._maps.append(mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) if size else None)
+            end = self._scan(segment)
+        if not paths:
+            self._start_segment(0, self.segment_size)
+        else:
+            # reopen the last segment for appending, after its last intact record
+            last = len(self._maps) - 1
+            if self._maps[last] is not None:
+                self._maps[last].close()
+            self._map_writable(last, max(end, self.segment_size))
+            self.position = end
+
+    def _scan(self, segment):
+        """
+        Indexes the intact records of a segment and returns the offset after the last one.
+        """
+        data = self._maps[segment]
+        offset = 0
+        while data is not None and offset + HEADER.size <= len(data):
+            length, crc, message_id, _, thread_length, _, _ = HEADER.unpack_from(data, offset)
+            if length < HEADER.size or offset + length > len(data):
+                break
+            if zlib.crc32(data[offset + CRC_START:offset + length]) != crc:
+                break
+            start = offset + HEADER.size
+            thread_id = str(data[start:start + thread_length], 'utf-8')
+            self._add(thread_id, message_id, segment << OFFSET_BITS | offset)
+            offset += length
+        return offset
+
+    def _add(self, thread_id, message_id, position):
+        index = self._index.get(thread_id)
+        if index is None:
+            index = self._index[thread_id] = _ThreadIndex()
+        index.append(message_id, position)
+        self.last_id = max(self.last_id, message_id)
+        self.records += 1
+
+    def _map_writable(self, segment, size):
+        with open(self._segment_path(segment), 'r+b') as f:
+            if os.fstat(f.fileno()).st_size < size:
+                f.truncate(size)
+            data = mmap.mmap(f.fileno(), size)
+        if segment < len(self._maps):
+            self._maps[segment] = data
+        else:
+            self._maps.append(data)
+
+    def _start_segment(self, segment, size):
+        open(self._segment_path(segment), 'wb').close()
+        self._map_writable(segment, size)
+        self.position = 0
+
+    def _seal(self):
+        """
+        Trims the active segment to its records and maps it read-only.
+        """
+        segment = len(self._maps) - 1
+        data = self._maps[segment]
+        data.flush()
+        data.close()
+        with open(self._segment_path(segment), 'r+b') as f:
+            f.truncate(self.position)
+            self._maps[segment] = mmap.mmap(f.fileno(), self.position, access=mmap.ACCESS_READ) if self.position else None
+
+    def append(self, thread_id, sender, content, message_id=None, timestamp=None):
+        """
+        Appends a message and returns its message_id.
+        """
+        with self._lock:
+            message_id = message_id or self.last_id + 1
+            record = encode_record(message_id, thread_id, timestamp or utc_timestamp(), sender, content)
+            self._append_record(record, str(thread_id), message_id)
+            return message_id
+
+    def _append_record(self, record, thread_id, message_id):
+        data = self._maps[-1]
+        if self.position + len(record) > len(data):
+            self._seal()
+            self._start_segment(len(self._maps), max(self.segment_size, len(record)))
+            data = self._maps[-1]
+        data[self.position:self.position + len(record)] = record
+        self._add(thread_id, message_id, (len(self._maps) - 1) << OFFSET_BITS | self.position)
+        self.position += len(record)
+
+    def _record(self, position):
+        """
+        The raw bytes of the record at position, as a view of the mapped segment.
+        """
+        data = self._maps[position >> OFFSET_BITS]
+        offset = position & OFFSET_MASK
+        length = struct.unpack_from('<I', data, offset)[0]
+        return memoryview(data)[offset:offset + length]
+
+    def _row(self, position):
+        with self._record(position) as record:
+            _, _, message_id, timestamp, thread_length, sender_length, content_length = HEADER.unpack_from(record)
+            start = HEADER.size
+            thread_id = str(record[start:start + thread_length], 'utf-8')
+            start += thread_length
+            sender = str(record[start:start + sender_length], 'utf-8')
+            start += sender_length
+            content = str(record[start:start + content_length], 'utf-8')
+        # a row in Schema.MESSAGE_COLUMNS order
+        return (message_id, thread_id, timestamp.decode('ascii'), sender, content, None, None, None)
+
+    def tail(self, thread_id, n=None):
+        """
+        Returns the newest n messages of the thread, newest first, or all of them when n is None.
+        """
+        with self._lock:
+            index = self._index.get(thread_id)
+            if index is None:
+                return []
+            positions = index.positions if n is None else index.positions[max(len(index.positions) - n, 0):]
+            return [self._row(position) for position in reversed(positions)]
+
+    def between(self, thread_id, after_id, before_id):
+        """
+        Returns the messages of the thread with after_id < message_id < before_id, oldest first.
+        """
+        with self._lock:
+            index = self._index.get(thread_id)
+            if index is None:
+                return []
+            start, end = bisect_right(index.ids, after_id), bisect_left(index.ids, before_id)
+            return [self._row(position) for position in index.positions[start:end]]
+
+    def threads(self):
+        with self._lock:
+            return list(self._index)
+
+    def __iter__(self):
+        """
+        Every message, in the order it was appended. Rows are decoded as they
+        are reached, so the log shouldn't be compacted meanwhile.
+        """
+        with self._lock:
+            positions = array('Q', sorted(position for index in self._index.values() for position in index.positions))
+        for position in positions:
+            with self._lock:
+                row = self._row(position)
+            yield row
+
+    def flush(self):
+        with self._lock:
+            if self._maps:
+                self._maps[-1].flush()
+
+    def close(self):
+        with self._lock:
+            if not self._maps:
+                return
+            self._seal()
+            for data in self._maps:
+                if data is not None:
+                    data.close()
+            self._maps = []
+            self._index = {}
+
+    def compact(self, keep_last=None, drop_threads=()):
+        """
+        Rewrites the log keeping only the newest keep_last messages of each
+        thread, and none of drop_threads. Records are copied as they are, so
+        message_ids don't change. Returns the number of messages dropped.
+        """
+        drop_threads = set(drop_threads)
+        staging = self.directory.rstrip(os.sep) + '.compacting'
+        with self._lock:
+            kept = []
+            for thread_id, index in self._index.items():
+                if thread_id in drop_threads:
+                    continue
+                positions = index.positions if keep_last is None else index.positions[max(len(index.positions) - keep_last, 0):]
+                kept.extend((position, thread_id, message_id) for position, message_id in
+                            zip(positions, index.ids[len(index.ids) - len(positions):]))
+            kept.sort()
+            dropped = self.records - len(kept)
+
+            shutil.rmtree(staging, ignore_errors=True)
+            compacted = TranscriptLog(staging, self.segment_size)
+            for position, thread_id, message_id in kept:
+                with self._record(position) as record:
+                    compacted._append_record(bytes(record), thread_id, message_id)
+            compacted.close()
+
+            self.close()
+            retired = self.directory.rstrip(os.sep) + '.retired'
+            os.rename(self.directory, retired)
+            os.rename(staging, self.directory)
+            shutil.rmtree(retired)
+            self._open()
+        return dropped
+
+    def export(self, connections, table='Messages', batch_size=10000):
+        """
+        Appends every message to a SQLite message table, in log order, and
+        returns how many were written. SQLite assigns new message_ids.
+        """
+        table = Schema.ensure_message_table(connections.connection(), table)
+        sql = f"INSERT INTO {table} (thread_id, timestamp, sender, content) VALUES (?, ?, ?, ?)"
+        rows = ((row[1], row[2], row[3], row[4]) for row in self)
+        exported = 0
+        with connections.transaction() as connection:
+            while True:
+                batch = list(islice(rows, batch_size))
+                if not batch:
+                    return exported
+                connection.executemany(sql, batch)
+                exported += len(batch)
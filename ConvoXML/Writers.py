@@ -0,0 +1,133 @@
+import threading
+import time
+from .Cache import utc_timestamp
+
+
+class MessageWriter:
+    """
+    Writes each agent message straight to the database and commits it.
+    This is the default sink used by agents; see BufferedMessageWriter for
+    the group-commit alternative. When a MessageCache is given every write
+    also goes to the cache.
+    """
+
+    def __init__(self, connections, cache=None):
+        self.connections = connections
+        self.cache = cache
+
+    @staticmethod
+    def insert_sql(table):
+        return f"INSERT INTO {table} (thread_id, sender, content) VALUES (?, ?, ?)"
+
+    @staticmethod
+    def cache_row(message_id, thread_id, sender, content):
+        # a row in Schema.MESSAGE_COLUMNS order
+        return (message_id, thread_id, utc_timestamp(), sender, content, None, None, None)
+
+    def write(self, table, thread_id, sender, content):
+        cursor = self.connections.execute(self.insert_sql(table), (thread_id, sender, content), commit=True)
+        if self.cache is not None:
+            # cached after the commit, so writers on other connections never wait for each other
+            self.cache.append(table, self.cache_row(cursor.lastrowid, thread_id, sender, content))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class BufferedMessageWriter(MessageWriter):
+    """
+    Queues messages from every agent and writes them in batches.
+
+    Pending rows are inserted with executemany inside a single transaction
+    once `batch_size` rows are queued or `flush_interval` seconds have passed,
+    whichever comes first. Agents call flush() before reading their inputs,
+    so a message is always visible to the next agent in the same process even
+    if the background thread has not written it yet. Rows still pending when
+    the process dies are lost, which is the durability traded for throughput.
+    Rows go to the cache once they are written, with their message_id.
+    """
+
+    def __init__(self, connections, batch_size=500, flush_interval=0.05, cache=None):
+        super().__init__(connections, cache=cache)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.error = None
+        self._pending = []
+        self._lock = threading.Lock()
+        # held for the whole flush so batches are committed in the order they were queued
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='convoxml-writer', daemon=True)
+        self._thread.start()
+
+    def write(self, table, thread_id, sender, content):
+        if self._closed:
+            raise RuntimeError("Cannot write to a closed BufferedMessageWriter")
+        if self._enqueue(table, (thread_id, sender, content)):
+            self._wakeup.set()
+
+    def _enqueue(self, table, row):
+        with self._lock:
+            self._pending.append((table, row))
+            return len(self._pending) >= self.batch_size
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, []
+            if pending:
+                self._write_batch(pending)
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _write_batch(self, pending):
+        # keep insertion order within each table
+        batches = {}
+        for table, row in pending:
+            batches.setdefault(table, []).append(row)
+        last_ids = {}
+        try:
+            with self.connections.transaction() as connection:
+                for table, rows in batches.items():
+                    connection.executemany(self.insert_sql(table), rows)
+                    last_ids[table] = connection.execute("SELECT last_insert_rowid()").fetchone()[0]
+        except Exception as e:
+            # put the rows back so the next flush retries them
+            with self._lock:
+                self._pending[:0] = pending
+            self.error = e
+            return
+        if self.cache is None:
+            return
+        for table, rows in batches.items():
+            # no other connection can insert during the transaction, so each table's ids are consecutive
+            first_id = last_ids[table] - len(rows) + 1
+            for message_id, (thread_id, sender, content) in enumerate(rows, first_id):
+                self.cache.append(table, self.cache_row(message_id, thread_id, sender, content))
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            started = time.monotonic()
+            with self._flush_lock:
+                with self._lock:
+                    pending, self._pending = self._pending, []
+                if pending:
+                    self._write_batch(pending)
+            if self.error is not None:
+                # back off instead of retrying a failing batch in a tight loop
+                time.sleep(max(0, self.flush_interval - (time.monotonic() - started)))
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join()
+        self.flush()
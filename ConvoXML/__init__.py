@@ -1,3 +1,22 @@
 from .ConvoXML import *
 from .Agents import *
 from .AgentInterface import *
+from .Connections import *
+from .Writers import *
+from .Cache import *
+from .Batch import *
+from .Registry import *
+from .Instrumentation import *
+from .ResponseCache import *
+from .Streaming import *
+from .Sandbox import *
+from .Providers import *
+from .RequestBatcher import *
+from .ContextWindow import *
+from .Sharding import *
+from .Stores import *
+from .Transcript import *
+from .Scheduler import *
+from .Budget import *
+from .Checkpoint import *
+from .Bus import *
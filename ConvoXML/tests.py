@@ -1,20 +1,76 @@
 from .ConvoXML import ConvoXML
+from .Connections import ConnectionManager
+from .Context import ChatMessages
+from .Writers import BufferedMessageWriter
+from . import Schema
+from .Cache import MessageCache
+from .Writers import MessageWriter
+from .Agents import TestAgent
+from .Batch import BatchRunner
+from .Sharding import ShardedChatMessages, shard_for, shard_paths
+from . import Plan
+from .Registry import AgentRegistry
+from .Instrumentation import Instrumentation, Histogram, NULL_INSTRUMENTATION
+from .ResponseCache import ResponseCache, response_cache_from_params
+from .Agents import OpenAIAgent
+from .Context import Context
+from .Streaming import ResponseTagStream, TagParser, extract_tag, TEXT, START, DATA, END
+from .AgentInterface import AgentTerminalInterface
+from .Sandbox import SandboxPool
+from .RequestBatcher import RequestBatcher, BatchRequestError, openai_batch_submitter
+from .ContextWindow import ContextWindow, count_tokens, truncate_tokens, extractive_summary
+from .Stores import MemoryStore, LogStore, SQLiteStore, TranscriptStore
+from .Transcript import TranscriptLog
+from .Scheduler import ConvoScheduler
+from .Budget import BudgetGovernor, BudgetExceeded
+from .Checkpoint import Checkpointer
+from .Bus import MessageBus, SocketBus, BusMessage
+from .Providers import TokenBucket, ProviderClients, call_with_retries, acall_with_retries, retry_delay, PROVIDER_CLIENTS
 
 import sqlite3
+import asyncio
+import json
+import threading
+import time
 import unittest
 import os
+import glob
+import subprocess
+import sys
+import tempfile
+import shutil
+from unittest import mock
 
 
+EXAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'examples')
+
+
+def remove_db(db_path):
+    # also clean up the WAL side files
+    for path in glob.glob(db_path + '*'):
+        os.remove(path)
+
+
+def make_parser(roles, loop, budgets='', **options):
+    """
+    A ConvoXML over an in-memory database for the given roles and ConvoLoop,
+    with the test agents defined in this module available as role classes.
+    """
+    xml_string = f"<InteractionModel>{budgets}<Roles>{roles}</Roles><ConvoLoop>{loop}</ConvoLoop></InteractionModel>"
+    options.setdefault('db_path', ':memory:')
+    options.setdefault('agent_classes', [PickingModerator, SlowAgent, ReadingAgent])
+    return ConvoXML(xml_string, **options)
+
 
 class TestConvoXML(unittest.TestCase):
     # Re-adjusting the test suite for the corrected parser
     def setUp(self):
         # Sample XML string
-        with open('./ConvoXml/examples/test_xml.xml', 'r') as f:
+        with open(os.path.join(EXAMPLES_DIR, 'test_xml.xml'), 'r') as f:
             xml_string = f.read()
         
         self.db_connection = sqlite3.connect('tests.db')
-        self.parser = ConvoXML(xml_string)
+        self.parser = ConvoXML(xml_string, db_path='tests.db')
         self.parser.setup_database()
     
     def test_initialization(self):
@@ -37,7 +93,7 @@ class TestConvoXML(unittest.TestCase):
                 queue_roles.extend([agent.role for agent in item])
             elif item:
                 queue_roles.append(item.role)
-                print(item.__dict__)
+                print(item)
         self.assertIn("Moderator", queue_roles)
         self.assertIn("Participant1", queue_roles)
         self.assertIn("Participant2", queue_roles)
@@ -53,7 +109,80 @@ class TestConvoXML(unittest.TestCase):
     
     def tearDown(self):
         self.db_connection.close()
-        os.remove('tests.db')
+        self.parser.close()
+        remove_db('tests.db')
+
+
+class TestConnectionManager(unittest.TestCase):
+    def setUp(self):
+        self.connections = ConnectionManager('connections_test.db')
+
+    def test_connection_is_reused_per_thread(self):
+        self.assertIs(self.connections.connection(), self.connections.connection())
+        other = []
+        thread = threading.Thread(target=lambda: other.append(self.connections.connection()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(other[0], self.connections.connection())
+
+    def test_wal_mode(self):
+        mode = self.connections.execute("PRAGMA journal_mode").fetchone()[0]
+        self.assertEqual(mode.lower(), 'wal')
+
+    def test_agents_share_parser_connections(self):
+        with open(os.path.join(EXAMPLES_DIR, 'test_xml.xml'), 'r') as f:
+            parser = ConvoXML(f.read(), db_path='connections_test.db', connections=self.connections)
+        for agent in parser.agents:
+            self.assertIs(agent.connections, self.connections)
+
+    def test_chat_messages_round_trip(self):
+        messages = ChatMessages('connections_test.db', connections=self.connections)
+        messages.insert_message('alice', 'hi', 'agent', [], [])
+        last = messages.get_last_n_messages(1, thread_id=messages.thread_id)
+        self.assertEqual(last[0][4], 'hi')
+
+    def tearDown(self):
+        self.connections.close()
+        remove_db('connections_test.db')
+
+
+class TestBufferedMessageWriter(unittest.TestCase):
+    def setUp(self):
+        self.connections = ConnectionManager('writer_test.db')
+        self.connections.execute("CREATE TABLE Messages (thread_id TEXT, sender TEXT, content TEXT)", commit=True)
+
+    def count(self):
+        return self.connections.execute("SELECT COUNT(*) FROM Messages").fetchone()[0]
+
+    def test_flush_makes_writes_visible(self):
+        writer = BufferedMessageWriter(self.connections, flush_interval=60)
+        writer.write('Messages', 't1', 'alice', 'hello')
+        self.assertEqual(self.count(), 0)
+        writer.flush()
+        self.assertEqual(self.count(), 1)
+        writer.close()
+
+    def test_background_flush_on_batch_size(self):
+        writer = BufferedMessageWriter(self.connections, batch_size=10, flush_interval=60)
+        for idx in range(10):
+            writer.write('Messages', 't1', 'alice', str(idx))
+        deadline = time.monotonic() + 5
+        while self.count() < 10 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.count(), 10)
+        writer.close()
+
+    def test_close_flushes_pending(self):
+        writer = BufferedMessageWriter(self.connections, flush_interval=60)
+        writer.write('Messages', 't1', 'alice', 'hello')
+        writer.close()
+        self.assertEqual(self.count(), 1)
+        with self.assertRaises(RuntimeError):
+            writer.write('Messages', 't1', 'alice', 'late')
+
+    def tearDown(self):
+        self.connections.close()
+        remove_db('writer_test.db')
 
 
 
@@ -62,3 +191,1345 @@ if __name__ == '__main__':
     test_suite = unittest.TestLoader().loadTestsFromTestCase(TestConvoXML)
     unittest.TextTestRunner().run(test_suite)
 
+
+
+class TestSchema(unittest.TestCase):
+    def setUp(self):
+        self.connection = sqlite3.connect(':memory:')
+
+    def test_migrates_legacy_parser_table(self):
+        self.connection.execute("""CREATE TABLE Messages (
+                                     message_id INTEGER PRIMARY KEY,
+                                     thread_id TEXT,
+                                     sender_id INTEGER,
+                                     content TEXT,
+                                     timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)""")
+        self.connection.execute("INSERT INTO Messages (thread_id, sender_id, content) VALUES ('t1', 7, 'old')")
+        self.assertEqual(Schema.migrate(self.connection), Schema.SCHEMA_VERSION)
+        columns = Schema.table_columns(self.connection, 'Messages')
+        for column in Schema.MESSAGE_COLUMNS:
+            self.assertIn(column, columns)
+        sender = self.connection.execute("SELECT sender FROM Messages").fetchone()[0]
+        self.assertEqual(sender, '7')
+
+    def test_latest_messages_use_index(self):
+        Schema.migrate(self.connection, tables=['Summary'])
+        for table in ('Messages', 'Summary'):
+            plan = self.connection.execute(
+                f"EXPLAIN QUERY PLAN SELECT * FROM {table} WHERE thread_id = ? ORDER BY message_id DESC LIMIT 5",
+                ('t1',)).fetchall()
+            self.assertIn(f'idx_{table}_thread_message', ' '.join(str(row[-1]) for row in plan))
+
+    def test_rejects_invalid_table_names(self):
+        with self.assertRaises(ValueError):
+            Schema.ensure_message_table(self.connection, 'Messages; DROP TABLE Messages')
+
+    def tearDown(self):
+        self.connection.close()
+
+
+class TestMessageCache(unittest.TestCase):
+    def setUp(self):
+        self.connections = ConnectionManager(':memory:')
+        Schema.migrate(self.connections.connection())
+        self.cache = MessageCache(rows_per_thread=3)
+        self.writer = MessageWriter(self.connections, cache=self.cache)
+        self.agent = TestAgent(role='Reader', thread_id='t1', rows=2, connections=self.connections,
+                               writer=self.writer)
+
+    def test_reads_are_served_from_cache_after_first_load(self):
+        self.writer.write('Messages', 't1', 'alice', 'first')
+        self.assertEqual(self.agent.get_inputs(), ['first'])
+        self.assertEqual(self.cache.misses, 1)
+        self.writer.write('Messages', 't1', 'bob', 'second')
+        self.assertEqual(self.agent.get_inputs(), ['first', 'second'])
+        self.assertEqual(self.cache.hits, 1)
+        rows = self.agent.get_messages('Messages', 2)
+        self.assertEqual([row[Schema.CONTENT] for row in rows], ['second', 'first'])
+
+    def test_ring_buffer_keeps_last_rows(self):
+        self.agent.get_messages('Messages', 1)
+        for idx in range(5):
+            self.writer.write('Messages', 't1', 'alice', str(idx))
+        rows = self.cache.get('Messages', 't1', 3, lambda limit: self.fail('unexpected load'))
+        self.assertEqual([row[Schema.CONTENT] for row in rows], ['4', '3', '2'])
+
+    def test_evicts_least_recently_used_threads(self):
+        cache = MessageCache(rows_per_thread=3, max_threads=2)
+        for thread_id in ('a', 'b', 'c'):
+            cache.get('Messages', thread_id, 1, lambda limit: [])
+        self.assertEqual(len(cache), 2)
+        cache.get('Messages', 'a', 1, lambda limit: [])
+        self.assertEqual(cache.misses, 4)
+
+    def test_memory_cap(self):
+        cache = MessageCache(rows_per_thread=10, max_bytes=1000)
+        for thread_id in range(20):
+            cache.get('Messages', str(thread_id), 1, lambda limit: [(1, 't', None, 's', 'x' * 100, None, None, None)])
+        self.assertLessEqual(cache.size, 1000)
+
+    def test_writers_commit_outside_the_cache_lock(self):
+        self.agent.get_messages('Messages', 1)
+        with self.cache.lock:
+            writer = threading.Thread(target=self.writer.write, args=('Messages', 't1', 'alice', 'first'))
+            writer.start()
+            deadline = time.monotonic() + 2
+            while not self.connections.execute("SELECT COUNT(*) FROM Messages").fetchone()[0]:
+                self.assertLess(time.monotonic(), deadline, "the insert waited for the cache lock")
+                time.sleep(0.01)
+        writer.join()
+        self.assertEqual(self.agent.get_inputs(), ['first'])
+
+    def test_append_skips_loaded_rows_and_keeps_id_order(self):
+        rows = lambda *ids: [(message_id, 't1', None, 's', str(message_id), None, None, None) for message_id in ids]
+        self.cache.get('Messages', 't1', 3, lambda limit: rows(2, 1))
+        for row in rows(2, 4, 3):
+            self.cache.append('Messages', row)
+        cached = self.cache.get('Messages', 't1', 3, lambda limit: self.fail('unexpected load'))
+        self.assertEqual([row[0] for row in cached], [4, 3, 2])
+
+    def test_buffered_rows_are_cached_with_their_ids(self):
+        writer = BufferedMessageWriter(self.connections, batch_size=100, flush_interval=60, cache=self.cache)
+        self.agent.get_messages('Messages', 1)
+        writer.write('Messages', 't1', 'alice', 'first')
+        writer.write('Messages', 't2', 'alice', 'other thread')
+        writer.write('Messages', 't1', 'bob', 'second')
+        writer.flush()
+        cached = self.cache.get('Messages', 't1', 2, lambda limit: self.fail('unexpected load'))
+        stored = self.connections.execute(
+            "SELECT message_id, content FROM Messages WHERE thread_id = 't1' ORDER BY message_id DESC").fetchall()
+        self.assertEqual([(row[0], row[Schema.CONTENT]) for row in cached], stored)
+        writer.close()
+
+    def test_buffered_writes_are_read_from_a_cached_thread(self):
+        writer = BufferedMessageWriter(self.connections, batch_size=100, flush_interval=10, cache=self.cache)
+        store = SQLiteStore(self.connections, writer)
+        store.write('Messages', 't1', 'alice', 'one')
+        self.assertEqual([row[Schema.CONTENT] for row in store.last('Messages', 't1', 2)], ['one'])
+        store.write('Messages', 't1', 'bob', 'two')
+        self.assertEqual([row[Schema.CONTENT] for row in store.last('Messages', 't1', 2)], ['two', 'one'])
+        self.assertEqual(self.cache.hits, 1)
+        writer.close()
+
+    def test_agents_read_buffered_messages_of_a_cached_thread(self):
+        parser = make_parser('<Role name="A"/><Role name="B"/>', '<A/><B/>', buffered_writes=True, flush_interval=10)
+        a, b = parser.agents
+        b.thread_id = a.thread_id
+        self.assertEqual(b.get_inputs(), [])
+        a.send_message()
+        self.assertEqual(b.get_inputs(), [a.test_message])
+        parser.close()
+
+    def test_chat_messages_use_cache(self):
+        messages = ChatMessages(':memory:', connections=self.connections, cache=self.cache)
+        messages.insert_message('alice', 'hi', 'agent', [], [])
+        messages.get_last_n_messages(1, thread_id=messages.thread_id)
+        messages.insert_message('bob', 'there', 'agent', [], [])
+        last = messages.get_last_n_messages(2, thread_id=messages.thread_id)
+        self.assertEqual([row[Schema.CONTENT] for row in last], ['there', 'hi'])
+        self.assertEqual(self.cache.hits, 1)
+
+    @unittest.skipUnless(hasattr(time, 'tzset'), "needs time.tzset")
+    def test_chat_messages_are_stamped_in_utc(self):
+        timezone = os.environ.get('TZ')
+        os.environ['TZ'] = 'Etc/GMT+5'
+        time.tzset()
+        try:
+            messages = ChatMessages(':memory:', connections=self.connections, cache=self.cache)
+            messages.insert_message('alice', 'hi', 'agent', [], [])
+        finally:
+            if timezone is None:
+                del os.environ['TZ']
+            else:
+                os.environ['TZ'] = timezone
+            time.tzset()
+        stamped = self.connections.execute("SELECT timestamp FROM Messages").fetchone()[0]
+        lag = self.connections.execute("SELECT strftime('%s', 'now') - strftime('%s', ?)", (stamped,)).fetchone()[0]
+        self.assertLess(abs(lag), 60)
+
+    def tearDown(self):
+        self.connections.close()
+
+
+class SleepyAgent(TestAgent):
+    async def execute(self, message=None):
+        await asyncio.sleep(0.2)
+        self.send_message(message)
+        # stop after the first round
+        self.context.exit = True
+        return self.role
+
+
+class TestAsyncRun(unittest.TestCase):
+    xml_string = """
+    <InteractionModel>
+      <Roles>
+        <Role name="First" class="SleepyAgent"/>
+        <Role name="Second" class="SleepyAgent"/>
+        <Role name="Third" class="SleepyAgent"/>
+      </Roles>
+      <ConvoLoop>
+        <First/>
+        <Second/>
+        <Third/>
+      </ConvoLoop>
+    </InteractionModel>
+    """
+
+    def setUp(self):
+        self.parser = ConvoXML(self.xml_string, db_path='async_test.db', agent_classes=[SleepyAgent])
+
+    def count(self):
+        return self.parser.connections.execute("SELECT COUNT(*) FROM Messages WHERE sender != '1' AND sender != '2'").fetchone()[0]
+
+    def test_independent_threads_run_concurrently(self):
+        started = time.monotonic()
+        asyncio.run(self.parser.arun())
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual(self.count(), 3)
+
+    def test_concurrency_limit(self):
+        started = time.monotonic()
+        asyncio.run(self.parser.arun(concurrency=1))
+        self.assertGreaterEqual(time.monotonic() - started, 0.6)
+
+    def test_blocking_run_supports_async_execute(self):
+        self.parser.run()
+        self.assertEqual(self.count(), 3)
+
+    def tearDown(self):
+        self.parser.close()
+        remove_db('async_test.db')
+
+
+class TestBatchRunner(unittest.TestCase):
+    def setUp(self):
+        with open(os.path.join(EXAMPLES_DIR, 'test_xml.xml'), 'r') as f:
+            self.parser = ConvoXML(f.read(), db_path='batch_test.db', buffered_writes=True)
+
+    def moderator_messages(self, thread_ids):
+        rows = self.parser.connections.execute("SELECT thread_id FROM Messages WHERE sender = 'Moderator'").fetchall()
+        return [row for row in rows if row[0] in thread_ids]
+
+    def test_parser_leaves_the_database_empty(self):
+        self.assertEqual(self.parser.connections.execute("SELECT COUNT(*) FROM Messages").fetchone()[0], 0)
+
+    def test_forks_are_isolated(self):
+        first, second = self.parser.fork(), self.parser.fork()
+        self.assertIsNot(first.context, second.context)
+        self.assertNotEqual(first.agents[0].thread_id, second.agents[0].thread_id)
+        first.run()
+        self.assertNotIn('turns', second.context)
+
+    def test_thread_mode(self):
+        reports = []
+        runner = BatchRunner(self.parser, conversations=20, workers=4, progress=reports.append, progress_interval=0)
+        stats = runner.run()
+        self.assertEqual(stats.completed, 20)
+        self.assertEqual(stats.failed, 0)
+        self.assertGreater(stats.steps_per_second, 0)
+        self.assertTrue(reports)
+        moderator_threads = {thread_ids[0] for thread_ids in runner.thread_ids}
+        self.assertEqual(len(moderator_threads), 20)
+        # each moderator picks six participants and announces the end
+        self.assertEqual(len(self.moderator_messages(moderator_threads)), 20 * 7)
+
+    def test_process_mode(self):
+        runner = BatchRunner(self.parser, conversations=4, workers=2, mode='process')
+        stats = runner.run()
+        self.assertEqual(stats.completed, 4)
+        moderator_threads = {thread_ids[0] for thread_ids in runner.thread_ids}
+        self.assertEqual(len(self.moderator_messages(moderator_threads)), 4 * 7)
+
+    def test_process_mode_options(self):
+        with open(os.path.join(EXAMPLES_DIR, 'test_xml.xml'), 'r') as f:
+            xml_string = f.read()
+        self.parser.close()
+        # the bus and instrumentation belong to this process, the workers make their own
+        self.parser = ConvoXML(xml_string, db_path='batch_test.db', buffered_writes=True, bus=MessageBus(),
+                               instrumentation=Instrumentation())
+        stats = BatchRunner(self.parser, conversations=2, workers=1, mode='process').run()
+        self.assertEqual((stats.completed, stats.failed), (2, 0))
+        self.parser.close()
+        self.parser = ConvoXML(xml_string, db_path='batch_test.db', on_chunk=lambda role, text: None)
+        with self.assertRaisesRegex(ValueError, "'on_chunk' option"):
+            BatchRunner(self.parser, conversations=2, workers=1, mode='process').run()
+
+    def test_sharded_mode(self):
+        runner = BatchRunner(self.parser, conversations=6, workers=2, mode='sharded')
+        stats = runner.run()
+        self.assertEqual(stats.completed, 6)
+        messages = ShardedChatMessages('batch_test.db', shards=2)
+        try:
+            for thread_ids in runner.thread_ids:
+                shard = shard_for(thread_ids[0], 2)
+                self.assertTrue(all(shard_for(thread_id, 2) == shard for thread_id in thread_ids))
+                rows = messages.shards[shard].connections.execute(
+                    "SELECT COUNT(*) FROM Messages WHERE thread_id = ? AND sender = 'Moderator'", (thread_ids[0],)).fetchone()
+                self.assertEqual(rows[0], 7)
+                self.assertEqual(len(messages.get_last_n_messages(3, thread_ids[0])), 3)
+            counts = messages.query("SELECT COUNT(*) FROM Messages WHERE sender = 'Moderator'")
+            self.assertEqual(sum(count for count, in counts), 6 * 7)
+            latest = messages.get_last_n_messages(10)
+            self.assertEqual(len(latest), 10)
+            self.assertEqual(latest, sorted(latest, key=lambda row: (row[2], row[0]), reverse=True))
+        finally:
+            messages.close()
+            for path in shard_paths('batch_test.db', 2):
+                remove_db(path)
+
+    def test_sharded_mode_needs_a_file(self):
+        with self.assertRaises(ValueError):
+            shard_paths(':memory:', 2)
+
+    def tearDown(self):
+        self.parser.close()
+        remove_db('batch_test.db')
+
+
+class TestConvoPlan(unittest.TestCase):
+    def setUp(self):
+        with open(os.path.join(EXAMPLES_DIR, 'test_xml.xml'), 'r') as f:
+            self.xml_string = f.read()
+
+    def test_compile(self):
+        plan = Plan.ConvoPlan.compile(self.xml_string)
+        self.assertEqual([role.name for role in plan.roles], ["Moderator", "Participant1", "Participant2", "Participant3"])
+        self.assertEqual(plan.role('moderator').class_name, 'TestModerator')
+        self.assertEqual(plan.steps, (Plan.Step('Moderator', ('Participant1', 'Participant2', 'Participant3')),))
+        with self.assertRaises(AttributeError):
+            plan.steps = ()
+
+    def test_input_and_output_elements(self):
+        plan = Plan.ConvoPlan.compile("""
+        <InteractionModel>
+          <Roles>
+            <Role name="Writer"><input table="Messages,Summary" rows="5,1"/><output table="Drafts"/></Role>
+          </Roles>
+          <ConvoLoop><Writer/></ConvoLoop>
+        </InteractionModel>""")
+        role = plan.role('Writer')
+        self.assertEqual((role.input_table, role.rows, role.output_table), ('Messages,Summary', (5, 1), 'Drafts'))
+        self.assertEqual(plan.tables(), ['Messages', 'Summary', 'Drafts'])
+
+    def test_undeclared_role(self):
+        with self.assertRaises(ValueError):
+            Plan.ConvoPlan.compile("<InteractionModel><Roles/><ConvoLoop><Ghost/></ConvoLoop></InteractionModel>")
+
+    def test_disk_cache_skips_parsing(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            with mock.patch.dict(Plan._plans, clear=True):
+                plan = Plan.load_plan(self.xml_string, cache_dir)
+                path = os.path.join(cache_dir, plan.digest + '.json')
+                with open(path) as f:
+                    self.assertEqual(json.load(f), json.loads(json.dumps(plan.as_dict())))
+            with mock.patch.dict(Plan._plans, clear=True), \
+                    mock.patch.object(Plan.ConvoPlan, 'compile', side_effect=AssertionError('parsed again')):
+                cached = Plan.load_plan(self.xml_string, cache_dir)
+            self.assertEqual((cached.roles, cached.steps, cached.budgets), (plan.roles, plan.steps, plan.budgets))
+            self.assertEqual(cached.role_index.keys(), plan.role_index.keys())
+
+    def test_disk_cache_ignores_files_that_are_not_plans(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            digest = Plan.ConvoPlan.hash(self.xml_string)
+            with open(os.path.join(cache_dir, digest + '.json'), 'w') as f:
+                f.write('{"digest": "other"}')
+            with mock.patch.dict(Plan._plans, clear=True):
+                plan = Plan.load_plan(self.xml_string, cache_dir)
+            self.assertEqual(plan.digest, digest)
+            self.assertEqual(plan.steps, Plan.ConvoPlan.compile(self.xml_string).steps)
+
+
+class TestLazyImports(unittest.TestCase):
+    def test_import_does_not_load_provider_sdks(self):
+        probe = "import sys, ConvoXML; print([m for m in ('openai', 'google.generativeai', 'bs4') if m in sys.modules])"
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.check_output([sys.executable, '-c', probe], cwd=root, text=True)
+        self.assertEqual(output.strip(), '[]')
+
+    def test_registry_resolves_references_on_first_use(self):
+        registry = AgentRegistry({'Agent': 'ConvoXML.Agents:TestAgent'})
+        self.assertIs(registry['Agent'], TestAgent)
+        self.assertIs(registry._entries['Agent'], TestAgent)
+
+    def test_registry_entry_points(self):
+        entry_point = mock.Mock()
+        entry_point.name = 'PluginAgent'
+        entry_point.load.return_value = SleepyAgent
+        with mock.patch('importlib.metadata.entry_points', return_value=[entry_point]):
+            registry = AgentRegistry()
+            self.assertIn('PluginAgent', registry)
+            self.assertIs(registry.get('PluginAgent'), SleepyAgent)
+            self.assertIsNone(registry.get('Missing'))
+
+
+class TestInstrumentation(unittest.TestCase):
+    def test_histogram_percentiles(self):
+        histogram = Histogram()
+        for value in range(1, 1001):
+            histogram.record(value / 1000)
+        self.assertEqual(histogram.count, 1000)
+        self.assertAlmostEqual(histogram.percentile(50), 0.5, delta=0.5 / 16)
+        self.assertAlmostEqual(histogram.percentile(99), 0.99, delta=0.99 / 16)
+        self.assertEqual(histogram.percentile(100), 1.0)
+
+    def test_run_records_agent_and_iteration_timings(self):
+        instrumentation = Instrumentation()
+        events = []
+        instrumentation.add_hook(lambda name, value, labels: events.append(name))
+        with open(os.path.join(EXAMPLES_DIR, 'test_xml.xml'), 'r') as f:
+            parser = ConvoXML(f.read(), db_path='instrumentation_test.db', instrumentation=instrumentation)
+        parser.run()
+        parser.close()
+        remove_db('instrumentation_test.db')
+
+        self.assertEqual(instrumentation.histogram('agent.execute').count, parser.steps)
+        self.assertEqual(instrumentation.histogram('agent.execute', role='Moderator').count, 6)
+        self.assertEqual(instrumentation.histogram('run.iteration').count, 6)
+        self.assertGreater(instrumentation.histogram('agent.output_message').count, 0)
+        self.assertIn('agent.execute', events)
+
+        text = instrumentation.to_prometheus()
+        self.assertIn('# TYPE convoxml_agent_execute_seconds histogram', text)
+        self.assertIn('convoxml_agent_execute_seconds_count{role="Moderator"} 6', text)
+        self.assertIn('"name": "run.iteration"', instrumentation.to_json())
+
+    def test_counters(self):
+        instrumentation = Instrumentation()
+        instrumentation.count('provider.prompt_tokens', 10, role='a', model='m')
+        instrumentation.count('provider.prompt_tokens', 5, role='b', model='m')
+        self.assertEqual(instrumentation.counter('provider.prompt_tokens'), 15)
+        self.assertEqual(instrumentation.counter('provider.prompt_tokens', role='a'), 10)
+        self.assertIn('convoxml_provider_prompt_tokens_total{model="m",role="a"} 10', instrumentation.to_prometheus())
+
+    def test_disabled_records_nothing(self):
+        with NULL_INSTRUMENTATION.timer('agent.execute'):
+            pass
+        NULL_INSTRUMENTATION.count('provider.prompt_tokens', 3)
+        self.assertEqual(NULL_INSTRUMENTATION.histograms, {})
+        self.assertEqual(NULL_INSTRUMENTATION.counters, {})
+
+
+class TestResponseCache(unittest.TestCase):
+    def test_memory_lru_and_ttl(self):
+        cache = ResponseCache(max_entries=2)
+        cache.set('a', 'A')
+        cache.set('b', 'B')
+        cache.get('a')
+        cache.set('c', 'C')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 'A')
+        cache.set('d', 'D', ttl=-1)
+        self.assertIsNone(cache.get('d'))
+        self.assertEqual(cache.stats()['hits'], 2)
+        self.assertEqual(cache.stats()['misses'], 2)
+
+    def test_disk_tier_survives_restart(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'responses.db')
+            cache = ResponseCache(path)
+            cache.set(ResponseCache.key('m', [{'content': 'hi'}]), 'hello')
+            cache.close()
+            reopened = ResponseCache(path)
+            self.assertEqual(reopened.get(ResponseCache.key('m', [{'content': 'hi'}])), 'hello')
+            self.assertEqual(reopened.stats()['disk_hits'], 1)
+            reopened.close()
+
+    def test_role_attributes(self):
+        self.assertIsNone(response_cache_from_params({'response_cache': 'false'}))
+        cache = response_cache_from_params({'response_cache': 'true', 'response_cache_ttl': '60'})
+        self.assertEqual(cache.ttl, 60.0)
+        self.assertIs(cache, response_cache_from_params({'response_cache': 'yes', 'response_cache_ttl': '60'}))
+
+    def test_openai_agent_skips_cached_calls(self):
+        connections = ConnectionManager(':memory:')
+        Schema.migrate(connections.connection())
+        agent = OpenAIAgent(role='Writer', context=Context.isolated(openai_key='key'), connections=connections,
+                            response_cache=ResponseCache())
+        agent.client = mock.Mock()
+        agent.client.chat.completions.create.return_value.choices = [mock.Mock(message=mock.Mock(content='answer'))]
+        self.assertEqual(agent.send_message(['question']), 'answer')
+        self.assertEqual(agent.send_message(['question']), 'answer')
+        self.assertEqual(agent.client.chat.completions.create.call_count, 1)
+        agent.send_message(['another question'])
+        self.assertEqual(agent.client.chat.completions.create.call_count, 2)
+        connections.close()
+
+
+def stream_chunks(*texts):
+    chunks = [mock.Mock(usage=None, choices=[mock.Mock(delta=mock.Mock(content=text))]) for text in texts]
+    return chunks + [mock.Mock(choices=[], usage=mock.Mock(prompt_tokens=3, completion_tokens=len(texts)))]
+
+
+class TestStreaming(unittest.TestCase):
+    def setUp(self):
+        self.connections = ConnectionManager(':memory:')
+        Schema.migrate(self.connections.connection())
+
+    def tearDown(self):
+        self.connections.close()
+
+    def make_agent(self, **params):
+        return OpenAIAgent(role='Writer', context=Context.isolated(openai_key='key'),
+                           connections=self.connections, **params)
+
+    def test_tag_stream_splits_tags_across_chunks(self):
+        stream = ResponseTagStream('answer')
+        chunks = ['<thinking>hm</thinking><ans', 'wer>Hel', 'lo wor', 'ld</ans', 'wer> trailing']
+        output = [stream.feed(chunk) for chunk in chunks] + [stream.close()]
+        self.assertEqual(''.join(output), 'Hello world')
+        self.assertEqual(output[:2], ['', 'Hel'])
+        self.assertEqual(stream.text, ''.join(chunks))
+
+    def test_tag_stream_without_tag(self):
+        self.assertEqual(ResponseTagStream().feed('abc'), 'abc')
+        stream = ResponseTagStream('answer')
+        self.assertEqual(stream.feed('no tags here'), '')
+        self.assertEqual(stream.close(), 'no tags here')
+
+    def test_stream_message_persists_final_message(self):
+        instrumentation = Instrumentation()
+        agent = self.make_agent(response_tag='answer', instrumentation=instrumentation)
+        agent.client = mock.Mock()
+        agent.client.chat.completions.create.return_value = iter(stream_chunks('<answer>Hi', ' there', '</answer>'))
+        chunks = []
+        for chunk in agent.stream_message(['question']):
+            chunks.append(chunk)
+            # nothing is stored until the reply is complete
+            self.assertEqual(agent.get_messages('Messages', 1), [])
+        self.assertEqual(''.join(chunks), 'Hi there')
+        self.assertEqual(agent.get_messages('Messages', 1)[0][Schema.CONTENT], 'Hi there')
+        self.assertEqual(agent.last_response, 'Hi there')
+        self.assertEqual(instrumentation.histogram('provider.first_token').count, 1)
+        self.assertEqual(instrumentation.counter('provider.completion_tokens'), 3)
+
+    def test_execute_streams_to_on_chunk(self):
+        received = []
+        agent = self.make_agent(stream='true', on_chunk=lambda agent, text: received.append(text))
+        agent.client = mock.Mock()
+        agent.client.chat.completions.create.return_value = iter(stream_chunks('a', 'b', 'c'))
+        agent.get_inputs = lambda: ['question']
+        self.assertEqual(agent.execute(), 'abc')
+        self.assertEqual(received, ['a', 'b', 'c'])
+        self.assertTrue(agent.client.chat.completions.create.call_args.kwargs['stream'])
+
+    def test_async_stream(self):
+        agent = self.make_agent()
+
+        async def chunks():
+            for chunk in stream_chunks('x', 'y'):
+                yield chunk
+
+        agent.async_client = mock.Mock()
+        agent.async_client.chat.completions.create = mock.AsyncMock(return_value=chunks())
+
+        async def consume():
+            return [chunk async for chunk in agent.astream_message(['question'])]
+
+        self.assertEqual(asyncio.run(consume()), ['x', 'y'])
+        self.assertEqual(agent.get_messages('Messages', 1)[0][Schema.CONTENT], 'xy')
+
+    def test_streamed_reply_is_cached(self):
+        agent = self.make_agent(response_cache=ResponseCache())
+        agent.client = mock.Mock()
+        agent.client.chat.completions.create.return_value = iter(stream_chunks('cached', ' reply'))
+        self.assertEqual(list(agent.stream_message(['question'])), ['cached', ' reply'])
+        self.assertEqual(list(agent.stream_message(['question'])), ['cached reply'])
+        self.assertEqual(agent.client.chat.completions.create.call_count, 1)
+
+    def test_default_execute_stream_yields_result(self):
+        agent = TestAgent(role='Tester', connections=self.connections, test_message='done')
+        self.assertEqual(list(agent.execute_stream()), [])
+        with mock.patch.object(TestAgent, 'execute', lambda self: self.send_message()):
+            self.assertEqual(list(agent.execute_stream()), ['done'])
+
+
+class TestTagParser(unittest.TestCase):
+    def test_events_across_chunks(self):
+        parser = TagParser(['python'])
+        events = []
+        for chunk in 'Run <Python lang="py">print(1 < 2)</py|thon> and <b>done</b>'.split('|'):
+            events += parser.feed(chunk)
+        events += parser.close()
+        self.assertEqual(events, [(TEXT, None, 'Run '), (START, 'python', ''), (DATA, 'python', 'print(1 < 2)'),
+                                  (END, 'python', ''), (TEXT, None, ' and <b>done</b>')])
+
+    def test_malformed_output(self):
+        self.assertEqual(extract_tag('<answer>unclosed & <not xml', 'answer'), 'unclosed & <not xml')
+        self.assertEqual(extract_tag('<reply><answer>a</answer><answer>b</answer></reply>', 'answer'), 'a')
+        self.assertIsNone(extract_tag('a < b > c', 'answer'))
+        self.assertEqual({kind for kind, _, _ in TagParser.parse('x <pyth', ['python'])}, {TEXT})
+
+    def test_parse_response(self):
+        agent = TestAgent(role='Tester', connections=ConnectionManager(':memory:'), response_tag='answer')
+        self.assertEqual(agent.parse_response('<thinking>hm</thinking>\n<answer>42</answer>'), '42')
+        self.assertEqual(agent.parse_response('no tag'), 'no tag')
+
+    def test_terminal_interface_runs_sections_in_order(self):
+        agent = AgentTerminalInterface(role='Developer', connections=ConnectionManager(':memory:'))
+        response = agent.parse_response('a <python>print(6 * 7)</python> b <terminal>echo hi</terminal> c')
+        self.assertEqual(response, 'a <python>42\n</python> b <terminal>hi\n</terminal> c')
+
+
+class TestSandboxPool(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.pool = SandboxPool(workers=2, timeout=2)
+        # wait for both interpreters to finish starting
+        cls.pool.run_many([('python', 'import time; time.sleep(0.1)')] * 2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.close()
+
+    def test_python_and_terminal_blocks(self):
+        python, terminal, error = self.pool.run_many([('python', 'print(6 * 7)'), ('terminal', 'echo hi'),
+                                                      ('python', '1 / 0')])
+        self.assertEqual((python.status, python.output), ('ok', '42\n'))
+        self.assertEqual((terminal.status, terminal.output), ('ok', 'hi\n'))
+        self.assertEqual(error.status, 'error')
+        self.assertIn('ZeroDivisionError', error.output)
+        self.assertGreater(python.elapsed, 0)
+
+    def test_blocks_run_concurrently(self):
+        started = time.perf_counter()
+        results = self.pool.run_many([('python', 'import time; time.sleep(0.5)')] * 2)
+        self.assertLess(time.perf_counter() - started, 0.9)
+        self.assertEqual([result.status for result in results], ['ok', 'ok'])
+
+    def test_limits(self):
+        self.assertEqual(self.pool.run('python', 'while True: pass', timeout=0.2).status, 'timeout')
+        self.assertEqual(self.pool.run('terminal', 'sleep 5', timeout=0.2).status, 'timeout')
+        result = self.pool.run('python', 'print("x" * 1000)', output_limit=10)
+        self.assertEqual((result.output, result.truncated), ('x' * 10, True))
+        if sys.platform.startswith('linux'):
+            result = self.pool.run('python', 'data = bytearray(1024 * 1024 * 1024)', memory_limit=512 * 1024 * 1024)
+            self.assertIn('MemoryError', result.output)
+
+    def test_blocks_are_isolated(self):
+        with SandboxPool(workers=1, timeout=2) as pool:
+            pool.run('python', "import os, json, threading, time\n"
+                               "os.environ['LEAK'] = 'yes'\n"
+                               "json.dumps = lambda *args, **kwargs: 'hijacked'\n"
+                               "threading.Thread(target=lambda: time.sleep(60), daemon=False).start()")
+            python = pool.run('python', "import os, json, threading\n"
+                                        "print(os.environ.get('LEAK'), json.dumps(1), threading.active_count())")
+            terminal = pool.run('terminal', 'echo "[$LEAK]"')
+        self.assertEqual(python.output, 'None 1 1\n')
+        self.assertEqual(terminal.output, '[]\n')
+
+    def test_child_process_output_is_captured(self):
+        result = self.pool.run('python', "import os, subprocess\n"
+                                         "os.system('echo from-shell')\n"
+                                         "subprocess.run(['echo', 'from-subprocess'])")
+        self.assertEqual(result.output, 'from-shell\nfrom-subprocess\n')
+        result = self.pool.run('python', "import os; os.system('echo oops >&2'); raise SystemExit(3)")
+        self.assertEqual((result.status, result.output), ('error', 'oops\n'))
+
+    def test_dead_worker_is_replaced(self):
+        self.assertEqual(self.pool.run('python', 'import os, signal; os.kill(os.getppid(), signal.SIGKILL)').status,
+                         'error')
+        self.assertEqual(self.pool.run_many([('python', 'print(1)')] * 2)[1].output, '1\n')
+
+
+class FakeAPIError(Exception):
+    def __init__(self, status_code, retry_after=None):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+        self.response = mock.Mock(headers={'retry-after': retry_after} if retry_after else {})
+
+
+class TestProviders(unittest.TestCase):
+    def test_token_bucket_spaces_requests(self):
+        bucket = TokenBucket(rate=20, capacity=1)
+        started = time.perf_counter()
+        for _ in range(4):
+            bucket.acquire()
+        self.assertGreaterEqual(time.perf_counter() - started, 0.14)
+        bucket.pause(0.1)
+        self.assertGreater(bucket.reserve(), 0.09)
+
+    def test_retries_with_retry_after(self):
+        call = mock.Mock(side_effect=[FakeAPIError(429, retry_after='0.01'), FakeAPIError(503, retry_after='0'), 'ok'])
+        retried = []
+        result = call_with_retries(call, retries=3, on_retry=lambda error, delay: retried.append((error.status_code, delay)))
+        self.assertEqual(result, 'ok')
+        self.assertEqual(retried, [(429, 0.01), (503, 0.0)])
+
+    def test_gives_up(self):
+        with self.assertRaises(FakeAPIError):
+            call_with_retries(mock.Mock(side_effect=FakeAPIError(400)), retries=3)
+        call = mock.Mock(side_effect=FakeAPIError(500, retry_after='0'))
+        with self.assertRaises(FakeAPIError):
+            asyncio.run(acall_with_retries(mock.AsyncMock(side_effect=call.side_effect), retries=2))
+        self.assertTrue(0 <= retry_delay(FakeAPIError(500), attempt=3, backoff=0.5) <= 4)
+
+    def test_agents_share_clients_and_limiters(self):
+        clients = ProviderClients()
+        self.assertIs(clients.openai('key', 'http://localhost/v1'), clients.openai('key', 'http://localhost/v1'))
+        self.assertIsNot(clients.openai('key', 'http://localhost/v1'), clients.openai('other', 'http://localhost/v1'))
+        self.assertIsNone(clients.limiter('key', 'model'))
+        limiter = clients.limiter('key', 'model', requests_per_minute='120')
+        self.assertEqual(limiter.rate, 2)
+        self.assertIs(clients.limiter('key', 'model'), limiter)
+        clients.close()
+
+    def test_agent_retries_provider_errors(self):
+        connections = ConnectionManager(':memory:')
+        Schema.migrate(connections.connection())
+        instrumentation = Instrumentation()
+        agent = OpenAIAgent(role='Writer', context=Context.isolated(openai_key='key'), connections=connections,
+                            instrumentation=instrumentation)
+        agent.client = mock.Mock()
+        agent.client.chat.completions.create.side_effect = [
+            FakeAPIError(429, retry_after='0'), mock.Mock(usage=None, choices=[mock.Mock(message=mock.Mock(content='answer'))])]
+        self.assertEqual(agent.send_message(['question']), 'answer')
+        self.assertEqual(instrumentation.counter('provider.retries', status='429'), 1)
+        connections.close()
+
+
+class TestRequestBatcher(unittest.TestCase):
+    def test_concurrent_requests_share_a_batch(self):
+        batches = []
+
+        def submit_batch(requests):
+            batches.append(list(requests))
+            return [request * 2 for request in requests]
+
+        batcher = RequestBatcher(submit_batch, window=0.05)
+        results = {}
+        threads = [threading.Thread(target=lambda n=n: results.update({n: batcher.submit(n)})) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        batcher.close()
+        self.assertEqual(results, {n: n * 2 for n in range(8)})
+        self.assertEqual(sorted(sum(batches, [])), list(range(8)))
+        self.assertLess(len(batches), 8)
+        self.assertEqual(batcher.requests, 8)
+
+    def test_errors_reach_their_callers(self):
+        batcher = RequestBatcher(lambda requests: [BatchRequestError('bad') if r == 'bad' else r for r in requests])
+        self.assertEqual(batcher.submit('good'), 'good')
+        with self.assertRaises(BatchRequestError):
+            batcher.submit('bad')
+        batcher.submit_batch = mock.Mock(side_effect=RuntimeError('down'))
+        with self.assertRaises(RuntimeError):
+            batcher.submit('good')
+        batcher.close()
+
+    def test_openai_agents_post_to_batch_endpoint(self):
+        completion = {'id': 'c', 'object': 'chat.completion', 'created': 0, 'model': 'm',
+                      'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': 'hi'}}]}
+        client = mock.Mock()
+        client.post.side_effect = lambda path, cast_to, body: {'responses': [completion] * len(body['requests'])}
+        batcher = RequestBatcher(openai_batch_submitter(client, '/chat/completions/batch'), window=0.05)
+        connections = ConnectionManager(':memory:')
+        Schema.migrate(connections.connection())
+        agents = [OpenAIAgent(role=f'Writer{n}', context=Context.isolated(openai_key='key'), connections=connections)
+                  for n in range(3)]
+        threads = []
+        for agent in agents:
+            agent.batcher = batcher
+            threads.append(threading.Thread(target=agent.send_message, args=(['question'],)))
+            threads[-1].start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(batcher.requests, 3)
+        self.assertLess(client.post.call_count, 3)
+        self.assertEqual(client.post.call_args.args[0], '/chat/completions/batch')
+        self.assertEqual([agent.get_messages('Messages', 1)[0][Schema.CONTENT] for agent in agents], ['hi'] * 3)
+        batcher.close()
+        connections.close()
+
+    def test_shared_batcher_checks_each_agents_budget(self):
+        completion = {'id': 'c', 'object': 'chat.completion', 'created': 0, 'model': 'm',
+                      'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': 'hi'}}],
+                      'usage': {'prompt_tokens': 5, 'completion_tokens': 5, 'total_tokens': 10}}
+        client = mock.Mock()
+        client.post.side_effect = lambda path, cast_to, body: {'responses': [completion] * len(body['requests'])}
+        governor = BudgetGovernor(thread_budget=Plan.BudgetSpec('thread', None, 10, None, None, 0.0, 0.0))
+        connections = ConnectionManager(':memory:')
+        Schema.migrate(connections.connection())
+        agents = []
+        with mock.patch.object(PROVIDER_CLIENTS, 'openai', return_value=client):
+            for thread_id in ('spent', 'fresh'):
+                agents.append(OpenAIAgent(role='Writer', thread_id=thread_id, budget=governor, batch_endpoint='/batch',
+                                          context=Context.isolated(openai_key='shared-batcher-key'),
+                                          connections=connections))
+        spent, fresh = agents
+        self.assertIs(spent.batcher, fresh.batcher)
+        self.assertEqual(spent.send_message(['question']), 'hi')
+        # the first agent's thread is out of tokens, the second one's isn't
+        with self.assertRaises(BudgetExceeded):
+            spent.send_message(['question'])
+        self.assertEqual(fresh.send_message(['question']), 'hi')
+        with self.assertRaises(BudgetExceeded):
+            fresh.send_message(['question'])
+        self.assertEqual(client.post.call_count, 2)
+        spent.batcher.close()
+        connections.close()
+
+
+class TestContextWindow(unittest.TestCase):
+    def setUp(self):
+        self.connections = ConnectionManager(':memory:')
+        Schema.migrate(self.connections.connection())
+        self.writer = MessageWriter(self.connections)
+
+    def tearDown(self):
+        self.connections.close()
+
+    def write(self, *contents):
+        for content in contents:
+            self.writer.write('Messages', 't1', 'alice', content)
+
+    def test_get_inputs_returns_last_rows_oldest_first(self):
+        agent = TestAgent(role='Reader', connections=self.connections, thread_id='t1', rows=3)
+        self.write('one', 'two', 'three', 'four')
+        self.assertEqual(agent.get_inputs(), ['two', 'three', 'four'])
+
+    def test_count_tokens_is_cached(self):
+        count_tokens.cache_clear()
+        self.assertGreater(count_tokens('Hello, world!'), 1)
+        count_tokens('Hello, world!')
+        self.assertEqual(count_tokens.cache_info().hits, 1)
+        self.assertEqual(truncate_tokens('a b c d e f', 3), 'd e f')
+
+    def test_budget_trims_oldest_messages(self):
+        window = ContextWindow(budget=4)
+        rows = [(n, 't1', None, 'alice', f'word{n} word', None, None, None) for n in range(1, 5)]
+        self.assertEqual(window.build(('Messages', 't1'), rows), ['word3 word', 'word4 word'])
+
+    def test_rolling_summary_is_incremental(self):
+        summarized = []
+
+        def summarize(summary, rows):
+            summarized.extend(row[Schema.CONTENT] for row in rows)
+            return extractive_summary(summary, rows)
+
+        agent = TestAgent(role='Reader', connections=self.connections, thread_id='t1', rows=3,
+                          token_budget='40', summary_tokens='20')
+        agent.context_window.summarize = summarize
+        self.write('First point. Details.', 'Second point.', 'Third.')
+        self.assertEqual(agent.get_inputs(), ['First point. Details.', 'Second point.', 'Third.'])
+        self.write('Fourth.', 'Fifth.')
+        inputs = agent.get_inputs()
+        self.assertEqual(inputs, ['Summary of earlier messages: alice: First point. alice: Second point.',
+                                  'Third.', 'Fourth.', 'Fifth.'])
+        agent.get_inputs()
+        self.write('Sixth.')
+        agent.get_inputs()
+        self.assertEqual(summarized, ['First point. Details.', 'Second point.', 'Third.'])
+
+    def test_summary_stays_within_budget(self):
+        agent = TestAgent(role='Reader', connections=self.connections, thread_id='t1', rows=2,
+                          token_budget='30', summary_tokens='10')
+        for n in range(50):
+            self.write(f'Message number {n} says something.')
+            summary = agent.get_inputs()[0]
+        self.assertTrue(summary.startswith('Summary of earlier messages: '))
+        self.assertLessEqual(count_tokens(summary[len('Summary of earlier messages: '):]), 10)
+        self.assertIn('47', summary)
+
+
+def check_message_store(test, store):
+    for content in ('one', 'two', 'three'):
+        store.write('Messages', 't1', 'alice', content)
+    store.write('Messages', 't2', 'bob', 'other')
+    store.write_many('Messages', 't1', 'alice', ['four'])
+    test.assertEqual([row[Schema.CONTENT] for row in store.last('Messages', 't1', 2)], ['four', 'three'])
+    test.assertEqual(len(store.last('Messages', 't1')), 4)
+    test.assertEqual(store.last('Messages', 'missing', 5), [])
+    ids = [row[Schema.MESSAGE_ID] for row in store.last('Messages', 't1')]
+    test.assertEqual(ids, sorted(ids, reverse=True))
+    between = store.between('Messages', 't1', ids[-1], ids[0])
+    test.assertEqual([row[Schema.CONTENT] for row in between], ['two', 'three'])
+
+
+class TestMessageStores(unittest.TestCase):
+    STORES_XML = """
+    <InteractionModel>
+      <Roles>
+        <Role name="Writer" class="TestAgent" test_message="draft"><output table="Drafts" store="memory"/></Role>
+        <Role name="Reader" class="TestAgent"><input table="Drafts" rows="2" store="memory"/></Role>
+      </Roles>
+      <ConvoLoop><Writer/><Reader/></ConvoLoop>
+    </InteractionModel>"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_memory_store(self):
+        check_message_store(self, MemoryStore())
+
+    def test_log_store(self):
+        store = LogStore(self.directory)
+        check_message_store(self, store)
+        store.close()
+
+    def test_log_store_reopens_and_drops_partial_record(self):
+        store = LogStore(self.directory)
+        store.write('Messages', 't1', 'alice', 'kept')
+        store.close()
+        with open(os.path.join(self.directory, 'Messages.jsonl'), 'ab') as f:
+            f.write(b'[2, "t1", "2024-01-01 00:00:00", "alice", "cut sh')
+        store = LogStore(self.directory)
+        store.write('Messages', 't1', 'alice', 'after')
+        self.assertEqual([row[Schema.CONTENT] for row in store.last('Messages', 't1')], ['after', 'kept'])
+        self.assertEqual(store.last('Messages', 't1', 1)[0][Schema.MESSAGE_ID], 2)
+        store.close()
+
+    def test_tables_are_routed_to_their_declared_store(self):
+        parser = ConvoXML(self.STORES_XML, db_path=':memory:')
+        try:
+            self.assertIsInstance(parser.store.store('Drafts'), MemoryStore)
+            self.assertIsInstance(parser.store.store('Messages'), SQLiteStore)
+            self.assertFalse(Schema.table_exists(parser.db_connection, 'Drafts'))
+            writer, reader = parser.agents
+            reader.thread_id = writer.thread_id
+            writer.execute()
+            writer.execute()
+            writer.execute()
+            self.assertEqual(reader.get_inputs(), ['draft', 'draft'])
+        finally:
+            parser.close()
+
+    def test_default_store_option(self):
+        parser = ConvoXML(self.STORES_XML, db_path=':memory:', store='log', log_dir=self.directory)
+        try:
+            self.assertIsInstance(parser.store.store('Messages'), LogStore)
+            self.assertIsInstance(parser.store.store('Drafts'), MemoryStore)
+        finally:
+            parser.close()
+
+    def test_conflicting_and_unknown_stores(self):
+        conflicting = self.STORES_XML.replace('rows="2" store="memory"', 'rows="2" store="log"')
+        with self.assertRaises(ValueError):
+            Plan.ConvoPlan.compile(conflicting).table_stores()
+        with self.assertRaises(ValueError):
+            ConvoXML(self.STORES_XML.replace('"memory"', '"redis"'), db_path=':memory:')
+
+
+class TestTranscriptLog(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'Messages')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def contents(self, rows):
+        return [row[Schema.CONTENT] for row in rows]
+
+    def test_store_contract(self):
+        store = TranscriptStore(self.directory)
+        check_message_store(self, store)
+        store.close()
+
+    def test_segments_roll_over_and_reopen(self):
+        log = TranscriptLog(self.path, segment_size=256)
+        for n in range(20):
+            log.append(f"t{n % 2}", 'alice', f"message {n}")
+        log.append('t0', 'alice', 'x' * 1000)
+        self.assertGreater(len(glob.glob(os.path.join(self.path, '*.seg'))), 5)
+        self.assertEqual(self.contents(log.tail('t0', 2)), ['x' * 1000, 'message 18'])
+        log.close()
+
+        log = TranscriptLog(self.path, segment_size=256)
+        self.assertEqual(log.records, 21)
+        self.assertEqual(log.append('t1', 'bob', 'after'), 22)
+        self.assertEqual(self.contents(log.tail('t1', 2)), ['after', 'message 19'])
+        self.assertEqual(self.contents(log.between('t1', 17, 22)), ['message 17', 'message 19'])
+        self.assertEqual(self.contents(log)[-2:], ['x' * 1000, 'after'])
+        log.close()
+
+    def test_torn_record_is_overwritten(self):
+        log = TranscriptLog(self.path)
+        log.append('t1', 'alice', 'kept')
+        log.append('t1', 'alice', 'torn')
+        log.flush()
+        segment = log._maps[-1]
+        # corrupt the last record as if the process died while writing it
+        segment[log.position - 1:log.position] = b'?'
+        segment.close()
+        log = TranscriptLog(self.path)
+        self.assertEqual(self.contents(log.tail('t1')), ['kept'])
+        log.append('t1', 'alice', 'next')
+        self.assertEqual(self.contents(log.tail('t1')), ['next', 'kept'])
+        log.close()
+
+    def test_compact_and_export(self):
+        log = TranscriptLog(self.path, segment_size=512)
+        for n in range(30):
+            log.append(f"t{n % 3}", 'alice', f"message {n}")
+        self.assertEqual(log.compact(keep_last=2, drop_threads=['t2']), 26)
+        self.assertEqual(log.records, 4)
+        self.assertEqual(self.contents(log.tail('t0')), ['message 27', 'message 24'])
+        self.assertEqual(log.tail('t2'), [])
+        self.assertEqual(log.tail('t1', 1)[0][Schema.MESSAGE_ID], 29)
+        self.assertFalse(os.path.exists(self.path + '.compacting'))
+
+        connections = ConnectionManager(':memory:')
+        Schema.migrate(connections.connection())
+        self.assertEqual(log.export(connections), 4)
+        rows = connections.execute("SELECT thread_id, content FROM Messages ORDER BY message_id").fetchall()
+        self.assertEqual(rows, [('t0', 'message 24'), ('t1', 'message 25'), ('t0', 'message 27'), ('t1', 'message 28')])
+        connections.close()
+        log.close()
+
+    def test_agents_tail_the_transcript(self):
+        parser = ConvoXML(TestMessageStores.STORES_XML.replace('"memory"', '"transcript"'),
+                          db_path=':memory:', log_dir=self.directory)
+        try:
+            writer, reader = parser.agents
+            reader.thread_id = writer.thread_id
+            for _ in range(3):
+                writer.execute()
+            self.assertEqual(reader.get_inputs(), ['draft', 'draft'])
+            self.assertEqual(parser.store.store('Drafts').export(parser.connections), {'Drafts': 3})
+        finally:
+            parser.close()
+
+
+class TestAgentState(unittest.TestCase):
+    def setUp(self):
+        with open(os.path.join(EXAMPLES_DIR, 'test_xml.xml'), 'r') as f:
+            self.parser = ConvoXML(f.read(), db_path=':memory:')
+
+    def tearDown(self):
+        self.parser.close()
+
+    def test_agents_have_no_instance_dict(self):
+        for agent in self.parser.agents:
+            self.assertFalse(hasattr(agent, '__dict__'))
+            self.assertFalse(hasattr(agent, 'connection'))
+
+    def test_forks_share_the_role_spec(self):
+        fork = self.parser.fork()
+        for agent, forked in zip(self.parser.agents, fork.agents):
+            self.assertIs(agent.spec, forked.spec)
+            self.assertIs(agent.attributes, forked.attributes)
+            self.assertEqual(dict(forked.attributes), dict(forked.spec.attributes))
+            with self.assertRaises(TypeError):
+                forked.attributes['name'] = 'Impostor'
+
+    def test_xml_attributes_read_as_attributes(self):
+        agent = TestAgent(role='Tester', connections=self.parser.connections, sandbox_timeout='5')
+        self.assertEqual(agent.sandbox_timeout, '5')
+        self.assertIsNone(getattr(agent, 'batch_endpoint', None))
+        with self.assertRaises(AttributeError):
+            agent.missing
+
+
+class PickingModerator(TestAgent):
+    __slots__ = ()
+
+    def execute(self):
+        self.send_message('pick')
+        if self.messages_sent >= 3:
+            self.context.exit = True
+        return self.pick
+
+
+class ReadingAgent(TestAgent):
+    __slots__ = ('inputs',)
+
+    def execute(self):
+        # the inputs of every turn, to check which messages reached the agent
+        self.inputs = getattr(self, 'inputs', []) + [self.get_inputs()]
+        return super().execute()
+
+
+class TestConvoScheduler(unittest.TestCase):
+    def senders(self, parser):
+        rows = parser.connections.execute("SELECT sender FROM Messages ORDER BY message_id")
+        return [sender for sender, in rows.fetchall()]
+
+    def test_dispatch_matches_the_whole_role(self):
+        parser = make_parser(
+            '<Role name="Mod" class="PickingModerator" pick="Agent1"/><Role name="Agent1"/><Role name="Agent10"/>',
+            '<Mod><Agent1/><Agent10/></Mod>')
+        parser.run()
+        self.assertEqual(self.senders(parser), ['Mod', 'Agent1'] * 3)
+        parser.close()
+
+    def test_test_moderator_returns_the_role(self):
+        with open(os.path.join(EXAMPLES_DIR, 'test_xml.xml'), 'r') as f:
+            parser = ConvoXML(f.read(), db_path=':memory:')
+        moderator = parser.agents[0]
+        self.assertIn(moderator.execute(), ['Participant1', 'Participant2', 'Participant3'])
+        parser.close()
+
+    def test_loop_without_moderator_stops_when_idle(self):
+        parser = make_parser('<Role name="Solo"/>', '<Solo/>')
+        started = time.monotonic()
+        parser.run()
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(self.senders(parser), ['Solo'])
+        parser.close()
+
+    def test_only_agents_with_new_messages_run(self):
+        parser = make_parser(
+            '<Role name="Writer"><output table="Notes"/></Role>'
+            '<Role name="Reader"><input table="Notes"/><output table="Replies"/></Role>',
+            '<Writer/><Reader/>')
+        for agent in parser.agents:
+            agent.thread_id = 'shared'
+        parser.run()
+        counts = [parser.connections.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in ('Notes', 'Replies')]
+        self.assertEqual(counts, [1, 1])
+        parser.close()
+
+    def test_notify_wakes_an_idle_run(self):
+        parser = make_parser('<Role name="Solo"/>', '<Solo/>', idle_timeout=0.5)
+        timer = threading.Timer(0.1, parser.notify, ['solo'])
+        timer.start()
+        parser.run()
+        timer.join()
+        self.assertEqual(self.senders(parser), ['Solo', 'Solo'])
+        parser.close()
+
+    def test_list_selects_several_members(self):
+        parser = make_parser(
+            '<Role name="Mod" class="PickingModerator"/><Role name="A"/><Role name="B"/><Role name="C"/>',
+            '<Mod><A/><B/><C/></Mod>')
+        scheduler = ConvoScheduler(parser)
+        dispatch = scheduler.steps[0][1]
+        self.assertEqual([agent.role for agent in scheduler.select(dispatch, ['c', ' A '])], ['C', 'A'])
+        self.assertEqual(scheduler.select(dispatch, None), [])
+        parser.close()
+
+
+class SlowAgent(TestAgent):
+    __slots__ = ()
+
+    async def execute(self):
+        await asyncio.sleep(5)
+        return self.send_message()
+
+
+class TestBudgetGovernor(unittest.TestCase):
+    def test_plan_compiles_budgets(self):
+        plan = Plan.ConvoPlan.compile(
+            '<InteractionModel><Budget max_turns="10" max_spend="2.5" prompt_price="0.5"/>'
+            '<Budget scope="thread" max_tokens="100"/><Roles/><ConvoLoop/></InteractionModel>')
+        self.assertEqual(plan.budget('run'), Plan.BudgetSpec('run', 10, None, None, 2.5, 0.5, 0.0))
+        self.assertEqual(plan.budget('thread').max_tokens, 100)
+        for budgets in ('<Budget/><Budget/>', '<Budget scope="role"/>', '<Budget max_turns="many"/>'):
+            with self.assertRaises(ValueError):
+                Plan.ConvoPlan.compile(f"<InteractionModel>{budgets}<Roles/><ConvoLoop/></InteractionModel>")
+
+    def test_thread_budget_stops_only_its_thread(self):
+        parser = make_parser(
+            '<Role name="Mod" class="PickingModerator" pick="A"/><Role name="A"/><Role name="Solo"/>',
+            '<Mod><A/></Mod><Solo/>',
+            budgets='<Budget scope="thread" max_turns="2"/>')
+        usage = parser.run()
+        self.assertEqual(usage['turns'], 3)
+        mod, solo = parser.get_agent_by_role('Mod'), parser.get_agent_by_role('Solo')
+        self.assertEqual(usage['threads'][mod.thread_id]['turns'], 2)
+        self.assertEqual(usage['threads'][solo.thread_id]['turns'], 1)
+        self.assertEqual([(stop['thread_id'], stop['limit']) for stop in usage['stopped']], [(mod.thread_id, 'turns')])
+        parser.close()
+
+    def test_run_budget_ends_the_run(self):
+        parser = make_parser(
+            '<Role name="Mod" class="PickingModerator" pick="A"/><Role name="A"/>',
+            '<Mod><A/></Mod>',
+            budgets='<Budget max_turns="3"/>')
+        usage = parser.run()
+        self.assertEqual(usage['turns'], 3)
+        self.assertEqual(usage['stopped'][0]['scope'], 'run')
+        parser.close()
+
+    def test_tokens_and_spend(self):
+        governor = BudgetGovernor(Plan.BudgetSpec('run', None, 100, None, None, 1.0, 2.0))
+        governor.charge_tokens('t1', 40, 10)
+        governor.charge_tokens('t1', 10, 10, prompt_price='4')
+        usage = governor.as_dict()
+        self.assertEqual((usage['prompt_tokens'], usage['completion_tokens']), (50, 20))
+        self.assertAlmostEqual(usage['spend'], 0.12)
+        governor.check('t1')
+        governor.charge_tokens('t2', 30, 0)
+        with self.assertRaises(BudgetExceeded) as raised:
+            governor.check('t1')
+        self.assertEqual((raised.exception.scope, raised.exception.limit), ('run', 'tokens'))
+
+    def test_arun_cancels_calls_when_the_wall_time_runs_out(self):
+        parser = make_parser('<Role name="Slow" class="SlowAgent"/>', '<Slow/>', budgets='<Budget max_seconds="0.2"/>')
+        started = time.monotonic()
+        usage = asyncio.run(parser.arun())
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual((usage['turns'], usage['stopped'][0]['limit']), (0, 'seconds'))
+        parser.close()
+
+    def test_batch_stats_report_budget_stops(self):
+        parser = make_parser(
+            '<Role name="Mod" class="PickingModerator" pick="A"/><Role name="A"/>',
+            '<Mod><A/></Mod>',
+            budgets='<Budget scope="thread" max_turns="2"/>')
+        stats = BatchRunner(parser, conversations=4, workers=2).run()
+        self.assertEqual((stats.steps, stats.budget_stops), (8, 4))
+        parser.close()
+
+
+class FlakyAgent(TestAgent):
+    __slots__ = ()
+    # set to make the second turn of every FlakyAgent fail like a dying process
+    crash = False
+
+    def execute(self):
+        if FlakyAgent.crash and self.messages_sent == 1:
+            raise RuntimeError('process died')
+        return super().execute()
+
+
+class TestCheckpoints(unittest.TestCase):
+    XML = ('<InteractionModel><Roles><Role name="Mod" class="PickingModerator" pick="A"/>'
+           '<Role name="A" class="FlakyAgent"/></Roles><ConvoLoop><Mod><A/></Mod></ConvoLoop></InteractionModel>')
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.directory, 'runs.db')
+
+    def make_parser(self, xml_string=None, **options):
+        return ConvoXML(xml_string or self.XML, db_path=self.db_path, agent_classes=[PickingModerator, FlakyAgent],
+                        run_id='run1', checkpoint_interval=0, **options)
+
+    def senders(self, parser):
+        rows = parser.connections.execute("SELECT sender FROM Messages WHERE thread_id = ? ORDER BY message_id",
+                                          (parser.agents[0].thread_id,))
+        return [sender for sender, in rows.fetchall()]
+
+    def test_finished_run_is_checkpointed_without_keys(self):
+        parser = self.make_parser(openai_key='secret-key')
+        parser.run()
+        digest, sequence, state = parser.connections.execute(
+            "SELECT digest, sequence, state FROM Checkpoints WHERE run_id = 'run1'").fetchone()
+        self.assertEqual(digest, parser.plan.digest)
+        self.assertEqual(sequence, 7)
+        self.assertNotIn('secret-key', state)
+        self.assertTrue(Checkpointer(parser.connections, 'run1', digest).load()['finished'])
+        parser.close()
+
+    def test_resume_continues_without_replaying_turns(self):
+        parser = self.make_parser()
+        with mock.patch.object(FlakyAgent, 'crash', True), self.assertRaises(RuntimeError):
+            parser.run()
+        self.assertEqual(self.senders(parser), ['Mod', 'A', 'Mod'])
+        parser.close()
+
+        resumed = self.make_parser()
+        usage = resumed.resume()
+        self.assertEqual(self.senders(resumed), ['Mod', 'A', 'Mod', 'A', 'Mod', 'A'])
+        self.assertEqual((resumed.steps, usage['turns']), (6, 6))
+        # a finished run has nothing left to do
+        resumed.resume()
+        self.assertEqual(len(self.senders(resumed)), 6)
+        resumed.close()
+
+    def test_resume_needs_a_checkpoint_of_the_same_definition(self):
+        parser = self.make_parser()
+        with self.assertRaises(ValueError):
+            parser.resume()
+        parser.run()
+        parser.close()
+        other = self.make_parser(self.XML.replace('pick="A"', 'pick="a"'))
+        with self.assertRaises(ValueError):
+            other.resume()
+        other.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+class TestMessageBus(unittest.TestCase):
+    def test_publish_reaches_subscribers_of_the_table_and_thread(self):
+        bus = MessageBus()
+        received = []
+        token = bus.subscribe('Messages', 't1', received.append)
+        bus.publish('Messages', 't1', 'Critic', 'first')
+        bus.publish('Messages', 't2', 'Critic', 'other thread')
+        bus.publish('Notes', 't1', 'Critic', 'other table')
+        bus.unsubscribe(token)
+        bus.publish('Messages', 't1', 'Critic', 'after unsubscribing')
+        self.assertEqual(received, [BusMessage('Messages', 't1', 'Critic', 'first')])
+
+    def test_agents_publish_their_output(self):
+        parser = make_parser('<Role name="Solo"/>', '<Solo/>')
+        received = []
+        solo = parser.agents[0]
+        parser.bus.subscribe('Messages', solo.thread_id, received.append)
+        parser.run()
+        self.assertEqual([(message.sender, message.content) for message in received],
+                         [('Solo', solo.test_message)])
+        parser.close()
+
+    def test_unsubscribed_inputs_do_not_wake_the_role(self):
+        roles = ('<Role name="Writer"><output table="Notes"/></Role>'
+                 '<Role name="Reader"><input table="Notes" subscribe="false"/><output table="Replies"/></Role>')
+        self.assertEqual(Plan.ConvoPlan.compile(
+            f"<InteractionModel><Roles>{roles}</Roles><ConvoLoop/></InteractionModel>").role('Reader').subscriptions, ())
+        parser = make_parser(roles, '<Writer/><Reader/><Writer/>')
+        for agent in parser.agents:
+            agent.thread_id = 'shared'
+        parser.run()
+        # Reader only runs in the first pass, when every step is ready
+        self.assertEqual(parser.connections.execute("SELECT COUNT(*) FROM Replies").fetchone()[0], 1)
+        parser.close()
+
+    def test_chat_messages_wake_an_idle_run(self):
+        parser = make_parser('<Role name="Solo" class="ReadingAgent"/>', '<Solo/>', idle_timeout=0.5)
+        solo = parser.agents[0]
+        # the parser's cache, so the woken run has to see the posted message through it
+        messages = ChatMessages(':memory:', thread_id=solo.thread_id, connections=parser.connections,
+                                cache=parser.cache, bus=parser.bus)
+        timer = threading.Timer(0.1, messages.insert_message, ['user', 'hello', None, None, None])
+        timer.start()
+        with mock.patch('builtins.print'):
+            parser.run()
+        timer.join()
+        senders = parser.connections.execute("SELECT sender FROM Messages WHERE thread_id = ? ORDER BY message_id",
+                                             (solo.thread_id,)).fetchall()
+        self.assertEqual([sender for sender, in senders], ['Solo', 'user', 'Solo'])
+        self.assertEqual(solo.inputs, [[], [solo.test_message, 'hello']])
+        parser.close()
+
+    def test_remote_messages_reach_the_woken_agent_through_the_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            db_path, bus_path = os.path.join(directory, 'convo.db'), os.path.join(directory, 'bus.sock')
+            parser = make_parser('<Role name="Solo" class="ReadingAgent"/>', '<Solo/>', db_path=db_path,
+                                 bus_path=bus_path, idle_timeout=1)
+            solo = parser.agents[0]
+            # another process, with its own connections and bus and no cache
+            connections, bus = ConnectionManager(db_path), SocketBus(bus_path)
+            messages = ChatMessages(db_path, thread_id=solo.thread_id, connections=connections, bus=bus)
+            timer = threading.Timer(0.2, messages.insert_message, ['user', 'hello', None, None, None])
+            timer.start()
+            with mock.patch('builtins.print'):
+                parser.run()
+            timer.join()
+            self.assertEqual(solo.inputs, [[], [solo.test_message, 'hello']])
+            bus.close()
+            connections.close()
+            parser.close()
+
+    def test_socket_bus_relays_between_processes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'bus.sock')
+            hub, first, second = SocketBus(path), SocketBus(path), SocketBus(path)
+            self.assertEqual((hub.hub, first.hub, second.hub), (True, False, False))
+            received = {name: threading.Event() for name in ('hub', 'second')}
+            hub.subscribe('Messages', 't1', lambda message: received['hub'].set())
+            second.subscribe('Messages', 't1', lambda message: message.content == 'hi' and received['second'].set())
+            first.publish('Messages', 't1', 'Critic', 'hi')
+            self.assertTrue(received['hub'].wait(2))
+            self.assertTrue(received['second'].wait(2))
+            for bus in (second, first, hub):
+                bus.close()
+            self.assertFalse(os.path.exists(path))
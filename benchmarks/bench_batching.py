@@ -0,0 +1,28 @@
+"""
+Parallel conversations of OpenAIAgent roles against the stub
+server, with each request sent on its own and with concurrent requests
+coalesced into calls to the stub's batch endpoint.
+"""
+from harness import Result, roles_xml, scaled, temporary_db
+from stub_llm import StubLLMServer
+
+from ConvoXML import ConvoXML, BatchRunner
+
+def run(scale):
+    conversations = scaled(64, scale)
+    results = []
+    with StubLLMServer(latency=0.02) as server:
+        for batched in (False, True):
+            attributes = 'batch_endpoint="/chat/completions/batch" batch_window="0.005"' if batched else ''
+            with temporary_db() as db_path:
+                parser = ConvoXML(roles_xml(2, 'OpenAIAgent', attributes=attributes), db_path=db_path, buffered_writes=True,
+                                  openai_key='stub', openai_base_url=server.base_url)
+                # the first call pays for importing the openai response types
+                parser.fork().run()
+                requests, batches = server.requests, server.batches
+                stats = BatchRunner(parser, conversations=conversations, workers=16).run()
+                parser.close()
+            results.append(Result('batching.conversation', [stats.elapsed], operations=stats.completed,
+                                  batched=batched, http_calls=(server.batches - batches) if batched
+                                  else server.requests - requests))
+    return results
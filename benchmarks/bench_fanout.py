@@ -0,0 +1,19 @@
+"""
+Multi-conversation fan-out with BatchRunner.
+"""
+from harness import Result, example_xml, scaled, temporary_db
+
+from ConvoXML import ConvoXML, BatchRunner
+
+
+def run(scale):
+    conversations = scaled(200, scale)
+    results = []
+    for mode, workers in (('thread', 1), ('thread', 4), ('thread', 8), ('process', 4)):
+        with temporary_db() as db_path:
+            parser = ConvoXML(example_xml(), db_path=db_path, buffered_writes=True)
+            stats = BatchRunner(parser, conversations=conversations, workers=workers, mode=mode).run()
+            parser.close()
+        results.append(Result('fanout.conversation', [stats.elapsed], operations=stats.completed,
+                              mode=mode, workers=workers))
+    return results
@@ -0,0 +1,74 @@
+"""
+Cold-start benchmark for `import ConvoXML`.
+
+Every measurement runs in a fresh interpreter, so nothing is cached in
+sys.modules. The script fails when the median import time is over the
+budget or when importing the package pulls in a provider SDK. Those SDKs
+should only be imported by the agents that use them.
+
+    python benchmarks/bench_import.py --runs 10 --budget 0.5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from harness import ROOT, Result, scaled
+
+# modules that must not be imported by `import ConvoXML`
+HEAVY_MODULES = ('openai', 'google.generativeai', 'grpc', 'google.protobuf', 'bs4', 'httpx')
+
+PROBE = f"""
+import json, sys, time
+started = time.perf_counter()
+import ConvoXML
+elapsed = time.perf_counter() - started
+print(json.dumps({{'elapsed': elapsed, 'loaded': [m for m in {HEAVY_MODULES!r} if m in sys.modules]}}))
+"""
+
+
+def measure_once():
+    output = subprocess.check_output([sys.executable, '-c', PROBE], cwd=ROOT, text=True)
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def measure(runs):
+    results = [measure_once() for _ in range(runs)]
+    loaded = sorted({module for result in results for module in result['loaded']})
+    timings = [result['elapsed'] for result in results]
+    return {
+        'runs': runs,
+        'median': statistics.median(timings),
+        'min': min(timings),
+        'max': max(timings),
+        'heavy_modules_loaded': loaded,
+    }
+
+
+def run(scale):
+    return [Result('import.cold_start', [measure_once()['elapsed'] for _ in range(scaled(10, scale))])]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--budget', type=float, default=float(os.environ.get('CONVOXML_IMPORT_BUDGET', 0.5)),
+                        help='maximum median import time in seconds')
+    args = parser.parse_args(argv)
+
+    result = measure(args.runs)
+    result['budget'] = args.budget
+    print(json.dumps(result, indent=2))
+    if result['heavy_modules_loaded']:
+        print(f"FAIL: import ConvoXML loaded {', '.join(result['heavy_modules_loaded'])}", file=sys.stderr)
+        return 1
+    if result['median'] > args.budget:
+        print(f"FAIL: median import time {result['median']:.3f}s is over the {args.budget:.3f}s budget", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,39 @@
+"""
+get_inputs latency as the Messages table grows, with and without the
+in-memory message cache.
+"""
+from harness import measure, scaled, temporary_db
+
+from ConvoXML import Schema
+from ConvoXML.Agents import TestAgent
+from ConvoXML.Cache import MessageCache
+from ConvoXML.Connections import ConnectionManager
+from ConvoXML.Writers import MessageWriter
+
+THREADS = 1000
+
+
+def fill(connections, rows):
+    Schema.migrate(connections.connection())
+    batch = 50000
+    for start in range(0, rows, batch):
+        connections.executemany("INSERT INTO Messages (thread_id, sender, content) VALUES (?, ?, ?)",
+                                ((f"thread{idx % THREADS}", 'bench', f"message {idx}")
+                                 for idx in range(start, min(rows, start + batch))))
+    connections.commit()
+
+
+def run(scale):
+    results = []
+    for rows in sorted({scaled(10000, scale), scaled(100000, scale), scaled(1000000, scale)}):
+        with temporary_db() as db_path:
+            connections = ConnectionManager(db_path)
+            fill(connections, rows)
+            for cached in (False, True):
+                writer = MessageWriter(connections, cache=MessageCache() if cached else None)
+                agent = TestAgent(role='Reader', thread_id='thread7', rows=10,
+                                  connections=connections, writer=writer)
+                results.append(measure('inputs.get_inputs', agent.get_inputs, operations=1,
+                                       repeat=200, warmup=5, rows=rows, cached=cached))
+            connections.close()
+    return results
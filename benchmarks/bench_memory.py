@@ -0,0 +1,20 @@
+"""
+Memory kept alive per conversation: the agents, queue and Context of a fork.
+"""
+from harness import example_xml, measure_memory, scaled, temporary_db
+
+from ConvoXML import ConvoXML
+
+
+def run(scale):
+    conversations = scaled(2000, scale)
+    results = []
+    for name in ('test_xml.xml', 'test_xml2.xml'):
+        with temporary_db() as db_path:
+            parser = ConvoXML(example_xml(name), db_path=db_path, openai_key='sk-bench', palm_key='bench')
+            # warm up lazily created state such as provider clients
+            parser.fork()
+            results.append(measure_memory('memory.conversation', lambda count: [parser.fork() for _ in range(count)],
+                                          conversations, definition=name))
+            parser.close()
+    return results
@@ -0,0 +1,31 @@
+"""
+XML compile time and agent construction for small and large role sets,
+and response_tag extraction from long model responses.
+"""
+from harness import measure, roles_xml, scaled, temporary_db
+
+from ConvoXML import ConvoXML
+from ConvoXML.Plan import ConvoPlan
+from ConvoXML.Streaming import extract_tag
+
+
+def long_response(paragraphs):
+    body = ' '.join(f"Step {index}: compare a < b and keep <b>notes</b>." for index in range(paragraphs))
+    return f"<thinking>{body}</thinking>\n<answer>{body}</answer>"
+
+
+def run(scale):
+    results = []
+    for roles in sorted({4, scaled(100, scale), scaled(1000, scale)}):
+        xml_string = roles_xml(roles)
+        results.append(measure('parse.compile_plan', lambda: ConvoPlan.compile(xml_string), roles=roles))
+        with temporary_db() as db_path:
+            parser = ConvoXML(xml_string, db_path=db_path)
+            # the plan is memoized, so this is the cost of a new conversation
+            results.append(measure('parse.fork', parser.fork, roles=roles))
+            parser.close()
+    for paragraphs in sorted({10, scaled(1000, scale)}):
+        response = long_response(paragraphs)
+        results.append(measure('parse.response_tag', lambda: extract_tag(response, 'answer'),
+                               chars=len(response)))
+    return results
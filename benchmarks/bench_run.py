@@ -0,0 +1,56 @@
+"""
+Per-turn latency of ConvoXMLParser.run, with test agents, with checkpoints
+and with provider agents talking to the offline stubs.
+"""
+import asyncio
+from unittest import mock
+
+from harness import example_xml, measure, roles_xml, scaled, temporary_db
+from stub_llm import StubLLMServer, StubPalm
+
+from ConvoXML import ConvoXML
+
+
+def steps_per_run(parser):
+    probe = parser.fork()
+    probe.run()
+    return probe.steps
+
+
+def measure_run(name, parser, repeat, use_async=False, **params):
+    steps = steps_per_run(parser)
+    if use_async:
+        fn = lambda conversation: asyncio.run(conversation.arun())
+    else:
+        fn = lambda conversation: conversation.run()
+    return measure(name, fn, operations=steps, repeat=repeat, setup=parser.fork, **params)
+
+
+def run(scale):
+    repeat = scaled(5, scale)
+    results = []
+    with temporary_db() as db_path:
+        parser = ConvoXML(example_xml(), db_path=db_path)
+        results.append(measure_run('run.turn.test_agents', parser, repeat))
+        parser.close()
+
+    # checkpoint cost per turn, saving after every turn and at most once a second
+    for interval in (0, 1):
+        with temporary_db() as db_path:
+            parser = ConvoXML(example_xml(), db_path=db_path, checkpoint_interval=interval)
+            results.append(measure_run('run.turn.checkpointed', parser, repeat, interval=interval))
+            parser.close()
+
+    for latency in (0.0, 0.02):
+        with StubLLMServer(latency=latency) as server, temporary_db() as db_path:
+            parser = ConvoXML(roles_xml(3, 'OpenAIAgent'), db_path=db_path,
+                              openai_key='stub', openai_base_url=server.base_url)
+            results.append(measure_run('run.turn.openai_stub', parser, repeat, latency=latency))
+            results.append(measure_run('arun.turn.openai_stub', parser, repeat, use_async=True, latency=latency))
+            parser.close()
+
+    with mock.patch('ConvoXML.Agents.import_palm', return_value=StubPalm()), temporary_db() as db_path:
+        parser = ConvoXML(roles_xml(3, 'PalmAgent'), db_path=db_path, palm_key='stub')
+        results.append(measure_run('run.turn.palm_stub', parser, repeat))
+        parser.close()
+    return results
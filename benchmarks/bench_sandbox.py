@@ -0,0 +1,27 @@
+"""
+Cost of running the <python> blocks of a developer response: a fresh
+`python -c` interpreter per block, as the developer agents used to do,
+against the pre-started SandboxPool.
+"""
+import subprocess
+import sys
+
+from harness import measure, scaled
+
+from ConvoXML.Sandbox import SandboxPool
+
+BLOCK = 'print(sum(range(1000)))'
+
+
+def run(scale):
+    repeat = scaled(5, scale)
+    results = []
+    for blocks in (1, 4):
+        def fresh_interpreters():
+            for _ in range(blocks):
+                subprocess.check_output([sys.executable, '-c', BLOCK], universal_newlines=True)
+        results.append(measure('sandbox.python_c', fresh_interpreters, repeat=repeat, blocks=blocks))
+        with SandboxPool(workers=4) as pool:
+            results.append(measure('sandbox.pool', lambda: pool.run_many([('python', BLOCK)] * blocks),
+                                   repeat=repeat, blocks=blocks))
+    return results
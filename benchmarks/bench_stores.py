@@ -0,0 +1,39 @@
+"""
+Write throughput and tail-read latency of each message store.
+"""
+import os
+
+from harness import measure, scaled, temporary_db
+
+from ConvoXML import Schema
+from ConvoXML.Connections import ConnectionManager
+from ConvoXML.Stores import create_store
+from ConvoXML.Writers import BufferedMessageWriter
+
+
+def run(scale):
+    messages = scaled(5000, scale)
+    threads = 50
+    results = []
+    for name in ('sqlite', 'memory', 'log', 'transcript'):
+        with temporary_db() as db_path:
+            connections = ConnectionManager(db_path)
+            Schema.migrate(connections.connection())
+            writer = BufferedMessageWriter(connections, cache=None)
+            store = create_store(name, connections, writer, directory=os.path.join(os.path.dirname(db_path), 'logs'))
+
+            def write():
+                for idx in range(messages):
+                    store.write('Messages', f"thread{idx % threads}", 'Writer', f"message {idx}")
+                store.flush()
+
+            def tail():
+                for idx in range(threads):
+                    store.last('Messages', f"thread{idx}", 10)
+
+            results.append(measure('stores.write', write, operations=messages, repeat=3, store=name))
+            results.append(measure('stores.last', tail, operations=threads, repeat=3, store=name))
+            store.close()
+            writer.close()
+            connections.close()
+    return results
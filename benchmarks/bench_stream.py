@@ -0,0 +1,54 @@
+"""
+Time to first chunk and to the complete reply for a streaming OpenAIAgent
+against the stub server, compared with the same agent without streaming.
+"""
+import time
+
+from harness import Result, scaled, temporary_db
+from stub_llm import StubLLMServer
+
+from ConvoXML import ConvoXML
+
+
+STREAM_XML = '''
+<ConvoXML>
+    <Roles>
+        <Role name="Writer" class="OpenAIAgent"/>
+    </Roles>
+    <ConvoLoop>
+        <Writer/>
+    </ConvoLoop>
+</ConvoXML>
+'''
+
+PROMPT = ['Describe the weather in one sentence.']
+
+
+def measure_stream(parser, repeat, stream):
+    first, total = [], []
+    for _ in range(repeat):
+        agent = parser.fork().agents[0]
+        started = time.perf_counter()
+        # without streaming the whole reply arrives as a single chunk
+        chunks = agent.stream_message(PROMPT) if stream else iter([agent.send_message(PROMPT)])
+        next(chunks)
+        first.append(time.perf_counter() - started)
+        for _ in chunks:
+            pass
+        total.append(time.perf_counter() - started)
+    return first, total
+
+
+def run(scale):
+    repeat = scaled(5, scale)
+    results = []
+    with StubLLMServer(latency=0.01, token_latency=0.002) as server:
+        for stream in (False, True):
+            with temporary_db() as db_path:
+                parser = ConvoXML(STREAM_XML, db_path=db_path,
+                                  openai_key='stub', openai_base_url=server.base_url)
+                first, total = measure_stream(parser, repeat, stream)
+                results.append(Result('stream.first_chunk', first, stream=stream))
+                results.append(Result('stream.complete', total, stream=stream))
+                parser.close()
+    return results
@@ -0,0 +1,32 @@
+"""
+Write throughput of output_messsage with the direct and the buffered writer.
+"""
+from harness import measure, scaled, temporary_db
+
+from ConvoXML import Schema
+from ConvoXML.Agents import TestAgent
+from ConvoXML.Connections import ConnectionManager
+from ConvoXML.Writers import MessageWriter, BufferedMessageWriter
+
+
+def run(scale):
+    messages = scaled(5000, scale)
+    results = []
+    for synchronous in ('NORMAL', 'FULL'):
+        for buffered in (False, True):
+            with temporary_db() as db_path:
+                connections = ConnectionManager(db_path, synchronous=synchronous)
+                Schema.migrate(connections.connection())
+                writer = BufferedMessageWriter(connections) if buffered else MessageWriter(connections)
+                agent = TestAgent(role='Writer', connections=connections, writer=writer)
+
+                def write():
+                    for idx in range(messages):
+                        agent.output_messsage(f"message {idx}")
+                    writer.flush()
+
+                results.append(measure('writes.output_message', write, operations=messages, repeat=3,
+                                       synchronous=synchronous, buffered=buffered))
+                writer.close()
+                connections.close()
+    return results
@@ -0,0 +1,155 @@
+"""
+Small timing harness shared by the benchmark modules.
+
+Each benchmark module defines `run(scale)` and returns a list of Result
+objects. `scale` multiplies the problem sizes, so `--scale 0.1` gives a
+quick smoke run and `--scale 10` gives the multi-million-row runs.
+"""
+import gc
+import glob
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+EXAMPLES_DIR = os.path.join(ROOT, 'ConvoXML', 'examples')
+
+
+class Result:
+    def __init__(self, name, timings, operations=1, **params):
+        self.name = name
+        # seconds per repetition, each repetition performing `operations` operations
+        self.timings = timings
+        self.operations = operations
+        self.params = params
+
+    @property
+    def median(self):
+        return statistics.median(self.timings) / self.operations
+
+    @property
+    def best(self):
+        return min(self.timings) / self.operations
+
+    @property
+    def ops_per_second(self):
+        return 1 / self.median if self.median else float('inf')
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'params': self.params,
+            'median_seconds': self.median,
+            'best_seconds': self.best,
+            'ops_per_second': self.ops_per_second,
+            'repeat': len(self.timings),
+            'operations': self.operations,
+        }
+
+    def __str__(self):
+        params = ' '.join(f"{key}={value}" for key, value in self.params.items())
+        return (f"{self.name:<40} {params:<28} median {self.median * 1e6:>12.1f} us"
+                f"  best {self.best * 1e6:>12.1f} us  {self.ops_per_second:>12.1f} ops/s")
+
+
+class MemoryResult:
+    def __init__(self, name, allocated, count=1, **params):
+        self.name = name
+        # bytes still allocated after creating `count` objects
+        self.allocated = allocated
+        self.count = count
+        self.params = params
+
+    @property
+    def bytes_per_item(self):
+        return self.allocated / self.count
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'params': self.params,
+            'bytes_per_item': self.bytes_per_item,
+            'count': self.count,
+        }
+
+    def __str__(self):
+        params = ' '.join(f"{key}={value}" for key, value in self.params.items())
+        return f"{self.name:<40} {params:<28} {self.bytes_per_item:>12.0f} bytes each"
+
+
+def measure_memory(name, fn, count, **params):
+    """
+    Calls fn(count), which creates count objects and returns them, and reports
+    the Python heap they keep alive according to tracemalloc.
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        objects = fn(count)
+        gc.collect()
+        allocated = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    del objects
+    return MemoryResult(name, allocated, count, **params)
+
+
+def measure(name, fn, operations=1, repeat=5, warmup=1, setup=None, **params):
+    """
+    Calls fn() `repeat` times after `warmup` untimed calls. setup(), when given,
+    runs untimed before every call and its return value is passed to fn.
+    """
+    timings = []
+    for idx in range(warmup + repeat):
+        argument = setup() if setup else None
+        started = time.perf_counter()
+        fn(argument) if setup else fn()
+        elapsed = time.perf_counter() - started
+        if idx >= warmup:
+            timings.append(elapsed)
+    return Result(name, timings, operations, **params)
+
+
+def scaled(value, scale):
+    return max(1, int(value * scale))
+
+
+@contextmanager
+def temporary_db(name='bench.db'):
+    with tempfile.TemporaryDirectory(prefix='convoxml-bench-') as directory:
+        yield os.path.join(directory, name)
+
+
+def remove_db(db_path):
+    for path in glob.glob(db_path + '*'):
+        os.remove(path)
+
+
+def example_xml(name='test_xml.xml'):
+    with open(os.path.join(EXAMPLES_DIR, name)) as f:
+        return f.read()
+
+
+def roles_xml(roles, agent_class='TestAgent', moderator=True, attributes=''):
+    """
+    A definition with a moderator and `roles` participants in one branch.
+    `attributes` is added to every participant's <Role>.
+    """
+    participants = [f"Participant{idx}" for idx in range(roles)]
+    role_elements = ''.join(f'<Role name="{name}" class="{agent_class}" {attributes}/>' for name in participants)
+    cases = ''.join(f'<Case role="{name}" case="{idx}"/>' for idx, name in enumerate(participants))
+    if moderator:
+        role_elements = '<Role name="Moderator" class="TestModerator"/>' + role_elements
+        loop = f"<Moderator>{cases}</Moderator>"
+    else:
+        loop = ''.join(f"<{name}/>" for name in participants)
+    return (f"<InteractionModel><Roles>{role_elements}</Roles>"
+            f"<ConvoLoop>{loop}</ConvoLoop></InteractionModel>")
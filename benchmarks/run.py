@@ -0,0 +1,56 @@
+"""
+Runs the ConvoXML benchmark suite.
+
+    python benchmarks/run.py                  # every benchmark
+    python benchmarks/run.py inputs writes    # only bench_inputs.py and bench_writes.py
+    python benchmarks/run.py --scale 0.1      # quick smoke run
+    python benchmarks/run.py --json results.json
+
+Provider agents talk to the stubs in stub_llm.py, so results do not depend
+on network access or API keys.
+"""
+import argparse
+import glob
+import importlib
+import json
+import os
+import sys
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARKS_DIR)
+
+
+def discover():
+    paths = sorted(glob.glob(os.path.join(BENCHMARKS_DIR, 'bench_*.py')))
+    return [os.path.basename(path)[len('bench_'):-len('.py')] for path in paths]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('names', nargs='*', help='benchmarks to run, default all')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplier for problem sizes')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args(argv)
+
+    available = discover()
+    names = args.names or available
+    unknown = sorted(set(names) - set(available))
+    if unknown:
+        parser.error(f"unknown benchmarks {', '.join(unknown)}, available: {', '.join(available)}")
+
+    results = []
+    for name in names:
+        module = importlib.import_module(f"bench_{name}")
+        print(f"# {name}")
+        for result in module.run(args.scale):
+            print(result)
+            results.append(result.as_dict())
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
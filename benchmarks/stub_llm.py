@@ -0,0 +1,183 @@
+"""
+Offline stand-ins for the model providers, so benchmarks are reproducible
+without network access or API keys.
+
+StubLLMServer speaks the subset of the OpenAI HTTP API used by OpenAIAgent
+(`POST /v1/chat/completions`) and answers after a fixed latency with a
+deterministic reply. `POST /v1/chat/completions/batch` answers several
+requests for the latency of one. With `"stream": true` the reply is sent word by word as
+server-sent events, `token_latency` seconds apart. StubPalm replaces the google.generativeai module used by
+PalmAgent.
+
+    with StubLLMServer(latency=0.05) as server:
+        parser = ConvoXML(xml_string, openai_key='stub', openai_base_url=server.base_url)
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def stub_reply(messages):
+    last = messages[-1]['content'] if messages else ''
+    return f"stub reply to: {last[:80]}"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body go out as separate writes; without this, reused
+    # keep-alive connections stall on delayed ACKs
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b'{}')
+        if self.path.rstrip('/').endswith('/chat/completions/batch'):
+            body = self.server.complete_batch(request)
+        elif self.path.rstrip('/').endswith('/chat/completions'):
+            if request.get('stream'):
+                self.send_stream(self.server.stream(request))
+                return
+            body = self.server.complete(request)
+        else:
+            self.send_error(404)
+            return
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def send_stream(self, events):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for event in events:
+            data = f"data: {event if isinstance(event, str) else json.dumps(event)}\n\n".encode('utf-8')
+            self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+            self.wfile.flush()
+        self.wfile.write(b"0\r\n\r\n")
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, token_latency=0.0, host='127.0.0.1', port=0):
+        super().__init__((host, port), _Handler)
+        self.latency = latency
+        self.token_latency = token_latency
+        self.requests = 0
+        self.batches = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def complete(self, request, wait=True):
+        with self._lock:
+            self.requests += 1
+            request_id = self.requests
+        if wait and self.latency:
+            time.sleep(self.latency)
+        messages = request.get('messages', [])
+        content = stub_reply(messages)
+        if wait and self.token_latency:
+            # the same generation time a streamed reply takes
+            time.sleep(self.token_latency * (len(content.split(' ')) - 1))
+        prompt_tokens = sum(len(message.get('content', '').split()) for message in messages)
+        return {
+            'id': f"chatcmpl-stub-{request_id}",
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': request.get('model', 'stub'),
+            'choices': [{'index': 0, 'finish_reason': 'stop',
+                         'message': {'role': 'assistant', 'content': content}}],
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': len(content.split()),
+                      'total_tokens': prompt_tokens + len(content.split())},
+        }
+
+    def complete_batch(self, request):
+        """
+        Answers {"requests": [...]} with {"responses": [...]}, paying the
+        latency once for the whole batch like a server that batches on the GPU.
+        """
+        with self._lock:
+            self.batches += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return {'responses': [self.complete(item, wait=False) for item in request.get('requests', [])]}
+
+    def stream(self, request):
+        """
+        Yields the chat.completion.chunk events of a streamed reply, ending with
+        a usage chunk and the [DONE] sentinel.
+        """
+        with self._lock:
+            self.requests += 1
+            request_id = self.requests
+        if self.latency:
+            time.sleep(self.latency)
+        messages = request.get('messages', [])
+        words = stub_reply(messages).split(' ')
+        chunk = {'id': f"chatcmpl-stub-{request_id}", 'object': 'chat.completion.chunk',
+                 'created': int(time.time()), 'model': request.get('model', 'stub')}
+        for index, word in enumerate(words):
+            if index and self.token_latency:
+                time.sleep(self.token_latency)
+            text = word if index == 0 else ' ' + word
+            yield dict(chunk, choices=[{'index': 0, 'finish_reason': None, 'delta': {'content': text}}])
+        yield dict(chunk, choices=[{'index': 0, 'finish_reason': 'stop', 'delta': {}}])
+        if (request.get('stream_options') or {}).get('include_usage'):
+            prompt_tokens = sum(len(message.get('content', '').split()) for message in messages)
+            yield dict(chunk, choices=[], usage={'prompt_tokens': prompt_tokens, 'completion_tokens': len(words),
+                                                 'total_tokens': prompt_tokens + len(words)})
+        yield '[DONE]'
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class _PalmResponse:
+    def __init__(self, messages):
+        self.messages = messages
+
+
+class StubPalm:
+    """
+    Drop-in for the google.generativeai module, e.g.
+    mock.patch('ConvoXML.Agents.import_palm', return_value=StubPalm()).
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.requests = 0
+
+    def configure(self, api_key=None, **kwargs):
+        pass
+
+    def chat(self, messages=None, **kwargs):
+        self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+        messages = list(messages or [])
+        return _PalmResponse(messages + [{'author': '1', 'content': stub_reply(messages)}])